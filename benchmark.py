@@ -0,0 +1,649 @@
+'''
+    Benchmarks of the hot paths.
+
+    usage: python benchmark.py [--seed N] [--repeat N] [--json FILE] [--compare FILE] [name ...]
+
+    Timings are printed pyperf style (mean +- std dev over --repeat runs),
+    other figures as value and unit.  Synthetic traffic comes from
+    random.Random(seed), so a run is reproducible for a given seed.
+    --json writes every result, --compare prints the ratio of each
+    timing to the same benchmark in a previous --json file.
+'''
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import bufferpool
+import capture
+import fec
+import forward
+import metrics
+import profile
+import retransmit
+import rtp
+import rtcp
+import transport
+
+SEED = 1234
+REPEAT = 5
+RESULTS = []
+
+'''
+    Same classes without __slots__, i.e. the per-instance __dict__
+    layout the records had before.
+'''
+class DictRtpHeader(rtp.RtpHeader):
+    pass
+
+class DictSource(rtp.Source):
+    pass
+
+class DictRtcpReceiverItem(rtcp.RtcpReceiverItem):
+    pass
+
+def timeit(func,loops):
+    t0 = time.perf_counter()
+    func(loops)
+    return (time.perf_counter() - t0) / loops
+
+def memory_per_instance(cls,count):
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    objs = [ cls() for _ in range(count) ]
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del objs
+    return used / count
+
+def format_time(seconds):
+    for unit,scale in (('ns',1e9),('us',1e6),('ms',1e3)):
+        if abs(seconds) * scale < 1000:
+            return '%.1f %s' % (seconds * scale,unit)
+    return '%.2f sec' % seconds
+
+'''
+    Run func(loops) `repeat` times, record and print the time per loop.
+'''
+def measure(name,func,loops,repeat=None):
+    values = [ timeit(func,loops) for _ in range(repeat or REPEAT) ]
+    mean = statistics.mean(values)
+    dev = statistics.stdev(values) if len(values) > 1 else 0.0
+    print('%s: Mean +- std dev: %s +- %s' % (name,format_time(mean),format_time(dev)))
+    RESULTS.append({'name': name,'unit': 'second','loops': loops,'values': values,'mean': mean,'stdev': dev})
+    return mean
+
+'''
+    Record and print a figure which is not a time (memory, throughput...)
+'''
+def report(name,value,unit):
+    print('%s: %.1f %s' % (name,value,unit))
+    RESULTS.append({'name': name,'unit': unit,'values': [value],'mean': value,'stdev': 0.0})
+
+
+def bench_records():
+    count = 100000
+    for slotted,legacy in ((rtp.RtpHeader,DictRtpHeader),(rtp.Source,DictSource),(rtcp.RtcpReceiverItem,DictRtcpReceiverItem)):
+        report('%s memory (slots)' % slotted.__name__,memory_per_instance(slotted,count),'B/obj')
+        report('%s memory (dict)' % slotted.__name__,memory_per_instance(legacy,count),'B/obj')
+
+    for cls in (rtp.RtpHeader,DictRtpHeader):
+        def create(loops,cls=cls):
+            for i in range(loops):
+                h = cls()
+                h.version = 2
+                h.seq = i
+                h.timestamp = i * 160
+                h.ssrc = 0x1234
+        measure('%s create+set' % cls.__name__,create,count)
+
+    for cls in (rtp.Source,DictSource):
+        def update(loops,cls=cls):
+            s = cls()
+            s.init_seq(0)
+            for i in range(loops):
+                s.update_seq(i & 0xFFFF)
+        measure('%s update_seq' % cls.__name__,update,count)
+
+
+def make_rtp_dump(count,payload_size=160):
+    buf = bytearray()
+    offsets = []
+    h = rtp.RtpHeader()
+    h.version = 2
+    h.ssrc = 0x1234
+    payload = bytes(payload_size)
+    for i in range(count):
+        offsets.append(len(buf))
+        h.seq = i
+        h.timestamp = i * payload_size
+        buf += h.toByteArray()
+        buf += payload
+    return bytes(buf),offsets
+
+def bench_decode_batch():
+    count = 100000
+    buf,offsets = make_rtp_dump(count)
+    def single(loops):
+        view = memoryview(buf)
+        h = rtp.RtpHeader()
+        for off in offsets[:loops]:
+            h.parse_into(view[off:off + 172])
+    measure('RtpHeader.parse_into (dump slices)',single,count)
+    measure('decode_headers (python)',lambda loops: rtp._decode_headers_python(buf,offsets,None),count)
+    if rtp.numpy is not None:
+        measure('decode_headers (numpy)',lambda loops: rtp._decode_headers_numpy(buf,offsets,None),count)
+
+def bench_source_table():
+    count = 100000
+    sources = 1000
+    ssrcs = [ i % sources for i in range(count) ]
+    seqs = [ (i // sources) & 0xFFFF for i in range(count) ]
+    timestamps = [ (i // sources) * 160 for i in range(count) ]
+    arrivals = [ t + (i % 7) for i,t in enumerate(timestamps) ]
+    def objects(loops):
+        table = {}
+        for ssrc,seq,ts,arrival in zip(ssrcs,seqs,timestamps,arrivals):
+            s = table.get(ssrc)
+            if s is None:
+                s = table[ssrc] = rtp.Source()
+                s.init_source(seq)
+            s.receive(seq,ts,arrival)
+    def columns(loops):
+        rtp.SourceTable().update(ssrcs,seqs,timestamps,arrivals)
+    measure('Source.receive',objects,count)
+    measure('SourceTable.update',columns,count)
+
+'''
+    Loopback throughput: send `count` packets in bursts of `burst`, then
+    drain the receiver.  Returns packets/s received.
+'''
+def loopback(sender,receiver,count,burst,packet):
+    received = 0
+    t0 = time.perf_counter()
+    for _ in range(count // burst):
+        for _ in range(burst):
+            sender.send(packet)
+        sender.flush()
+        while True:
+            n = receiver.receive()
+            if n == 0:
+                break
+            received += n
+    return received / (time.perf_counter() - t0)
+
+class NaiveTransport(transport.Transport):
+    def __init__(self,local_addr=('127.0.0.1',0),remote_addr=None,with_addr=False):
+        transport.Transport.__init__(self)
+        self.with_addr = with_addr      # recvfrom(), as a relay needs the sender address
+        self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind(local_addr)
+        if remote_addr is not None:
+            self.sock.connect(remote_addr)
+        self.local_addr = self.sock.getsockname()
+
+    def send(self,packet):
+        self.sock.send(packet)
+
+    def flush(self):
+        pass
+
+    def receive(self):
+        try:
+            if self.with_addr:
+                data = self.sock.recvfrom(2048)
+            else:
+                data = self.sock.recv(2048)
+        except BlockingIOError:
+            return 0
+        if self._callback is not None:
+            self._callback(data)
+        return 1
+
+    def close(self):
+        self.sock.close()
+
+def bench_transport_batch():
+    count = 64000
+    burst = 32
+    packet = bytes(172)
+    for with_addr in (False,True):
+        rx = NaiveTransport(with_addr=with_addr)
+        tx = NaiveTransport(remote_addr=rx.local_addr)
+        name = 'recvfrom/send' if with_addr else 'recv/send'
+        report('per-packet transport loopback (%s)' % name,loopback(tx,rx,count,burst,packet),'pkt/s')
+        rx.close()
+        tx.close()
+    for use_mmsg in (False,True):
+        rx = transport.BatchTransport(('127.0.0.1',0),batch=burst,use_mmsg=use_mmsg)
+        tx = transport.BatchTransport(('127.0.0.1',0),remote_addr=rx.local_addr,batch=burst,use_mmsg=use_mmsg)
+        name = 'recvmmsg/sendmmsg' if tx.use_mmsg else 'recv/send loop'
+        report('BatchTransport loopback (%s)' % name,loopback(tx,rx,count,burst,packet),'pkt/s')
+        rx.close()
+        tx.close()
+
+class SinkTransport(transport.Transport):
+    def __init__(self):
+        transport.Transport.__init__(self)
+        self.sent = 0
+
+    def send(self,packet,addr=None):
+        self.sent += 1
+
+'''
+    1 -> `fanout` forwarding of one incoming packet: parse and re-serialize
+    per subscriber, rewrite in place per subscriber, rewrite once for all.
+'''
+def bench_fanout():
+    count = 2000
+    fanout = 100
+    packet,_ = make_rtp_dump(1)
+    sinks = [ SinkTransport() for _ in range(fanout) ]
+
+    def reserialize(loops):
+        for i in range(loops):
+            for n,sink in enumerate(sinks):
+                header,payload = rtp.RtpHeader.from_buffer(packet)
+                header.ssrc = n
+                header.seq = header.seq + i
+                header.timestamp = header.timestamp + i * 160
+                sink.send(header.toByteArray() + payload)
+    measure('fan-out 1->%d re-serialize' % fanout,reserialize,count)
+
+    streams = []
+    for n,sink in enumerate(sinks):
+        stream = forward.ForwardStream(n)
+        stream.subscribe(sink)
+        streams.append(stream)
+    fwd = forward.Forwarder()
+    for stream in streams:
+        fwd.add(stream)
+    buf = bytearray(packet)
+    measure('fan-out 1->%d rewrite per stream' % fanout,lambda loops: [ fwd.forward(buf,len(buf)) for _ in range(loops) ],count)
+
+    shared = forward.ForwardStream(0x5555)
+    for sink in sinks:
+        shared.subscribe(sink)
+    measure('fan-out 1->%d rewrite once' % fanout,lambda loops: [ shared.forward(buf,len(buf)) for _ in range(loops) ],count)
+
+    rx = [ socket.socket(socket.AF_INET,socket.SOCK_DGRAM) for _ in range(fanout) ]
+    for sock in rx:
+        sock.bind(('127.0.0.1',0))
+    tx = transport.BatchTransport(('127.0.0.1',0),batch=fanout)
+    udp = forward.ForwardStream(0x6666)
+    for sock in rx:
+        udp.subscribe(tx,sock.getsockname())
+    def udp_fanout(loops):
+        for _ in range(loops):
+            udp.forward(buf,len(buf))
+            tx.flush()
+    measure('fan-out 1->%d rewrite once, UDP' % fanout,udp_fanout,count // 10)
+    tx.close()
+    for sock in rx:
+        sock.close()
+
+def bench_buffer_pool():
+    count = 200000
+    header = rtp.RtpHeader()
+    header.version = 2
+    def allocate(loops):
+        for _ in range(loops):
+            buf = bytearray(rtp.RTP_MTU)
+            header.pack_into(buf,0)
+    pool = bufferpool.BufferPool()
+    def borrow(loops):
+        for _ in range(loops):
+            buf = pool.acquire()
+            header.pack_into(buf,0)
+            pool.release(buf)
+    measure('bytearray(MTU) per packet',allocate,count)
+    measure('BufferPool acquire/release',borrow,count)
+    report('BufferPool misses',pool.misses,'')
+
+def bench_header():
+    count = 100000
+    h = rtp.RtpHeader()
+    h.version = 2
+    h.ssrc = 0x1234
+    h.csrc = [1,2]
+    buf = bytearray(rtp.RTP_MTU)
+    def pack(loops):
+        for i in range(loops):
+            h.seq = i
+            h.pack_into(buf,0)
+    def to_bytes(loops):
+        for _ in range(loops):
+            h.toByteArray()
+    packet = bytes(h.toByteArray()) + bytes(160)
+    view = memoryview(packet)
+    def parse(loops):
+        p = rtp.RtpHeader()
+        for _ in range(loops):
+            p.parse_into(view)
+    def from_buffer(loops):
+        for _ in range(loops):
+            rtp.RtpHeader.from_buffer(view)
+    measure('RtpHeader.pack_into',pack,count)
+    measure('RtpHeader.toByteArray',to_bytes,count)
+    measure('RtpHeader.parse_into',parse,count)
+    measure('RtpHeader.from_buffer',from_buffer,count)
+
+'''
+    Deterministic sequence number trace of `count` packets starting at a
+    random seq:
+        inorder:   every packet once, in order
+        reordered: 10% of the packets swapped with the next one
+        lossy:     5% of the packets lost, in bursts of 1 to 3
+'''
+def make_seq_trace(kind,count,rng):
+    start = rng.randrange(rtp.RTP_SEQ_MOD)
+    seqs = [ (start + i) & 0xFFFF for i in range(count) ]
+    if kind == 'reordered':
+        i = 0
+        while i < count - 1:
+            if rng.random() < 0.1:
+                seqs[i],seqs[i + 1] = seqs[i + 1],seqs[i]
+                i += 1
+            i += 1
+    elif kind == 'lossy':
+        out = []
+        i = 0
+        while i < count:
+            if rng.random() < 0.05 / 2:
+                i += rng.randint(1,3)
+                continue
+            out.append(seqs[i])
+            i += 1
+        seqs = out
+    elif kind != 'inorder':
+        raise ValueError('unknown trace kind %r' % (kind,))
+    return seqs
+
+def bench_seq():
+    count = 100000
+    for kind in ('inorder','reordered','lossy'):
+        seqs = make_seq_trace(kind,count,random.Random(SEED))
+        def update(loops,seqs=seqs):
+            s = rtp.Source()
+            s.init_source(seqs[0])
+            for seq in seqs:
+                s.update_seq(seq)
+        measure('Source.update_seq (%s)' % kind,update,len(seqs))
+
+def make_report_items(count,rng):
+    items = []
+    for _ in range(count):
+        item = rtcp.RtcpReceiverItem()
+        item.ssrc = rng.randrange(1,1 << 32)
+        item.fraction = rng.randrange(256)
+        item.lost = rng.randrange(1 << 20)
+        item.last_seq = rng.randrange(1 << 32)
+        item.jitter = rng.randrange(1 << 16)
+        item.lsr = rng.randrange(1 << 32)
+        item.dlsr = rng.randrange(1 << 20)
+        items.append(item)
+    return items
+
+def bench_rtcp_compound():
+    count = 20000
+    items = make_report_items(rtcp.RTCP_MAX_REPORTS,random.Random(SEED))
+    builder = rtcp.CompoundRtcpBuilder(0x1234,'bench@example.org')
+    measure('CompoundRtcpBuilder.build (31 RR)',lambda loops: [ builder.build(items) for _ in range(loops) ],count)
+    packet = bytes(builder.build(items,bye=[0x1234],reason='bench'))
+    def parse(loops):
+        for _ in range(loops):
+            rtcp.parse_compound(packet)
+    def parse_all(loops):
+        for _ in range(loops):
+            for block in rtcp.parse_compound(packet):
+                if block.packet_type == rtcp.RTCP_TYPE.RTCP_RR:
+                    for item in block.reports:
+                        item.jitter
+    measure('parse_compound',parse,count)
+    measure('parse_compound + read every RR',parse_all,count)
+
+def bench_rtcp_interval():
+    count = 20000
+    rng = random.Random(SEED)
+    for members in (10,1000,100000):
+        r = rtcp.Rtcp(64)
+        for i in range(members):
+            ssrc = rng.randrange(1,1 << 32)
+            if i % 10 == 0:
+                r.sources.on_rtp(ssrc,0,None,0)
+            else:
+                r.sources.on_rtcp(ssrc,None,0)
+        measure('Rtcp.rtcp_interval (%d members)' % members,lambda loops: [ r.rtcp_interval() for _ in range(loops) ],count)
+
+def bench_profile_pcm():
+    count = 100000
+    pcm = profile.PcmProfile()
+    rng = random.Random(SEED)
+    frames = [ bytes(rng.randrange(256) for _ in range(pcm.bytes_per_frame)) for _ in range(3) ]
+    payload = pcm.pack(frames)
+    buf = bytearray(rtp.RTP_MTU)
+    measure('PcmProfile.pack (3 frames)',lambda loops: [ pcm.pack(frames) for _ in range(loops) ],count)
+    measure('PcmProfile.pack_into (3 frames)',lambda loops: [ pcm.pack_into(frames,buf,12) for _ in range(loops) ],count)
+    measure('PcmProfile.unpack (3 frames)',lambda loops: [ pcm.unpack(payload) for _ in range(loops) ],count)
+
+'''
+    End to end: RtpStream packetizes PCM into an AsyncioTransport, the
+    peer AsyncioTransport parses what arrives.  Bursts are small enough
+    for the socket buffers, time is per packet received.
+'''
+def bench_loopback():
+    count = 20000
+    burst = 16
+    async def run(loops):
+        rx = await transport.AsyncioTransport().open('127.0.0.1',0)
+        tx = await transport.AsyncioTransport().open('127.0.0.1',0,'127.0.0.1',rx.local_port)
+        pcm = profile.PcmProfile()
+        stream = rtp.RtpStream(profile=pcm,transport=tx,ssrc=0x1234)
+        frames = [ bytes(pcm.bytes_per_frame) ]
+        try:
+            for _ in range(loops // burst):
+                for _ in range(burst):
+                    stream.send_frames(frames)
+                target = stream.packets_sent
+                for _ in range(1000):
+                    if rx.received >= target:
+                        break
+                    await asyncio.sleep(0)
+        finally:
+            tx.close()
+            rx.close()
+        return rx.received
+    received = []
+    def loop(loops):
+        received.append(asyncio.run(run(loops)))
+    measure('RtpStream -> AsyncioTransport loopback',loop,count)
+    report('loopback packets lost',count * len(received) - sum(received),'pkt')
+
+
+def bench_fec():
+    count = 20000
+    window = 10
+    rnd = random.Random(SEED)
+    header = rtp.RtpHeader()
+    header.version = 2
+    header.ssrc = 0x1234
+    packets = []
+    for i in range(window * 10):
+        header.seq = i
+        header.timestamp = i * 160
+        buf = bytearray(rtp.RTP_HEADER_SIZE) + bytes(rnd.getrandbits(8) for _ in range(rnd.randint(100,1200)))
+        header.pack_into(buf,0)
+        packets.append(bytes(buf))
+    def encode(loops):
+        enc = fec.FecEncoder(window)
+        for i in range(loops):
+            enc.add(packets[i % len(packets)])
+    parity = []
+    enc = fec.FecEncoder(window)
+    for p in packets:
+        f = enc.add(p)
+        if f is not None:
+            parity.append(bytes(f))
+    def recover(loops):
+        done = 0
+        while done < loops:
+            dec = fec.FecDecoder()
+            for w,f in enumerate(parity):
+                lost = w * window + rnd.randrange(window)
+                for i in range(w * window,(w + 1) * window):
+                    if i != lost:
+                        dec.add_media(packets[i])
+                if dec.add_fec(f) != [packets[lost]]:
+                    raise AssertionError('FecDecoder recovered a wrong packet %d' % lost)
+            done += len(packets)
+    measure('FecEncoder.add (window %d)' % window,encode,count)
+    measure('FecDecoder one loss per window, per media packet',recover,count)
+    report('FEC overhead',100.0 / window,'%')
+def bench_capture():
+    count = 20000
+    rnd = random.Random(SEED)
+    header = rtp.RtpHeader()
+    header.version = 2
+    header.ssrc = 0x1234
+    with tempfile.TemporaryDirectory() as tmp:
+        path = tmp + '/bench.pcap'
+        with capture.PcapWriter(path) as writer:
+            for i in range(count):
+                header.seq = i & 0xFFFF
+                header.timestamp = i * 160
+                writer.write(bytes(header.toByteArray()) + bytes(rnd.randint(20,1200)),1000.0 + i * 0.02)
+        def read(loops):
+            done = 0
+            while done < loops:
+                with capture.open_capture(path) as reader:
+                    for _ in reader:
+                        done += 1
+        measure('PcapReader iteration, per packet',read,count)
+        report('pcap file size',os.path.getsize(path) // 1024,'KiB')
+def bench_retransmit():
+    count = 100000
+    capacity = 256
+    rnd = random.Random(SEED)
+    packet = bytearray(rtp.RTP_HEADER_SIZE + 160)
+    packet[0] = 0x80
+    cache = retransmit.RetransmissionCache(capacity)
+    def put(loops):
+        for i in range(loops):
+            # mostly in order, some jumps so slots get overwritten out of order
+            seq = i & 0xFFFF if i % 16 else rnd.randrange(0x10000)
+            packet[2] = seq >> 8
+            packet[3] = seq & 0xFF
+            cache.put(packet,i * 0.02)
+            if len(cache._order) > 2 * capacity + 1:
+                raise AssertionError('RetransmissionCache order queue unbounded: %d' % len(cache._order))
+    measure('RetransmissionCache.put',put,count)
+    report('RetransmissionCache order queue',len(cache._order),'entries')
+
+    # 50 packets/s through RtpStream, NACKs for the last 2 s: only the
+    # packets younger than max_age (1 s) may go out again
+    now = [0.0]
+    pcm = profile.PcmProfile()
+    stream = rtp.RtpStream(profile=pcm,transport=SinkTransport(),ssrc=0x1234,
+                           rtx_cache=retransmit.RetransmissionCache(capacity,clock=lambda: now[0]))
+    frames = [ bytes(pcm.bytes_per_frame) ]
+    def send(loops):
+        for _ in range(loops):
+            now[0] += 0.02
+            stream.send_frames(frames)
+    measure('RtpStream.send_frames with rtx_cache',send,count)
+    last = (stream.header.seq - 1) & 0xFFFF
+    sent = stream.retransmit([ (last - i) & 0xFFFF for i in range(100) ])
+    if sent > 51 or stream.rtx_cache.packets > 51:
+        raise AssertionError('packets older than max_age retransmitted: %d' % sent)
+    report('RtpStream.retransmit of the last 2 s',sent,'pkt')
+    report('RetransmissionCache expired',stream.rtx_cache.expired,'pkt')
+
+def bench_metrics():
+    count = 200000
+    header = rtp.RtpHeader()
+    header.version = 2
+    header.ssrc = 0x1234
+    packet = bytes(header.toByteArray()) + bytes(160)
+    receiver = transport.AsyncioTransport()
+    receiver.readable(lambda packet: None)
+    def deliver(loops):
+        for _ in range(loops):
+            receiver._deliver(packet,None)
+    measure('AsyncioTransport receive, metrics off',deliver,count)
+    registry = metrics.MetricsRegistry()
+    receiver.metrics = registry.session('bench')
+    measure('AsyncioTransport receive, metrics on',deliver,count)
+    registry.enable_profiler()
+    measure('AsyncioTransport receive, metrics and profiler on',deliver,count)
+    registry.disable_profiler()
+    report('profiler samples',registry.profiler.total,'')
+
+BENCHMARKS = {
+    'records':      bench_records,
+    'decode_batch': bench_decode_batch,
+    'source_table': bench_source_table,
+    'transport_batch': bench_transport_batch,
+    'fanout':       bench_fanout,
+    'buffer_pool':  bench_buffer_pool,
+    'capture':      bench_capture,
+    'fec':          bench_fec,
+    'header':       bench_header,
+    'seq':          bench_seq,
+    'rtcp_compound': bench_rtcp_compound,
+    'rtcp_interval': bench_rtcp_interval,
+    'profile_pcm':  bench_profile_pcm,
+    'retransmit':   bench_retransmit,
+    'loopback':     bench_loopback,
+    'metrics':      bench_metrics,
+}
+
+def compare(path):
+    with open(path) as f:
+        old = dict( (r['name'],r) for r in json.load(f)['benchmarks'] )
+    for r in RESULTS:
+        prev = old.get(r['name'])
+        if prev is None or r['unit'] != 'second' or not prev['mean']:
+            continue
+        ratio = r['mean'] / prev['mean']
+        print('%s: %s -> %s: %.2fx %s' % (r['name'],format_time(prev['mean']),format_time(r['mean']),
+                                           ratio if ratio >= 1 else 1 / ratio,'slower' if ratio >= 1 else 'faster'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pyrtp benchmarks')
+    parser.add_argument('names',nargs='*',help='benchmarks to run, default all: %s' % ' '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--seed',type=int,default=SEED)
+    parser.add_argument('--repeat',type=int,default=REPEAT)
+    parser.add_argument('--json',help='write the results to this file')
+    parser.add_argument('--compare',help='compare with the results of a previous --json run')
+    args = parser.parse_args()
+    SEED = args.seed
+    REPEAT = args.repeat
+    for name in args.names or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r' % name)
+    for name in args.names or sorted(BENCHMARKS):
+        print('[%s]' % name)
+        BENCHMARKS[name]()
+    if args.json:
+        with open(args.json,'w') as f:
+            json.dump({
+                'python': sys.version,
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'numpy': rtp.numpy is not None,
+                'seed': SEED,
+                'repeat': REPEAT,
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'benchmarks': RESULTS,
+            },f,indent=1)
+    if args.compare:
+        compare(args.compare)
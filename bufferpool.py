@@ -0,0 +1,94 @@
+from rtp import RTP_MTU
+
+'''
+    Pool of fixed size, preallocated packet buffers.
+
+    acquire() hands out a bytearray of exactly `size` bytes, release() gives
+    it back for reuse.  Buffers are reused last in first out, so the hot
+    ones stay in cache.  When the pool is empty acquire() allocates a new
+    buffer and counts a miss; released buffers beyond `count` are left to
+    the garbage collector.
+
+        with pool.borrow() as buf:
+            n = header.pack_into(buf,0)
+            ...
+
+    Nothing checks that a buffer is not used after release(), the caller
+    must drop every memoryview over it first.
+'''
+class BufferPool:
+    def __init__(self,size=RTP_MTU,count=256):
+        self.size = size
+        self.count = count
+        self._free = [ bytearray(size) for _ in range(count) ]
+
+        self.in_use = 0
+        self.high_water = 0             # largest in_use seen
+        self.acquired = 0
+        self.misses = 0                 # acquire() with the pool empty
+        self.discarded = 0              # released buffers the pool had no room for
+
+    def acquire(self):
+        self.acquired += 1
+        self.in_use += 1
+        if self.in_use > self.high_water:
+            self.high_water = self.in_use
+        if self._free:
+            return self._free.pop()
+        self.misses += 1
+        return bytearray(self.size)
+
+    def release(self,buf):
+        if len(buf) != self.size:
+            raise ValueError('buffer does not belong to this pool')
+        self.in_use -= 1
+        if len(self._free) < self.count:
+            self._free.append(buf)
+        else:
+            self.discarded += 1
+
+    def borrow(self):
+        return _Loan(self)
+
+    @property
+    def available(self):
+        return len(self._free)
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'count': self.count,
+            'available': len(self._free),
+            'in_use': self.in_use,
+            'high_water': self.high_water,
+            'acquired': self.acquired,
+            'misses': self.misses,
+            'discarded': self.discarded,
+        }
+
+class _Loan:
+    __slots__ = ('pool','buf')
+
+    def __init__(self,pool):
+        self.pool = pool
+        self.buf = None
+
+    def __enter__(self):
+        self.buf = self.pool.acquire()
+        return self.buf
+
+    def __exit__(self,*exc):
+        self.pool.release(self.buf)
+        self.buf = None
+        return False
+
+_shared = None
+
+'''
+    Process wide pool of RTP_MTU buffers, created on first use.
+'''
+def shared_pool():
+    global _shared
+    if _shared is None:
+        _shared = BufferPool()
+    return _shared
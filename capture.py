@@ -0,0 +1,433 @@
+import argparse
+import asyncio
+import mmap
+import os
+import socket
+import struct
+import time
+
+from rtp import RtpHeader
+
+'''
+    Packet captures: pcap (libpcap, not pcapng) and rtpdump (rtptools).
+
+    Readers memory-map the whole file and walk it record by record, nothing
+    is read into Python objects up front, so captures larger than memory
+    can be scanned.  Packets are handed out as memoryviews over the map,
+    valid until close().
+
+        with open_capture('incident.pcap') as capture:
+            for timestamp,header,payload in capture:
+                ...
+
+    Writers append through a regular buffered file.
+'''
+PCAP_MAGIC_USEC = 0xA1B2C3D4
+PCAP_MAGIC_NSEC = 0xA1B23C4D
+PCAP_SNAPLEN = 65535
+
+class PCAP_LINKTYPE:
+    NULL        = 0             # BSD loopback, 4 bytes address family
+    ETHERNET    = 1
+    RAW         = 101           # IPv4 or IPv6, no link header
+    LINUX_SLL   = 113
+    IPV4        = 228
+    IPV6        = 229
+    LINUX_SLL2  = 276
+
+RTPDUMP_MAGIC = b'#!rtpplay1.0 '
+RTPDUMP_FILE_HEADER = struct.Struct('!IIIHH')   # start sec, start usec, source address, port, padding
+RTPDUMP_PACKET_HEADER = struct.Struct('!HHI')   # length (header included), RTP length (0 for RTCP), offset ms
+
+IPV4_HEADER = struct.Struct('!BBHHHBBH4s4s')
+UDP_HEADER = struct.Struct('!HHHH')
+IPPROTO_UDP = 17
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100,0x88A8)
+
+'''
+    RTCP packet types 192..223 read as RTP marker bit + payload types
+    64..95, which RFC 5761 keeps free of RTP.
+'''
+def is_rtcp(packet):
+    return len(packet) >= 2 and 192 <= packet[1] <= 223
+
+class _CaptureReader:
+    def __init__(self,path):
+        self.path = path
+        self._file = open(path,'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size:
+            self._map = mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+            self.view = memoryview(self._map)
+        else:
+            self._map = None
+            self.view = memoryview(b'')
+        self.header = RtpHeader()       # reused by __iter__
+        self.packets = 0
+        self.skipped = 0                # records which are not UDP / RTP
+
+    '''
+        Every RTP packet: (timestamp, RtpHeader, payload memoryview).
+
+        The same RtpHeader instance is filled for every packet, copy what
+        is kept across iterations.  RTCP and anything which does not parse
+        as RTP is counted in skipped.
+    '''
+    def __iter__(self):
+        header = self.header
+        for timestamp,packet in self.datagrams():
+            if is_rtcp(packet):
+                self.skipped += 1
+                continue
+            try:
+                payload = header.parse_into(packet)
+            except ValueError:
+                self.skipped += 1
+                continue
+            self.packets += 1
+            yield timestamp,header,payload
+
+    '''
+        Unmap the file.  If views over it are still referenced, the map is
+        left to be freed with the last of them.
+    '''
+    def close(self):
+        try:
+            self.view.release()
+            if self._map is not None:
+                self._map.close()
+        except BufferError:
+            pass
+        self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+        return False
+
+'''
+    pcap reader, UDP over IPv4/IPv6 on Ethernet (VLAN tags skipped),
+    Linux cooked (SLL, SLL2), BSD loopback or raw IP.  IP fragments and
+    IPv6 extension headers are skipped, not reassembled.
+
+    port: when given, only datagrams from or to that UDP port
+'''
+class PcapReader(_CaptureReader):
+    def __init__(self,path,port=None):
+        _CaptureReader.__init__(self,path)
+        self.port = port
+        view = self.view
+        if len(view) < 24:
+            self.close()
+            raise ValueError('pcap file too short')
+        magic = struct.unpack_from('<I',view,0)[0]
+        if magic in (PCAP_MAGIC_USEC,PCAP_MAGIC_NSEC):
+            order = '<'
+        else:
+            order = '>'
+            magic = struct.unpack_from('>I',view,0)[0]
+            if magic not in (PCAP_MAGIC_USEC,PCAP_MAGIC_NSEC):
+                self.close()
+                raise ValueError('not a pcap file')
+        self.resolution = 1e-9 if magic == PCAP_MAGIC_NSEC else 1e-6
+        _,_,_,_,self.snaplen,self.linktype = struct.unpack_from(order + 'HHiIII',view,4)
+        self.linktype &= 0xFFFF
+        self._record = struct.Struct(order + 'IIII')
+
+    '''
+        Every UDP payload: (timestamp, memoryview)
+    '''
+    def datagrams(self):
+        view = self.view
+        end = len(view)
+        record = self._record
+        pos = 24
+        resolution = self.resolution
+        link = self._link_offset
+        while pos + 16 <= end:
+            sec,frac,caplen,_ = record.unpack_from(view,pos)
+            pos += 16
+            if pos + caplen > end:
+                break                   # truncated capture
+            frame = view[pos:pos + caplen]
+            pos += caplen
+            offset = link(frame)
+            data = self._udp(frame,offset) if offset is not None else None
+            if data is None:
+                self.skipped += 1
+                continue
+            yield sec + frac * resolution,data
+
+    def _link_offset(self,frame):
+        linktype = self.linktype
+        n = len(frame)
+        if linktype == PCAP_LINKTYPE.ETHERNET:
+            pos = 12
+            while pos + 2 <= n:
+                ethertype = (frame[pos] << 8) | frame[pos + 1]
+                if ethertype in ETHERTYPE_VLAN:
+                    pos += 4
+                    continue
+                if ethertype in (ETHERTYPE_IPV4,ETHERTYPE_IPV6):
+                    return pos + 2
+                return None
+            return None
+        if linktype in (PCAP_LINKTYPE.RAW,PCAP_LINKTYPE.IPV4,PCAP_LINKTYPE.IPV6):
+            return 0
+        if linktype == PCAP_LINKTYPE.LINUX_SLL:
+            return 16
+        if linktype == PCAP_LINKTYPE.LINUX_SLL2:
+            return 20
+        if linktype == PCAP_LINKTYPE.NULL:
+            return 4
+        return None
+
+    def _udp(self,frame,pos):
+        n = len(frame)
+        if pos >= n:
+            return None
+        version = frame[pos] >> 4
+        if version == 4:
+            if pos + 20 > n:
+                return None
+            ihl = (frame[pos] & 0xF) << 2
+            total = (frame[pos + 2] << 8) | frame[pos + 3]
+            fragment = ((frame[pos + 6] << 8) | frame[pos + 7]) & 0x3FFF
+            if frame[pos + 9] != IPPROTO_UDP or fragment:
+                return None
+            end = min(n,pos + total)
+            pos += ihl
+        elif version == 6:
+            if pos + 40 > n or frame[pos + 6] != IPPROTO_UDP:
+                return None
+            end = min(n,pos + 40 + ((frame[pos + 4] << 8) | frame[pos + 5]))
+            pos += 40
+        else:
+            return None
+        if pos + 8 > end:
+            return None
+        sport,dport,length,_ = UDP_HEADER.unpack_from(frame,pos)
+        if self.port is not None and self.port != sport and self.port != dport:
+            return None
+        end = min(end,pos + length)
+        return frame[pos + 8:end]
+
+'''
+    rtpdump reader (rtpplay 1.0 binary format).  Timestamps are the
+    capture start time plus each packet's millisecond offset.
+'''
+class RtpdumpReader(_CaptureReader):
+    def __init__(self,path):
+        _CaptureReader.__init__(self,path)
+        view = self.view
+        if bytes(view[:len(RTPDUMP_MAGIC)]) != RTPDUMP_MAGIC:
+            self.close()
+            raise ValueError('not a rtpdump file')
+        eol = bytes(view[:256]).find(b'\n')
+        if eol < 0 or eol + 1 + RTPDUMP_FILE_HEADER.size > len(view):
+            self.close()
+            raise ValueError('rtpdump file header truncated')
+        self.address = bytes(view[len(RTPDUMP_MAGIC):eol]).decode('ascii','replace')
+        sec,usec,_,_,_ = RTPDUMP_FILE_HEADER.unpack_from(view,eol + 1)
+        self.start = sec + usec * 1e-6
+        self._first = eol + 1 + RTPDUMP_FILE_HEADER.size
+
+    '''
+        Every packet, RTP and RTCP: (timestamp, memoryview)
+    '''
+    def datagrams(self):
+        view = self.view
+        end = len(view)
+        pos = self._first
+        start = self.start
+        size = RTPDUMP_PACKET_HEADER.size
+        while pos + size <= end:
+            length,_,offset = RTPDUMP_PACKET_HEADER.unpack_from(view,pos)
+            if length < size or pos + length > end:
+                break                   # truncated dump
+            pos += length
+            yield start + offset * 1e-3,view[pos - length + size:pos]
+
+'''
+    Open a pcap or rtpdump capture, whichever the file holds.
+'''
+def open_capture(path,port=None):
+    with open(path,'rb') as f:
+        head = f.read(len(RTPDUMP_MAGIC))
+    if head == RTPDUMP_MAGIC:
+        return RtpdumpReader(path)
+    return PcapReader(path,port)
+
+def _ipv4_checksum(header):
+    total = sum(struct.unpack('!10H',header))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+class _CaptureWriter:
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+        return False
+
+'''
+    pcap writer, RTP/RTCP packets wrapped in IPv4 + UDP headers on a raw IP
+    link (no checksum on UDP, which IPv4 allows).
+
+    write(packet, timestamp, src, dst): src and dst are (IPv4 address, port),
+    timestamp defaults to time.time()
+'''
+class PcapWriter(_CaptureWriter):
+    def __init__(self,path,src=('127.0.0.1',5004),dst=('127.0.0.1',5004),snaplen=PCAP_SNAPLEN):
+        self.src = src
+        self.dst = dst
+        self.snaplen = snaplen
+        self._file = open(path,'wb')
+        self._file.write(struct.pack('<IHHiIII',PCAP_MAGIC_USEC,2,4,0,0,snaplen,PCAP_LINKTYPE.RAW))
+        self._record = struct.Struct('<IIII')
+        self._head = bytearray(self._record.size + IPV4_HEADER.size + UDP_HEADER.size)
+        self._id = 0
+        self.packets = 0
+
+    def write(self,packet,timestamp=None,src=None,dst=None):
+        if timestamp is None:
+            timestamp = time.time()
+        src = src or self.src
+        dst = dst or self.dst
+        head = self._head
+        length = IPV4_HEADER.size + UDP_HEADER.size + len(packet)
+        if length > 0xFFFF:
+            raise ValueError('packet too large for IPv4')
+        caplen = min(length,self.snaplen)
+        sec = int(timestamp)
+        self._record.pack_into(head,0,sec,int((timestamp - sec) * 1e6),caplen,length)
+        pos = self._record.size
+        IPV4_HEADER.pack_into(head,pos,0x45,0,length,self._id,0x4000,64,IPPROTO_UDP,0,
+                              socket.inet_aton(src[0]),socket.inet_aton(dst[0]))
+        struct.pack_into('!H',head,pos + 10,_ipv4_checksum(head[pos:pos + IPV4_HEADER.size]))
+        UDP_HEADER.pack_into(head,pos + IPV4_HEADER.size,src[1],dst[1],UDP_HEADER.size + len(packet),0)
+        self._id = (self._id + 1) & 0xFFFF
+        self._file.write(head)
+        self._file.write(packet[:caplen - IPV4_HEADER.size - UDP_HEADER.size])
+        self.packets += 1
+
+'''
+    rtpdump writer.  source is the (IPv4 address, port) put in the file
+    header, start the capture start time (default: first packet).
+'''
+class RtpdumpWriter(_CaptureWriter):
+    def __init__(self,path,source=('0.0.0.0',0),start=None):
+        self.source = source
+        self.start = start
+        self._file = open(path,'wb')
+        self._head = bytearray(RTPDUMP_PACKET_HEADER.size)
+        self.packets = 0
+        if start is not None:
+            self._write_header()
+
+    def _write_header(self):
+        address,port = self.source
+        self._file.write(RTPDUMP_MAGIC + ('%s/%d\n' % (address,port)).encode('ascii'))
+        sec = int(self.start)
+        self._file.write(RTPDUMP_FILE_HEADER.pack(sec,int((self.start - sec) * 1e6),
+                         struct.unpack('!I',socket.inet_aton(address))[0],port,0))
+
+    def write(self,packet,timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        if self.start is None:
+            self.start = timestamp
+            self._write_header()
+        length = len(packet)
+        if length + RTPDUMP_PACKET_HEADER.size > 0xFFFF:
+            raise ValueError('packet too large for rtpdump')
+        offset = max(0,int(round((timestamp - self.start) * 1000)))
+        RTPDUMP_PACKET_HEADER.pack_into(self._head,0,length + RTPDUMP_PACKET_HEADER.size,
+                                        0 if is_rtcp(packet) else length,offset & 0xFFFFFFFF)
+        self._file.write(self._head)
+        self._file.write(packet)
+        self.packets += 1
+
+REPLAY_MIN_SLEEP = 0.001            # below this replay sends without sleeping
+
+'''
+    Send the datagrams of a capture through a transport.Transport.
+
+    The time between packets is the captured one divided by speed (2.0
+    replays twice as fast), speed 0 sends as fast as possible.  RTCP goes
+    to transport.send_rtcp() if the transport has one, otherwise it is
+    left out.  Return the number of packets sent.
+
+        replay(open_capture('incident.pcap',port=5004),transport,speed=4)
+'''
+def replay(capture,transport,speed=1.0,clock=time.monotonic,sleep=time.sleep):
+    count = 0
+    for delay,packet in _paced(capture,transport,speed,clock):
+        if delay >= REPLAY_MIN_SLEEP:
+            sleep(delay)
+        count += _send(transport,packet)
+    return count
+
+'''
+    Same as replay(), sleeping with asyncio (for AsyncioTransport)
+'''
+async def replay_async(capture,transport,speed=1.0,clock=time.monotonic):
+    count = 0
+    for delay,packet in _paced(capture,transport,speed,clock):
+        if delay >= REPLAY_MIN_SLEEP:
+            await asyncio.sleep(delay)
+        count += _send(transport,packet)
+    return count
+
+def _paced(capture,transport,speed,clock):
+    first = None
+    for timestamp,packet in capture.datagrams():
+        if not speed:
+            yield 0.0,packet
+            continue
+        if first is None:
+            first = timestamp
+            start = clock()
+        yield start + (timestamp - first) / speed - clock(),packet
+
+def _send(transport,packet):
+    if is_rtcp(packet):
+        send_rtcp = getattr(transport,'send_rtcp',None)
+        if send_rtcp is None:
+            return 0
+        send_rtcp(packet)
+        return 1
+    transport.send(packet)
+    return 1
+
+if __name__ == '__main__':
+    from transport import AsyncioTransport
+
+    parser = argparse.ArgumentParser(description='replay a pcap or rtpdump capture to host:port (RTP, RTCP on port + 1)')
+    parser.add_argument('capture')
+    parser.add_argument('host')
+    parser.add_argument('port',type=int)
+    parser.add_argument('--speed',type=float,default=1.0,help='replay speed factor, 0 for as fast as possible')
+    parser.add_argument('--filter-port',type=int,help='only UDP datagrams from or to this port (pcap)')
+    args = parser.parse_args()
+
+    async def main():
+        transport = await AsyncioTransport().open('0.0.0.0',0,args.host,args.port)
+        try:
+            with open_capture(args.capture,args.filter_port) as capture:
+                count = await replay_async(capture,transport,args.speed)
+                print('%d packets sent, %d records skipped' % (count,capture.skipped))
+        finally:
+            transport.close()
+    asyncio.run(main())
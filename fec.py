@@ -0,0 +1,315 @@
+import random
+import struct
+from collections import OrderedDict, deque
+
+from rtp import RTP_FIXED_HEADER, RTP_HEADER_SIZE, RTP_MTU, RTP_VERSION
+
+'''
+    XOR parity FEC of RFC 5109 (ULPFEC), one protection level.
+
+    FEC packet = RTP header of the FEC stream, FEC header, level 0 header,
+    then the XOR of the protected payloads (everything after the 12 bytes
+    fixed header, padded with zeros to the longest):
+
+        FEC header:     E L P X CC | M PT recovery | SN base
+                        TS recovery
+                        length recovery
+        level 0:        protection length | mask (16 bits, 48 if L)
+
+    XOR is done on whole packets turned into Python ints (int.from_bytes),
+    not byte by byte.
+'''
+FEC_HEADER = struct.Struct('!BBHIH')
+FEC_LEVEL_HEADER = struct.Struct('!HH')
+FEC_LEVEL_HEADER_LONG = struct.Struct('!HHI')
+FEC_SHORT_MASK = 16
+FEC_LONG_MASK = 48
+FEC_WINDOW = 5
+FEC_HISTORY = 512                   # media packets kept by the decoder
+FEC_MAX_PENDING = 64                # FEC packets waiting for more media
+
+def _fec_overhead(long_mask):
+    return RTP_HEADER_SIZE + FEC_HEADER.size + (FEC_LEVEL_HEADER_LONG.size if long_mask else FEC_LEVEL_HEADER.size)
+
+'''
+    Sender side: one parity packet every `window` media packets.
+
+        fec = FecEncoder(window=5,paytype=127)
+        packet = fec.add(rtp_packet)        # a FEC packet or None
+
+    window is at most 48 packets, a 48-bit mask is used above 16.  The FEC
+    stream has its own SSRC and sequence numbers.  add() returns a
+    memoryview over the encoder's buffer, valid until the next FEC packet.
+'''
+class FecEncoder:
+    def __init__(self,window=FEC_WINDOW,paytype=127,ssrc=None,mtu=RTP_MTU):
+        if not 0 < window <= FEC_LONG_MASK:
+            raise ValueError('FEC window must be 1..48 packets')
+        self.window = window
+        self.paytype = paytype
+        self.ssrc = ssrc if ssrc is not None else random.randint(1,0xFFFFFFFF)
+        self.seq = random.randint(0,0xFFFF)
+        self.long_mask = window > FEC_SHORT_MASK
+        self.mtu = mtu
+        self.buf = bytearray(mtu)
+        self.view = memoryview(self.buf)
+        self.packets_sent = 0
+        self._reset()
+
+    def _reset(self):
+        self._count = 0
+        self._base = None
+        self._head = 0          # XOR of the first 2 bytes of the RTP headers
+        self._ts = 0
+        self._length = 0        # XOR of the lengths after the fixed header
+        self._payload = 0       # XOR of everything after the fixed header, as int
+        self._size = 0          # longest of those
+        self._mask = 0          # bit i: packet SN base + i protected
+        self._last_ts = 0
+
+    '''
+        Account one media packet (bytes-like, complete RTP packet before
+        SRTP).  Return the FEC packet when the window is complete, or when
+        a sequence gap ends the current window early.
+    '''
+    def add(self,packet):
+        n = len(packet)
+        if n < RTP_HEADER_SIZE:
+            raise ValueError('RTP packet too short')
+        b0,b1,seq,ts,_ = RTP_FIXED_HEADER.unpack_from(packet,0)
+        partial = None
+        if self._base is None:
+            self._base = seq
+        elif (seq - self._base) & 0xFFFF >= self.window:
+            # gap in the media stream: close the current window first, its
+            # FEC packet is returned (this packet starts a new window, which
+            # window >= 2 cannot complete at once)
+            partial = self.flush()
+            self._base = seq
+        self._head ^= (b0 << 8) | b1
+        self._ts ^= ts
+        size = n - RTP_HEADER_SIZE
+        self._length ^= size
+        v = int.from_bytes(packet[RTP_HEADER_SIZE:],'big')
+        if size > self._size:
+            self._payload <<= (size - self._size) << 3
+            self._size = size
+        elif size < self._size:
+            v <<= (self._size - size) << 3
+        self._payload ^= v
+        self._last_ts = ts
+        self._mask |= 1 << ((seq - self._base) & 0xFFFF)
+        self._count += 1
+        if self._count < self.window:
+            return partial
+        packet = self._build()
+        self._reset()
+        return packet
+
+    '''Emit the FEC packet of a partial window (end of stream)'''
+    def flush(self):
+        if not self._count:
+            return None
+        packet = self._build()
+        self._reset()
+        return packet
+
+    def _build(self):
+        buf = self.buf
+        start = _fec_overhead(self.long_mask)
+        end = start + self._size
+        if end > self.mtu:
+            raise ValueError('FEC packet exceeds mtu')
+        RTP_FIXED_HEADER.pack_into(buf,0,RTP_VERSION << 6,self.paytype & 0x7F,self.seq,self._last_ts,self.ssrc)
+        head = self._head
+        b0 = (head >> 8) & 0x3F
+        if self.long_mask:
+            b0 |= 0x40
+        FEC_HEADER.pack_into(buf,RTP_HEADER_SIZE,b0,head & 0xFF,self._base,self._ts,self._length)
+        pos = RTP_HEADER_SIZE + FEC_HEADER.size
+        if self.long_mask:
+            mask = _reverse_mask(self._mask,FEC_LONG_MASK)
+            FEC_LEVEL_HEADER_LONG.pack_into(buf,pos,self._size,mask >> 32,mask & 0xFFFFFFFF)
+        else:
+            FEC_LEVEL_HEADER.pack_into(buf,pos,self._size,_reverse_mask(self._mask,FEC_SHORT_MASK))
+        buf[start:end] = self._payload.to_bytes(self._size,'big')
+        self.seq = (self.seq + 1) & 0xFFFF
+        self.packets_sent += 1
+        return self.view[:end]
+
+'''
+    Bit i of the mask (packet SN base + i) is sent most significant bit
+    first: convert between that and an int with bit i = 1 << i.
+'''
+def _reverse_mask(mask,bits):
+    out = 0
+    for i in range(bits):
+        if mask >> i & 1:
+            out |= 1 << (bits - 1 - i)
+    return out
+
+class _FecPacket:
+    __slots__ = ('seqs','head','ts','length','size','payload','done')
+
+'''
+    Receiver side: recover single losses inside each FEC window.
+
+    Feed every media packet to add_media() and every FEC packet (by payload
+    type or SSRC) to add_fec(), both return the list of media packets
+    recovered thanks to it (bytes, complete RTP packets) to hand to the
+    jitter buffer like received ones.  The last `history` media packets
+    are kept to XOR with, FEC packets missing more than one of their
+    packets wait (at most max_pending of them) for another loss to be
+    recovered.
+'''
+class FecDecoder:
+    def __init__(self,history=FEC_HISTORY,max_pending=FEC_MAX_PENDING):
+        self.history = history
+        self.max_pending = max_pending
+        self._media = OrderedDict()         # seq -> packet bytes
+        self._pending = deque()             # _FecPacket, oldest first
+        self._waiting = {}                  # missing seq -> [_FecPacket] covering it
+        self.ssrc = None                    # media SSRC, learnt from add_media()
+        self.received = 0
+        self.recovered = 0
+        self.unrecoverable = 0              # FEC packets given up with losses left
+        self.errors = 0                     # FEC packets dropped, inconsistent with the media
+
+    def add_media(self,packet):
+        n = len(packet)
+        if n < RTP_HEADER_SIZE:
+            raise ValueError('RTP packet too short')
+        seq = (packet[2] << 8) | packet[3]
+        if seq in self._media:
+            return []
+        self.received += 1
+        if self.ssrc is None:
+            self.ssrc = struct.unpack_from('!I',packet,8)[0]
+        self._store(seq,bytes(packet))
+        return self._arrived(seq)
+
+    def add_fec(self,packet):
+        n = len(packet)
+        if n < RTP_HEADER_SIZE + FEC_HEADER.size + FEC_LEVEL_HEADER.size:
+            raise ValueError('FEC packet too short')
+        b0,b1,base,ts,length = FEC_HEADER.unpack_from(packet,RTP_HEADER_SIZE)
+        pos = RTP_HEADER_SIZE + FEC_HEADER.size
+        if b0 & 0x40:
+            if n < pos + FEC_LEVEL_HEADER_LONG.size:
+                raise ValueError('FEC packet too short')
+            size,high,low = FEC_LEVEL_HEADER_LONG.unpack_from(packet,pos)
+            mask = _reverse_mask((high << 32) | low,FEC_LONG_MASK)
+            pos += FEC_LEVEL_HEADER_LONG.size
+        else:
+            size,mask = FEC_LEVEL_HEADER.unpack_from(packet,pos)
+            mask = _reverse_mask(mask,FEC_SHORT_MASK)
+            pos += FEC_LEVEL_HEADER.size
+        if pos + size > n:
+            raise ValueError('FEC protection length exceeds packet')
+        fec = _FecPacket()
+        fec.seqs = [ (base + i) & 0xFFFF for i in range(FEC_LONG_MASK) if mask >> i & 1 ]
+        fec.head = (b0 << 8) | b1
+        fec.ts = ts
+        fec.length = length
+        fec.size = size
+        fec.payload = int.from_bytes(packet[pos:pos + size],'big')
+        fec.done = False
+        recovered = []
+        if self._try(fec,recovered):
+            fec.done = True
+            for p in list(recovered):
+                recovered.extend(self._arrived((p[2] << 8) | p[3]))
+            return recovered
+        for seq in fec.seqs:
+            if seq not in self._media:
+                self._waiting.setdefault(seq,[]).append(fec)
+        self._pending.append(fec)
+        while len(self._pending) > self.max_pending:
+            old = self._pending.popleft()
+            if not old.done:
+                old.done = True
+                self.unrecoverable += 1
+                self._unwait(old)
+        return recovered
+
+    def _unwait(self,fec):
+        for seq in fec.seqs:
+            fecs = self._waiting.get(seq)
+            if fecs and fec in fecs:
+                fecs.remove(fec)
+                if not fecs:
+                    del self._waiting[seq]
+
+    def _store(self,seq,packet):
+        self._media[seq] = packet
+        while len(self._media) > self.history:
+            self._media.popitem(last=False)
+
+    '''
+        Recover from fec if exactly one protected packet is missing.
+        Return True when fec is done with: recovered, nothing missing, or
+        dropped as an error when a protected packet or the recovered length
+        exceeds its protection length.
+    '''
+    def _try(self,fec,recovered):
+        missing = None
+        present = []
+        for seq in fec.seqs:
+            packet = self._media.get(seq)
+            if packet is None:
+                if missing is not None:
+                    return False
+                missing = seq
+            else:
+                present.append(packet)
+        if missing is None:
+            return True
+        head = fec.head
+        ts = fec.ts
+        length = fec.length
+        payload = fec.payload
+        for packet in present:
+            b0,b1,_,t,_ = RTP_FIXED_HEADER.unpack_from(packet,0)
+            head ^= (b0 << 8) | b1
+            ts ^= t
+            n = len(packet) - RTP_HEADER_SIZE
+            length ^= n
+            if n > fec.size:
+                # packet not covered by this FEC packet's protection length
+                self.errors += 1
+                return True
+            payload ^= int.from_bytes(packet[RTP_HEADER_SIZE:],'big') << ((fec.size - n) << 3)
+        if length > fec.size:
+            self.errors += 1
+            return True
+        ssrc = self.ssrc if self.ssrc is not None else 0
+        out = bytearray(RTP_HEADER_SIZE + length)
+        RTP_FIXED_HEADER.pack_into(out,0,(RTP_VERSION << 6) | ((head >> 8) & 0x3F),head & 0xFF,missing,ts,ssrc)
+        out[RTP_HEADER_SIZE:] = (payload >> ((fec.size - length) << 3)).to_bytes(length,'big')
+        packet = bytes(out)
+        self._store(missing,packet)
+        self.recovered += 1
+        recovered.append(packet)
+        return True
+
+    '''
+        seq is now known (received or recovered): retry the FEC packets
+        which were waiting for it, and for what they recover in turn.
+    '''
+    def _arrived(self,seq):
+        recovered = []
+        work = [seq]
+        while work:
+            fecs = self._waiting.pop(work.pop(),None)
+            if not fecs:
+                continue
+            for fec in fecs:
+                if fec.done:
+                    continue
+                n = len(recovered)
+                if self._try(fec,recovered):
+                    fec.done = True
+                    work.extend( (p[2] << 8) | p[3] for p in recovered[n:] )
+        if not self._waiting:
+            self._pending.clear()
+        return recovered
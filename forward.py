@@ -0,0 +1,183 @@
+import struct
+
+from rtp import RTP_HEADER_SIZE, RTP_VERSION
+
+# seq, timestamp, SSRC of the fixed header, patched in place at offset 2
+RTP_FORWARD_FIELDS = struct.Struct('!HII')
+
+'''
+    One outgoing stream of a selective forwarding unit.
+
+    Packets of whichever incoming source is currently selected are rewritten
+    in place to carry this stream's SSRC and a continuous sequence number and
+    timestamp space, then sent to every subscribed transport.  Payload,
+    CSRC list and header extensions are left untouched and nothing is
+    re-serialized: the same buffer goes to all subscribers.
+
+    When the selected source changes (simulcast layer switch, active
+    speaker change, ...) the offsets are recomputed on its first packet so
+    the outgoing sequence number continues at last + 1 and the timestamp at
+    last + ts_step.  Gaps within one source are kept, receivers still see
+    upstream loss.
+'''
+class ForwardStream:
+    __slots__ = ('ssrc','ts_step','mark_switch','source_ssrc','seq_offset','ts_offset',
+                 'last_seq','last_ts','_rebase','_targets','packets_sent','octets_sent')
+
+    def __init__(self,ssrc,ts_step=0,mark_switch=False):
+        self.ssrc = ssrc
+        self.ts_step = ts_step          # timestamp gap across a switch, learned if 0
+        self.mark_switch = mark_switch  # set the marker bit on the first packet after a switch
+        self.source_ssrc = None         # incoming SSRC being forwarded
+        self.seq_offset = 0
+        self.ts_offset = 0
+        self.last_seq = None            # last outgoing seq
+        self.last_ts = None             # last outgoing timestamp
+        self._rebase = True
+        self._targets = []              # (transport.send, addr)
+        self.packets_sent = 0
+        self.octets_sent = 0
+
+    '''
+        Forward under the SSRC of a local RtpStream, continuing its sequence
+        number and timestamp, to the stream's transport.
+    '''
+    @staticmethod
+    def from_stream(stream,mark_switch=False):
+        ts_step = 0
+        if stream.profile is not None:
+            ts_step = stream.profile.samples_per_frame * stream.frames_per_packet
+        fs = ForwardStream(stream.ssrc,ts_step,mark_switch)
+        if stream.packets_sent:
+            fs.last_seq = (stream.header.seq - 1) & 0xFFFF
+            fs.last_ts = (stream.header.timestamp - max(ts_step,1)) & 0xFFFFFFFF
+        if stream.transport is not None:
+            fs.subscribe(stream.transport)
+        return fs
+
+    '''
+        Send the rewritten packets to transport, addr is passed to
+        transport.send() when given (one socket, many peers).
+    '''
+    def subscribe(self,transport,addr=None):
+        self._targets.append((transport.send,addr))
+
+    def unsubscribe(self,transport,addr=None):
+        self._targets = [ t for t in self._targets if t != (transport.send,addr) ]
+
+    @property
+    def subscribers(self):
+        return len(self._targets)
+
+    '''
+        Force the offsets to be recomputed on the next packet, e.g. when
+        the application selects another source with the same SSRC.
+    '''
+    def switch(self):
+        self._rebase = True
+
+    '''
+        Patch SSRC, seq, timestamp (and marker) of the RTP packet at
+        buf[offset:] in place.  buf must be writable.
+
+        Input:
+            marker: None keeps the marker bit, otherwise it is set to 0/1
+        Output:
+            return: (seq, timestamp) written
+    '''
+    def rewrite(self,buf,offset=0,marker=None):
+        b1,b2 = buf[offset],buf[offset + 1]
+        if (b1 >> 6) != RTP_VERSION:
+            raise ValueError('RTP version must be 2')
+        seq,ts,ssrc = RTP_FORWARD_FIELDS.unpack_from(buf,offset + 2)
+        if ssrc != self.source_ssrc or self._rebase:
+            self._switch_to(ssrc,seq,ts)
+            if self.mark_switch and self.last_seq is not None:
+                marker = 1
+            self._rebase = False
+        out_seq = (seq + self.seq_offset) & 0xFFFF
+        out_ts = (ts + self.ts_offset) & 0xFFFFFFFF
+        if self.last_ts is not None and not self.ts_step:
+            step = (out_ts - self.last_ts) & 0xFFFFFFFF
+            if 0 < step < 0x80000000:
+                self.ts_step = step
+        RTP_FORWARD_FIELDS.pack_into(buf,offset + 2,out_seq,out_ts,self.ssrc)
+        if marker is not None:
+            buf[offset + 1] = (b2 & 0x7F) | ((marker & 0x1) << 7)
+        self.last_seq = out_seq
+        self.last_ts = out_ts
+        return out_seq,out_ts
+
+    def _switch_to(self,ssrc,seq,ts):
+        self.source_ssrc = ssrc
+        if self.last_seq is None:
+            # first source: keep its numbering
+            self.seq_offset = 0
+            self.ts_offset = 0
+            return
+        self.seq_offset = (self.last_seq + 1 - seq) & 0xFFFF
+        self.ts_offset = (self.last_ts + max(self.ts_step,1) - ts) & 0xFFFFFFFF
+
+    '''
+        Rewrite the packet buf[:length] and send it to every subscriber.
+        Return the number of subscribers it was sent to.
+
+        The transports get a memoryview over buf, they must send or copy it
+        before buf is reused (AsyncioTransport and BatchTransport do).
+    '''
+    def forward(self,buf,length,marker=None):
+        if length < RTP_HEADER_SIZE:
+            raise ValueError('RTP packet too short')
+        self.rewrite(buf,0,marker)
+        view = memoryview(buf)[:length]
+        for send,addr in self._targets:
+            if addr is None:
+                send(view)
+            else:
+                send(view,addr)
+        self.packets_sent += 1
+        self.octets_sent += length
+        return len(self._targets)
+
+'''
+    Fan-out of one incoming packet to many outgoing streams.
+
+    Subscribers sharing the same outgoing SSRC should share one ForwardStream:
+    the packet is rewritten once for them.  Streams with their own SSRC or
+    numbering are rewritten one after the other in the same buffer, each
+    from the original header, which is restored in between.
+'''
+class Forwarder:
+    def __init__(self):
+        self.streams = []
+        self.received = 0
+        self.errors = 0
+
+    def add(self,stream):
+        self.streams.append(stream)
+        return stream
+
+    def remove(self,stream):
+        self.streams.remove(stream)
+
+    '''
+        Forward the packet buf[:length] (writable, e.g. a receive ring slot)
+        to every stream.  Return the number of packets sent.  A stream
+        failing with ValueError is skipped, the packet counted once in errors.
+    '''
+    def forward(self,buf,length):
+        self.received += 1
+        sent = 0
+        failed = False
+        # marker byte, seq, timestamp and SSRC as received
+        original = bytes(buf[1:RTP_HEADER_SIZE]) if len(self.streams) > 1 else None
+        for i,stream in enumerate(self.streams):
+            if i:
+                buf[1:RTP_HEADER_SIZE] = original
+            try:
+                sent += stream.forward(buf,length)
+            except ValueError:
+                failed = True
+        if failed:
+            self.errors += 1
+        return sent
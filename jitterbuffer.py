@@ -0,0 +1,205 @@
+from array import array
+
+from rtp import RTP_SEQ_MOD, Source
+
+'''
+    Playout delay = JITTER_FACTOR * interarrival jitter, within
+    [min_delay, max_delay] seconds.
+'''
+JITTER_FACTOR = 4.0
+MIN_DELAY = 0.02
+MAX_DELAY = 0.5
+
+'''
+    Adaptive jitter buffer of one source.
+
+    Packets are put() as they arrive, in any order, and get() returns the
+    frames due for playout at a given time.  Packets are reordered by
+    extended sequence number and played at
+
+        rtp timestamp / clock_rate + smallest seen transit + target delay
+
+    target delay follows the interarrival jitter measured by the Source.
+    Packets arriving after their turn are dropped (late), missing packets
+    are replaced by Profile.zeroFrame() silence (concealed).
+
+    Payloads are copied into a ring of `capacity` preallocated slots of
+    `max_payload` bytes, the ring is never resized.  With a BufferPool the
+    slots are borrowed from it (max_payload is then the pool's buffer size)
+    and given back by close().
+'''
+class JitterBuffer:
+    def __init__(self,profile,source=None,capacity=64,max_payload=1500,min_delay=MIN_DELAY,max_delay=MAX_DELAY,pool=None):
+        self.profile = profile
+        self.source = source if source is not None else Source()
+        self.capacity = capacity
+        self.pool = pool
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.target_delay = min_delay
+
+        if pool is not None:
+            self.max_payload = pool.size
+            self._buffers = [ pool.acquire() for _ in range(capacity) ]
+            self._slots = [ memoryview(buf) for buf in self._buffers ]
+        else:
+            self.max_payload = max_payload
+            data = memoryview(bytearray(capacity * max_payload))
+            self._buffers = None
+            self._slots = [ data[i * max_payload:(i + 1) * max_payload] for i in range(capacity) ]
+        self._seq = array('q',[-1] * capacity)      # extended seq held by slot, -1 if empty
+        self._ts = array('q',[0] * capacity)        # unwrapped timestamp of slot
+        self._len = array('l',[0] * capacity)
+
+        self.next_seq = None        # extended seq of the next packet to play
+        self.next_ts = 0            # unwrapped timestamp expected for next_seq
+        self.ts_step = 0            # timestamp increment between packets
+        self.base_ts = None         # first timestamp seen, unwrapping origin
+        self.last_ts = 0            # unwrapped timestamp of newest packet
+        self.offset = None          # smallest arrival - timestamp seen, seconds
+
+        self.depth = 0              # packets waiting in the buffer
+        self.received = 0
+        self.played = 0
+        self.late = 0
+        self.duplicate = 0
+        self.overflow = 0
+        self.concealed = 0
+
+    def _unwrap(self,ts):
+        if self.base_ts is None:
+            self.base_ts = ts
+            return 0
+        d = (ts - self.base_ts - self.last_ts) & 0xFFFFFFFF
+        if d >= 0x80000000:
+            d -= 0x100000000
+        return self.last_ts + d
+
+    def _extend(self,seq):
+        ref = self.next_seq
+        d = (seq - ref) & (RTP_SEQ_MOD - 1)
+        if d >= RTP_SEQ_MOD >> 1:
+            d -= RTP_SEQ_MOD
+        return ref + d
+
+    '''
+        Buffer one packet.
+
+        Input:
+            header: RtpHeader
+            payload: bytes-like payload, copied
+            arrival: arrival time in seconds
+        Output:
+            return: False if the packet was dropped
+    '''
+    def put(self,header,payload,arrival):
+        clock_rate = self.profile.clock_rate
+        self.received += 1
+        source = self.source
+        if self.next_seq is None and source.received == 0 and source.probation == 0:
+            source.init_source(header.seq)
+        if not source.receive(header.seq,header.timestamp,int(arrival * clock_rate)) and source.probation == 0:
+            # bad sequence jump; packets of a source on probation are kept,
+            # RFC 3550 only delays counting it as valid
+            return False
+        jitter = JITTER_FACTOR * source.jitter / clock_rate
+        self.target_delay = min(max(jitter,self.min_delay),self.max_delay)
+
+        ts = self._unwrap(header.timestamp)
+        if self.next_seq is None:
+            self.next_seq = header.seq
+            self.next_ts = ts
+        ext = self._extend(header.seq)
+        if ext < self.next_seq:
+            self.late += 1
+            return False
+        if ext > self.next_seq and ts > self.next_ts:
+            self.ts_step = (ts - self.next_ts) // (ext - self.next_seq)
+        if ts > self.last_ts:
+            self.last_ts = ts
+
+        offset = arrival - float(ts) / clock_rate
+        if self.offset is None or offset < self.offset:
+            self.offset = offset
+
+        if ext >= self.next_seq + self.capacity:
+            # too far ahead, give up the oldest packets to make room
+            while self.next_seq <= ext - self.capacity:
+                self._discard(self.next_seq % self.capacity)
+                self.next_seq += 1
+                self.overflow += 1
+            self.next_ts = ts - (ext - self.next_seq) * self.ts_step
+
+        n = len(payload)
+        if n > self.max_payload:
+            raise ValueError('payload larger than jitter buffer slot')
+        slot = ext % self.capacity
+        if self._seq[slot] == ext:
+            self.duplicate += 1
+            return False
+        self._slots[slot][:n] = payload
+        self._seq[slot] = ext
+        self._ts[slot] = ts
+        self._len[slot] = n
+        self.depth += 1
+        return True
+
+    def _discard(self,slot):
+        if self._seq[slot] >= 0:
+            self._seq[slot] = -1
+            self.depth -= 1
+
+    def playout_time(self,ts):
+        return float(ts) / self.profile.clock_rate + self.offset + self.target_delay
+
+    '''
+        Frames due for playout at `now` (seconds), in order, as bytes owned
+        by the caller.  A packet missing at its playout time is concealed
+        with silence.
+    '''
+    def get(self,now):
+        frames = []
+        if self.next_seq is None:
+            return frames
+        profile = self.profile
+        while True:
+            slot = self.next_seq % self.capacity
+            present = self._seq[slot] == self.next_seq
+            ts = self._ts[slot] if present else self.next_ts
+            if self.playout_time(ts) > now:
+                break
+            if present:
+                # the slot is reused by the next put(), hand out copies
+                frames.extend( bytes(frame) for frame in profile.unpack(self._slots[slot][:self._len[slot]]) )
+                self._discard(slot)
+                self.played += 1
+            elif self.depth == 0:
+                # nothing buffered: stream paused, not lost
+                break
+            else:
+                frames.extend(self._silence())
+                self.concealed += 1
+            self.next_seq += 1
+            self.next_ts = ts + self.ts_step
+        return frames
+
+    '''
+        Give borrowed slots back to the pool, the buffer is unusable after.
+    '''
+    def close(self):
+        if self._buffers is not None:
+            for view in self._slots:
+                view.release()
+            for buf in self._buffers:
+                self.pool.release(buf)
+            self._buffers = None
+        self._slots = []
+
+    def _silence(self):
+        profile = self.profile
+        if self.ts_step and profile.samples_per_frame:
+            count = max(self.ts_step // profile.samples_per_frame,1)
+        else:
+            count = profile.frames_per_packet_hint
+        # zeroFrame() is the profile's own bytearray, hand out immutable copies
+        return [bytes(profile.zeroFrame())] * count
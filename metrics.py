@@ -0,0 +1,237 @@
+import sys
+import threading
+from array import array
+from collections import Counter
+
+'''
+    Runtime counters, latency histograms and a sampling profiler, exported
+    in Prometheus text format.
+
+    Instrumented objects (AsyncioTransport, BatchTransport, RtpStream,
+    SourceRegistry, RtcpScheduler) have a `metrics` attribute, None by
+    default: the hot paths then only test it and do nothing else.  Set it to
+    a SessionMetrics to start counting, back to None to stop:
+
+        registry = MetricsRegistry()
+        transport.metrics = stream.metrics = registry.session('call-1')
+        ...
+        text = registry.export()
+'''
+class METRIC:
+    PACKETS_IN          = 0
+    BYTES_IN            = 1
+    PACKETS_OUT         = 2
+    BYTES_OUT           = 3
+    PARSE_ERRORS        = 4
+    SEQ_REJECTED        = 5     # bad sequence jump, or out of sequence while on probation
+    PROBATION_RESETS    = 6     # out of sequence packet while on probation
+    RTCP_SENT           = 7
+    RTCP_RECEIVED       = 8
+    RTCP_TIMERS         = 9     # RtcpScheduler timers fired
+    DROPPED             = 10
+    COUNT               = 11
+
+METRIC_NAMES = (
+    ('packets_in_total','RTP packets received'),
+    ('bytes_in_total','RTP bytes received'),
+    ('packets_out_total','RTP packets sent'),
+    ('bytes_out_total','RTP bytes sent'),
+    ('parse_errors_total','Packets which did not parse as RTP'),
+    ('seq_rejected_total','Packets rejected by the sequence number check'),
+    ('probation_resets_total','Sources put back on probation'),
+    ('rtcp_sent_total','RTCP compound packets sent'),
+    ('rtcp_received_total','RTCP compound packets received'),
+    ('rtcp_timers_total','RTCP transmission timers fired'),
+    ('dropped_total','Packets dropped by a full queue or paused transport'),
+)
+
+class HISTOGRAM:
+    PARSE       = 0             # RtpHeader.parse_into of a received packet
+    PACK        = 1             # header + payload serialization of a sent packet
+    CALLBACK    = 2             # application callback of a received packet
+    COUNT       = 3
+
+HISTOGRAM_NAMES = (
+    ('parse_seconds','Time spent parsing received RTP packets'),
+    ('pack_seconds','Time spent serializing sent RTP packets'),
+    ('callback_seconds','Time spent in receive callbacks'),
+)
+
+# bucket i holds durations below HISTOGRAM_FIRST_BUCKET << i ns, the last one everything above
+HISTOGRAM_FIRST_BUCKET = 256    # 1 << 8, observe() shifts by 8
+HISTOGRAM_BUCKETS = 16          # 256 ns .. 8.4 ms, then +Inf
+
+PROMETHEUS_PREFIX = 'pyrtp_'
+
+'''
+    Counters and histograms of one session, in arrays allocated once.
+    Durations are perf_counter_ns() differences.
+'''
+class SessionMetrics:
+    def __init__(self):
+        self.counters = array('Q',[0] * METRIC.COUNT)
+        self.buckets = array('Q',[0] * (HISTOGRAM.COUNT * (HISTOGRAM_BUCKETS + 1)))
+        self.sums = array('Q',[0] * HISTOGRAM.COUNT)        # ns
+        # indexes used by received(), bound once rather than looked up per packet
+        self._packets_in = METRIC.PACKETS_IN
+        self._bytes_in = METRIC.BYTES_IN
+        self._parse = HISTOGRAM.PARSE
+        self._parse_buckets = HISTOGRAM.PARSE * (HISTOGRAM_BUCKETS + 1)
+
+    def count(self,metric,n=1):
+        self.counters[metric] += n
+
+    def observe(self,histogram,ns):
+        bucket = (ns >> 8).bit_length()
+        if bucket > HISTOGRAM_BUCKETS:
+            bucket = HISTOGRAM_BUCKETS
+        self.buckets[histogram * (HISTOGRAM_BUCKETS + 1) + bucket] += 1
+        self.sums[histogram] += ns
+
+    '''One packet received and parsed in ns nanoseconds, observe() inlined'''
+    def received(self,length,ns):
+        counters = self.counters
+        counters[self._packets_in] += 1
+        counters[self._bytes_in] += length
+        bucket = (ns >> 8).bit_length()
+        self.buckets[self._parse_buckets + (bucket if bucket < HISTOGRAM_BUCKETS else HISTOGRAM_BUCKETS)] += 1
+        self.sums[self._parse] += ns
+
+    def sent(self,length):
+        counters = self.counters
+        counters[METRIC.PACKETS_OUT] += 1
+        counters[METRIC.BYTES_OUT] += length
+
+    def __getitem__(self,metric):
+        return self.counters[metric]
+
+    '''Observations of a histogram: (bucket counts, sum in ns)'''
+    def histogram(self,histogram):
+        start = histogram * (HISTOGRAM_BUCKETS + 1)
+        return list(self.buckets[start:start + HISTOGRAM_BUCKETS + 1]),self.sums[histogram]
+
+    def reset(self):
+        for a in (self.counters,self.buckets,self.sums):
+            for i in range(len(a)):
+                a[i] = 0
+
+'''
+    Sampling profiler: a background thread looks at the stack of the
+    profiled thread (the one calling start() by default) every `interval`
+    seconds and counts the innermost function.  It can be started and
+    stopped at any time, nothing is hooked into the profiled code.
+'''
+class SamplingProfiler:
+    def __init__(self,interval=0.005,depth=1):
+        self.interval = interval
+        self.depth = depth              # innermost frames in a sample key
+        self.samples = Counter()        # 'file:function;...' -> samples
+        self.total = 0
+        self._thread = None
+        self._target = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self,thread_id=None):
+        if self._thread is not None:
+            return
+        self._target = thread_id if thread_id is not None else threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,name='pyrtp-profiler',daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def clear(self):
+        self.samples.clear()
+        self.total = 0
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None and len(names) < self.depth:
+                code = frame.f_code
+                names.append('%s:%s' % (code.co_filename.rsplit('/',1)[-1],code.co_name))
+                frame = frame.f_back
+            self.samples[';'.join(names)] += 1
+            self.total += 1
+
+    '''The n most sampled keys with their share of the samples'''
+    def top(self,n=20):
+        total = self.total or 1
+        return [ (key,count,count / total) for key,count in self.samples.most_common(n) ]
+
+'''
+    Named SessionMetrics, plus an optional SamplingProfiler, exported
+    together.
+'''
+class MetricsRegistry:
+    def __init__(self,prefix=PROMETHEUS_PREFIX):
+        self.prefix = prefix
+        self.sessions = {}              # name -> SessionMetrics
+        self.profiler = None
+
+    '''The SessionMetrics of name, created on first use'''
+    def session(self,name):
+        metrics = self.sessions.get(name)
+        if metrics is None:
+            metrics = self.sessions[name] = SessionMetrics()
+        return metrics
+
+    def remove(self,name):
+        self.sessions.pop(name,None)
+
+    def enable_profiler(self,interval=0.005,depth=1,thread_id=None):
+        if self.profiler is None:
+            self.profiler = SamplingProfiler(interval,depth)
+        self.profiler.start(thread_id)
+        return self.profiler
+
+    def disable_profiler(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+
+    '''Prometheus text exposition format (version 0.0.4)'''
+    def export(self):
+        prefix = self.prefix
+        lines = []
+        sessions = sorted(self.sessions.items(),key=lambda item: str(item[0]))
+        for metric,(name,help) in enumerate(METRIC_NAMES):
+            lines.append('# HELP %s%s %s' % (prefix,name,help))
+            lines.append('# TYPE %s%s counter' % (prefix,name))
+            for session,metrics in sessions:
+                lines.append('%s%s{session="%s"} %d' % (prefix,name,_escape(session),metrics.counters[metric]))
+        bounds = [ '%g' % ((HISTOGRAM_FIRST_BUCKET << i) * 1e-9) for i in range(HISTOGRAM_BUCKETS) ] + ['+Inf']
+        for histogram,(name,help) in enumerate(HISTOGRAM_NAMES):
+            lines.append('# HELP %s%s %s' % (prefix,name,help))
+            lines.append('# TYPE %s%s histogram' % (prefix,name))
+            for session,metrics in sessions:
+                label = _escape(session)
+                buckets,total = metrics.histogram(histogram)
+                cumulative = 0
+                for le,count in zip(bounds,buckets):
+                    cumulative += count
+                    lines.append('%s%s_bucket{session="%s",le="%s"} %d' % (prefix,name,label,le,cumulative))
+                lines.append('%s%s_sum{session="%s"} %.9f' % (prefix,name,label,total * 1e-9))
+                lines.append('%s%s_count{session="%s"} %d' % (prefix,name,label,cumulative))
+        profiler = self.profiler
+        if profiler is not None:
+            lines.append('# HELP %sprofile_samples_total Sampling profiler samples by innermost functions' % prefix)
+            lines.append('# TYPE %sprofile_samples_total counter' % prefix)
+            for key,count in sorted(profiler.samples.items()):
+                lines.append('%sprofile_samples_total{function="%s"} %d' % (prefix,_escape(key),count))
+        return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
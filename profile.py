@@ -39,7 +39,7 @@ class Profile:
 
     def zeroFrame(self):
         if self.zero_pattern is None:
-            self.zero_pattern = bytearray(bytes_per_frame)
+            self.zero_pattern = bytearray(self.bytes_per_frame)
         return self.zero_pattern
 
     '''
@@ -52,6 +52,19 @@ class Profile:
     def pack(self,frames):
         raise NotImplementedError()
 
+    '''
+        Write the payload of frames into buf at offset, return its size.
+        Profiles able to encode in place should override this, the
+        default copies the result of pack().
+    '''
+    def pack_into(self,frames,buf,offset):
+        data = self.pack(frames)
+        n = len(data)
+        if offset + n > len(buf):
+            raise ValueError('payload does not fit in packet buffer')
+        buf[offset:offset + n] = data
+        return n
+
     '''
     Input:
         packet: payload (not include rtp header) bytes or bytearray
@@ -61,3 +74,42 @@ class Profile:
     def unpack(self,packet):
         raise NotImplementedError()
 
+
+'''
+    Linear PCM (L16 when bits_per_sampe is 16), frames are raw sample
+    bytes of samples_per_frame samples each.
+'''
+class PcmProfile(Profile):
+    def __init__(self,clock_rate=8000,samples_per_frame=160,bits_per_sampe=16,channels=1):
+        Profile.__init__(self)
+        self.mime_type = 'pcm'
+        self.clock_rate = clock_rate
+        self.samples_per_frame = samples_per_frame
+        self.bits_per_sampe = bits_per_sampe
+        self.channels = channels
+
+    '''a frame holds the samples of every channel, as unpack() cuts them'''
+    def zeroFrame(self):
+        if self.zero_pattern is None:
+            self.zero_pattern = bytearray(self.bytes_per_frame * self.channels)
+        return self.zero_pattern
+
+    def pack(self,frames):
+        return b''.join(frames)
+
+    def pack_into(self,frames,buf,offset):
+        pos = offset
+        for frame in frames:
+            n = len(frame)
+            if pos + n > len(buf):
+                raise ValueError('payload does not fit in packet buffer')
+            buf[pos:pos + n] = frame
+            pos += n
+        return pos - offset
+
+    '''frames are memoryviews over packet when it is a memoryview'''
+    def unpack(self,packet):
+        size = self.bytes_per_frame * self.channels
+        if size == 0 or len(packet) % size:
+            raise ValueError('PCM payload is not a whole number of frames')
+        return [ packet[i:i + size] for i in range(0,len(packet),size) ]
@@ -0,0 +1,258 @@
+import time
+from array import array
+from collections import OrderedDict, deque
+
+from rtp import RTP_HEADER_SIZE, RTP_MTU, RTP_SEQ_MOD, Source
+
+RTX_CACHE_SIZE = 512                # packets kept for retransmission
+RTX_MAX_AGE = 1.0                   # seconds a packet can be retransmitted
+
+NACK_RTT = 0.1                      # seconds before a seq is NACKed again
+NACK_MAX_MISSING = 1000             # missing seqs tracked at most
+NACK_MAX_RETRIES = 10
+NACK_MAX_AGE = 1.0                  # seconds after which a missing seq is given up
+NACK_MAX_RATE = 20.0                # NACK packets per second
+NACK_MAX_SEQS = 17 * 16             # seqs per NACK packet (16 full PID/BLP items)
+
+'''
+    Sender side cache of recently sent RTP packets, indexed by sequence
+    number, for answering generic NACKs.
+
+    Packets are copied into a ring of `capacity` preallocated slots of `mtu`
+    bytes, slot = seq % capacity, so a new packet overwrites the one sent
+    capacity packets earlier.  On top of that the oldest packets are
+    evicted when they hold more than max_bytes in total, and packets older
+    than max_age seconds are never retransmitted (a late retransmission
+    only wastes bandwidth, the receiver has played out or given up).
+'''
+class RetransmissionCache:
+    def __init__(self,capacity=RTX_CACHE_SIZE,mtu=RTP_MTU,max_bytes=None,max_age=RTX_MAX_AGE,clock=time.monotonic):
+        self.capacity = capacity
+        self.mtu = mtu
+        self.max_bytes = max_bytes if max_bytes is not None else capacity * mtu
+        self.max_age = max_age
+        self.clock = clock
+        data = memoryview(bytearray(capacity * mtu))
+        self._slots = [ data[i * mtu:(i + 1) * mtu] for i in range(capacity) ]
+        self._seq = array('l',[-1] * capacity)      # seq held by slot, -1 if empty
+        self._len = array('l',[0] * capacity)
+        self._time = array('d',[0.0] * capacity)
+        self._serial = array('q',[0] * capacity)    # put() count when the slot was filled
+        self._order = deque()                       # (slot, serial), oldest first
+        self._next_serial = 1
+
+        self.packets = 0
+        self.bytes = 0
+        self.stored = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0                            # for max_bytes
+
+    def __len__(self):
+        return self.packets
+
+    '''
+        Keep a copy of the RTP packet (before any SRTP protection).
+    '''
+    def put(self,packet,now=None):
+        n = len(packet)
+        if n < RTP_HEADER_SIZE or n > self.mtu:
+            raise ValueError('packet does not fit in retransmission cache slot')
+        if now is None:
+            now = self.clock()
+        seq = (packet[2] << 8) | packet[3]
+        slot = seq % self.capacity
+        self._drop(slot)
+        self._slots[slot][:n] = packet
+        self._seq[slot] = seq
+        self._len[slot] = n
+        self._time[slot] = now
+        self._serial[slot] = self._next_serial
+        order = self._order
+        order.append((slot,self._next_serial))
+        self._next_serial += 1
+        # entries of slots overwritten since are stale, keep the deque short
+        while self._serial[order[0][0]] != order[0][1]:
+            order.popleft()
+        if len(order) > 2 * self.capacity:
+            self._order = deque( e for e in order if self._serial[e[0]] == e[1] )
+        self.packets += 1
+        self.bytes += n
+        self.stored += 1
+        while self.bytes > self.max_bytes:
+            self._pop_oldest()
+            self.evicted += 1
+
+    '''
+        The cached packet with sequence number seq as a memoryview over the
+        cache, valid until the next put(), or None.
+    '''
+    def get(self,seq,now=None):
+        slot = seq % self.capacity
+        if self._seq[slot] != seq:
+            self.misses += 1
+            return None
+        if now is None:
+            now = self.clock()
+        if now - self._time[slot] > self.max_age:
+            self._drop(slot)
+            self.expired += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._slots[slot][:self._len[slot]]
+
+    '''Drop every packet older than max_age'''
+    def expire(self,now=None):
+        if now is None:
+            now = self.clock()
+        limit = now - self.max_age
+        order = self._order
+        while order:
+            slot,serial = order[0]
+            if self._serial[slot] == serial and self._time[slot] >= limit:
+                break
+            order.popleft()
+            if self._serial[slot] == serial:
+                self._drop(slot)
+                self.expired += 1
+
+    def _pop_oldest(self):
+        order = self._order
+        while order:
+            slot,serial = order.popleft()
+            if self._serial[slot] == serial:
+                self._drop(slot)
+                return
+
+    def _drop(self,slot):
+        if self._seq[slot] >= 0:
+            self.packets -= 1
+            self.bytes -= self._len[slot]
+            self._seq[slot] = -1
+            self._serial[slot] = 0
+
+'''
+    Receiver side generic NACK scheduling for one source.
+
+    Every packet goes through receive()/update_seq() instead of the Source
+    methods of the same name: sequence numbers skipped over when
+    Source.update_seq() advances max_seq are recorded as missing, and
+    removed when they arrive late (reordering or retransmission).
+
+    generate() returns the missing seqs due for a NACK now: a seq is
+    requested again only after rtt seconds, at most max_retries times and
+    for max_age seconds.  At most max_rate NACK packets per second are
+    produced (token bucket of one second), and tracking is bounded to
+    max_missing seqs, the oldest are given up first.
+'''
+class NackGenerator:
+    def __init__(self,source=None,rtt=NACK_RTT,max_missing=NACK_MAX_MISSING,max_retries=NACK_MAX_RETRIES,
+                 max_age=NACK_MAX_AGE,max_rate=NACK_MAX_RATE,clock=time.monotonic):
+        self.source = source if source is not None else Source()
+        self.rtt = rtt                  # update from ClockSync.smoothed_rtt()
+        self.max_missing = max_missing
+        self.max_retries = max_retries
+        self.max_age = max_age
+        self.max_rate = max_rate
+        self.clock = clock
+        self._missing = OrderedDict()   # extended seq -> [first seen, last NACK time, NACK count]
+        self._tokens = max(max_rate,1.0)
+        self._last_refill = None
+        self._started = False
+
+        self.requested = 0              # seqs put in NACKs, repeats included
+        self.nacks = 0                  # NACK packets generated
+        self.recovered = 0              # missing seqs which arrived later
+        self.given_up = 0
+
+    @property
+    def missing(self):
+        return len(self._missing)
+
+    '''
+        Same as Source.receive(), plus gap tracking
+    '''
+    def receive(self,seq,timestamp,arrival,now=None):
+        if not self.update_seq(seq,now):
+            return False
+        self.source.update_jitter(timestamp,arrival)
+        return True
+
+    '''
+        Same as Source.update_seq(), plus gap tracking
+    '''
+    def update_seq(self,seq,now=None):
+        s = self.source
+        if not self._started:
+            self._started = True
+            if s.received == 0 and s.probation == 0:
+                s.init_source(seq)
+        valid = s.probation == 0
+        before = s.cycles + s.max_seq
+        received = s.received
+        ok = s.update_seq(seq)
+        if not ok or not valid:
+            return ok
+        after = s.cycles + s.max_seq
+        if s.received <= received:
+            # init_seq() ran: the source re-synchronized (restart through
+            # bad_seq), the old numbering is meaningless whichever way it jumped
+            self.given_up += len(self._missing)
+            self._missing.clear()
+        elif after > before + 1:
+            if now is None:
+                now = self.clock()
+            first = max(before + 1,after - self.max_missing)
+            self.given_up += first - (before + 1)
+            for ext in range(first,after):
+                self._missing[ext] = [now,None,0]
+            while len(self._missing) > self.max_missing:
+                self._missing.popitem(last=False)
+                self.given_up += 1
+        elif after == before and self._missing:
+            d = (seq - s.max_seq) & (RTP_SEQ_MOD - 1)
+            if d:
+                ext = after - (RTP_SEQ_MOD - d)
+                if self._missing.pop(ext,None) is not None:
+                    self.recovered += 1
+        return ok
+
+    '''
+        Sequence numbers (16-bit, oldest first) to put in a NACK now,
+        empty when nothing is due or the rate limit is reached.
+    '''
+    def generate(self,now=None):
+        if now is None:
+            now = self.clock()
+        if not self._missing:
+            return []
+        burst = max(self.max_rate,1.0)
+        if self._last_refill is not None:
+            self._tokens = min(burst,self._tokens + (now - self._last_refill) * self.max_rate)
+        self._last_refill = now
+        if self._tokens < 1.0:
+            return []
+
+        seqs = []
+        stale = []
+        for ext,entry in self._missing.items():
+            if now - entry[0] > self.max_age or entry[2] >= self.max_retries:
+                stale.append(ext)
+                continue
+            if entry[1] is not None and now - entry[1] < self.rtt:
+                continue
+            seqs.append(ext & 0xFFFF)
+            entry[1] = now
+            entry[2] += 1
+            if len(seqs) >= NACK_MAX_SEQS:
+                break
+        for ext in stale:
+            del self._missing[ext]
+        self.given_up += len(stale)
+        if seqs:
+            self._tokens -= 1.0
+            self.nacks += 1
+            self.requested += len(seqs)
+        return seqs
@@ -1,14 +1,33 @@
+import asyncio
+import math
 import struct
 import random
+import time
+from collections import OrderedDict, deque
+
+from metrics import METRIC
+from rtp import RTP_VERSION, SourceRegistry
 
 RTP_MAX_SDES = 255
 
+# precompiled layouts, shared by every RTCP object
+RTCP_COMMON_HEADER = struct.Struct('!BBH')
+RTCP_UINT32 = struct.Struct('!I')
+RTCP_RECEIVER_ITEM = struct.Struct('!IIIIII')
+RTCP_SENDER_INFO = struct.Struct('!IIIIII')
+RTCP_SDES_ITEM_HEADER = struct.Struct('!BB')
+RTCP_FB_HEADER = struct.Struct('!II')           # sender SSRC, media source SSRC
+RTCP_NACK_ITEM = struct.Struct('!HH')           # PID, BLP
+RTCP_FIR_ITEM = struct.Struct('!IB3x')          # SSRC, command seq nr
+
 class RTCP_TYPE:
     RTCP_SR         = 200
     RTCP_RR         = 201
     RTCP_SDES       = 202
     RTCP_BYE        = 203
     RTCP_APP        = 204
+    RTCP_RTPFB      = 205           # transport layer feedback (RFC 4585)
+    RTCP_PSFB       = 206           # payload specific feedback (RFC 4585)
 
     EVENT_BYE       = 0
     EVENT_REPORT    = 1
@@ -20,6 +39,14 @@ class RTCP_TYPE:
         else:
             return RTCP_TYPE.EVENT_REPORT
 
+'''
+    Feedback message types (FMT, in the count field) of RTPFB/PSFB
+'''
+class RTCP_FB_FMT:
+    RTPFB_NACK      = 1             # generic NACK
+    PSFB_PLI        = 1             # picture loss indication
+    PSFB_FIR        = 4             # full intra request (RFC 5104)
+
 class RTCP_SDES_TYPE:
     RTCP_SDES_END   = 0
     RTCP_SDES_CNAME = 1
@@ -32,6 +59,8 @@ class RTCP_SDES_TYPE:
     RTCP_SDES_PRIV  = 8
 
 class RtcpCommonHeader:
+    __slots__ = ('field_byte_1','field_byte_2','field_uint16_3')
+
     def __init__(self):
         self.field_byte_1       = 0
         self.field_byte_2       = 0
@@ -55,26 +84,23 @@ class RtcpCommonHeader:
     '''
     @staticmethod
     def validity(buf):
-        RTCP_VALID_MASK = (0xc000 | 0x2000 | 0xfe)
-        RTCP_VALID_VALUE = ((RTP_VERSION << 14) | RTCP_TYPE.RTCP_SR)
-
-        if len(buf) < 20: ##TODO 20 maybe wrong
-            return False
-
-        if (buf[0] & 0xe0) != 0xC0 or (buf[1] & 0xFE) != 200:
-            return False
-        offset = 0
-        while offset < len(buf):
-            if 2 != ((buf[offset] >> 6) & 0x3):
-                return False
-            length = int(buf[offset + 2]) << 8 | buf[offset + 3]
-            offset += length
-        if offset != len(buf)
+        try:
+            parse_compound(buf)
+        except ValueError:
             return False
         return True
 
+    def size(self):
+        return RTCP_COMMON_HEADER.size
+
     def toByteArray(self):
-        return bytearray(struct.pack('!BBH',self.field_byte_1,self.field_byte_2,self.field_uint16_3))
+        buf = bytearray(RTCP_COMMON_HEADER.size)
+        self.pack_into(buf,0)
+        return buf
+
+    def pack_into(self,buf,offset=0):
+        RTCP_COMMON_HEADER.pack_into(buf,offset,self.field_byte_1,self.field_byte_2,self.field_uint16_3)
+        return RTCP_COMMON_HEADER.size
 
     '''protocol version'''
     @property
@@ -119,6 +145,8 @@ class RtcpCommonHeader:
 
 
 class RtcpReceiverItem:
+    __slots__ = ('field_uint32_1','field_uint32_2','field_uint32_3','field_uint32_4','field_uint32_5','field_uint32_6')
+
     def __init__(self):
         self.field_uint32_1         = 0
         self.field_uint32_2         = 0
@@ -127,8 +155,17 @@ class RtcpReceiverItem:
         self.field_uint32_5         = 0
         self.field_uint32_6         = 0
 
+    def size(self):
+        return RTCP_RECEIVER_ITEM.size
+
     def toByteArray(self):
-        return bytearray(struct.pack('!IIIIII',self.field_uint32_1,self.field_uint32_2,self.field_uint32_3,self.field_uint32_4,self.field_uint32_5,self.field_uint32_6))
+        buf = bytearray(RTCP_RECEIVER_ITEM.size)
+        self.pack_into(buf,0)
+        return buf
+
+    def pack_into(self,buf,offset=0):
+        RTCP_RECEIVER_ITEM.pack_into(buf,offset,self.field_uint32_1,self.field_uint32_2,self.field_uint32_3,self.field_uint32_4,self.field_uint32_5,self.field_uint32_6)
+        return RTCP_RECEIVER_ITEM.size
     
     '''data source being reported'''
     @property
@@ -144,20 +181,20 @@ class RtcpReceiverItem:
         return ((self.field_uint32_2 >> 24) & 0xFF)
     @fraction.setter
     def fraction(self,f):
-        self.field_uint32_2 = (self.field_uint32_2 & 0x0FFFFFFF) | ( (f & 0xFF) << 24 )
+        self.field_uint32_2 = (self.field_uint32_2 & 0x00FFFFFF) | ( (f & 0xFF) << 24 )
     
     '''cumul. no. pkts lost (signed!)'''
     @property
     def lost(self):
         v = (self.field_uint32_2 & 0x00FFFFFF)
-        if v & 0x800000 == 1:   # negative
-            v = ~((v & 0x7FFFFF) - 1)
-            v = -v
+        if v & 0x800000:        # negative, 24-bit two's complement
+            v -= 0x1000000
         return v
 
-    @lost.setter(self,v):
-        if v < 0:
-            v = (((~(v & 0x7FFFFF)) + 1) & 0x7FFFFF) | 0x800000
+    @lost.setter
+    def lost(self,v):
+        # clamp to the 24-bit signed range
+        v = max(min(v,0x7FFFFF),-0x800000)
         self.field_uint32_2 = (self.field_uint32_2 & 0xFF000000) | (v & 0x00FFFFFF)
 
     '''extended last seq. no. received'''
@@ -165,7 +202,7 @@ class RtcpReceiverItem:
     def last_seq(self):
         return self.field_uint32_3 & 0xFFFFFFFF
     @last_seq.setter
-    @def last_seq(self,v):
+    def last_seq(self,v):
         self.field_uint32_3 = (v & 0xFFFFFFFF)
 
     '''interarrival jitter'''
@@ -173,7 +210,7 @@ class RtcpReceiverItem:
     def jitter(self):
         return self.field_uint32_4 & 0xFFFFFFFF
     @jitter.setter
-    @def jitter(self,v):
+    def jitter(self,v):
         self.field_uint32_4 = (v & 0xFFFFFFFF)
 
     '''last SR packet from this source'''
@@ -181,7 +218,7 @@ class RtcpReceiverItem:
     def lsr(self):
         return self.field_uint32_5 & 0xFFFFFFFF
     @lsr.setter
-    @def lsr(self,v):
+    def lsr(self,v):
         self.field_uint32_5 = (v & 0xFFFFFFFF)
 
     '''delay since last SR packet'''
@@ -189,30 +226,42 @@ class RtcpReceiverItem:
     def dlsr(self):
         return self.field_uint32_6 & 0xFFFFFFFF
     @dlsr.setter
-    @def dlsr(self,v):
+    def dlsr(self,v):
         self.field_uint32_6 = (v & 0xFFFFFFFF)
 
 
 
 
 class RtcpReceiverReport:
+    __slots__ = ('field_uint32_1','field_list_2')
+
     def __init__(self):
         self.field_uint32_1     = 0
         self.field_list_2       = []
 
+    def size(self):
+        return RTCP_UINT32.size + RTCP_RECEIVER_ITEM.size * len(self.field_list_2)
+
     def toByteArray(self):
-        buf = bytearray(struct.pack('!I',self.field_uint32_1))
+        buf = bytearray(self.size())
+        self.pack_into(buf,0)
+        return buf
+
+    def pack_into(self,buf,offset=0):
+        RTCP_UINT32.pack_into(buf,offset,self.field_uint32_1)
+        pos = offset + RTCP_UINT32.size
         for r in self.field_list_2:
             if not isinstance(r,RtcpReceiverItem):
                 raise TypeError('RtcpReceiverReport reports list item MUST be RtcpReceiverItem')
-            buf.append(r.toByteArray())
-        return buf
+            pos += r.pack_into(buf,pos)
+        return pos - offset
 
     '''receiver generating this report'''
     @property
     def ssrc(self):
         return (self.field_uint32_1 & 0xFFFFFFFF)
-    @ssrc.setter(self,v):
+    @ssrc.setter
+    def ssrc(self,v):
         self.field_uint32_1 = (v & 0xFFFFFFFF)
 
     '''list of RtcpReceiverItem'''
@@ -224,6 +273,8 @@ class RtcpReceiverReport:
         self.field_list_2 = l
 
 class RtcpSenderReport:
+    __slots__ = ('field_uint32_1','field_uint32_2','field_uint32_3','field_uint32_4','field_uint32_5','field_uint32_6','field_list_7')
+
     def __init__(self):
         self.field_uint32_1     = 0
         self.field_uint32_2     = 0
@@ -233,13 +284,22 @@ class RtcpSenderReport:
         self.field_uint32_6     = 0
         self.field_list_7       = []
 
+    def size(self):
+        return RTCP_SENDER_INFO.size + RTCP_RECEIVER_ITEM.size * len(self.field_list_7)
+
     def toByteArray(self):
-        buf = bytearray(struct.pack('!IIIIII',self.field_uint32_1,self.field_uint32_2,self.field_uint32_3,self.field_uint32_4,self.field_uint32_5,self.field_uint32_6))
+        buf = bytearray(self.size())
+        self.pack_into(buf,0)
+        return buf
+
+    def pack_into(self,buf,offset=0):
+        RTCP_SENDER_INFO.pack_into(buf,offset,self.field_uint32_1,self.field_uint32_2,self.field_uint32_3,self.field_uint32_4,self.field_uint32_5,self.field_uint32_6)
+        pos = offset + RTCP_SENDER_INFO.size
         for r in self.field_list_7:
             if not isinstance(r,RtcpReceiverItem):
                 raise TypeError('RtcpSenderReport rr list item MUST be RtcpReceiverItem')
-            buf.append(r.toByteArray())
-        return buf
+            pos += r.pack_into(buf,pos)
+        return pos - offset
 
     '''sender generating this report'''
     @property
@@ -298,16 +358,30 @@ class RtcpSenderReport:
         self.field_list_7 = l
 
 class RtcpSdesItem:
+    __slots__ = ('field_uint8_1','field_uint8_2','field_bytes_3')
+
     def __init__(self):
         self.field_uint8_1      = 0
         self.field_uint8_2      = 0
         self.field_bytes_3      = None
 
+    def size(self):
+        return RTCP_SDES_ITEM_HEADER.size + self.field_uint8_2
+
     def toByteArray(self):
-        buf = bytearray(struct.pack('!BB',self.field_uint8_1,self.field_uint8_2))
-        if self.field_bytes_3 is not None:
-            buf.append(self.field_bytes_3)
+        buf = bytearray(self.size())
+        self.pack_into(buf,0)
         return buf
+
+    def pack_into(self,buf,offset=0):
+        RTCP_SDES_ITEM_HEADER.pack_into(buf,offset,self.field_uint8_1,self.field_uint8_2)
+        pos = offset + RTCP_SDES_ITEM_HEADER.size
+        n = self.field_uint8_2
+        if n > 0:
+            if pos + n > len(buf):
+                raise ValueError('buffer too small for SDES item')
+            buf[pos:pos + n] = self.field_bytes_3
+        return RTCP_SDES_ITEM_HEADER.size + n
     @property
     def sdes_type(self):
         return self.field_uint8_1
@@ -321,7 +395,7 @@ class RtcpSdesItem:
 
     '''text,not null-terminated'''
     @property
-    @def data(self):
+    def data(self):
         if self.field_bytes_3 is None:
             return ''
         else:
@@ -332,7 +406,7 @@ class RtcpSdesItem:
             self.field_bytes_3 = None
             self.field_uint8_2 = 0
         elif isinstance(s,str):
-            self.field_bytes_3 = bytes(s)
+            self.field_bytes_3 = s.encode('utf-8')
             if len(self.field_bytes_3) > RTP_MAX_SDES:
                 self.field_bytes_3 = self.field_bytes_3[:RTP_MAX_SDES]
             self.field_uint8_2 = len(self.field_bytes_3)
@@ -342,23 +416,40 @@ class RtcpSdesItem:
                 self.field_bytes_3 = self.field_bytes_3[:RTP_MAX_SDES]
             self.field_uint8_2 = len(self.field_bytes_3)
 
+RTCP_SDES_PADDING = [ bytes(n) for n in range(5) ]
+
 class RtcpSdes:
+    __slots__ = ('field_uint32_1','field_list_2')
+
     def __init__(self):
         self.field_uint32_1         = 0
         self.field_list_2           = []
 
+    def size(self):
+        n = RTCP_UINT32.size
+        for v in self.field_list_2:
+            n += v.size()
+        # at least one end marker, then pad to next 4-octet boundary
+        return n + 4 - (n & 0x3)
+
     def toByteArray(self):
-        buf = bytearray(struct.pack('!I',self.field_uint32_1))
+        buf = bytearray(self.size())
+        self.pack_into(buf,0)
+        return buf
+
+    def pack_into(self,buf,offset=0):
+        RTCP_UINT32.pack_into(buf,offset,self.field_uint32_1)
+        pos = offset + RTCP_UINT32.size
         for v in self.field_list_2:
             if not isinstance(v,RtcpSdesItem):
                 raise TypeError('Sdes item MUST be RtcpSdesItem')
-            buf.append(v.toByteArray())
+            pos += v.pack_into(buf,pos)
         # terminate with end marker and pad to next 4-octet boundary
-        pad = 4 - (len(buf) & 0x3)
-        while pad > 0:
-            buf.append(RTCP_SDES_TYPE.RTCP_SDES_END)
-            pad -= 1
-        return buf
+        pad = 4 - ((pos - offset) & 0x3)
+        if pos + pad > len(buf):
+            raise ValueError('buffer too small for SDES chunk')
+        buf[pos:pos + pad] = RTCP_SDES_PADDING[pad]
+        return pos + pad - offset
 
     '''first SSRC/CSRC'''
     @property
@@ -377,31 +468,1065 @@ class RtcpSdes:
         self.field_list_2 = l
 
 class RtcpBye:
+    __slots__ = ('src',)
+
     def __init__(self):
         self.src        = []    # list of sources
 
+    def size(self):
+        return RTCP_UINT32.size * len(self.src)
+
     def toByteArray(self):
+        buf = bytearray(self.size())
+        self.pack_into(buf,0)
+        return buf
+
+    def pack_into(self,buf,offset=0):
         if len(self.src) == 0:
             raise ValueError('RtcpBye atleast contains one source')
-        buf = bytearray()
+        pos = offset
         for v in self.src:
             if not isinstance(v,int):
                 raise TypeError('src must be uint32 number')
-            buf.append(struct.pack('!I',v))
+            RTCP_UINT32.pack_into(buf,pos,v)
+            pos += RTCP_UINT32.size
+        return pos - offset
+
+'''
+    APP packet body (RFC 3550 6.7).  subtype is carried in the common
+    header count field, it is kept here so a decoded APP packet keeps it.
+'''
+class RtcpApp:
+    __slots__ = ('subtype','ssrc','name','data')
+
+    def __init__(self):
+        self.subtype    = 0
+        self.ssrc       = 0
+        self.name       = b'\0\0\0\0'   # 4 ASCII characters
+        self.data       = b''           # multiple of 4 bytes
+
+    def size(self):
+        return 8 + len(self.data)
+
+    def toByteArray(self):
+        buf = bytearray(self.size())
+        self.pack_into(buf,0)
         return buf
 
-class Rtcp:
+    def pack_into(self,buf,offset=0):
+        if len(self.name) != 4:
+            raise ValueError('RTCP APP name must be 4 bytes')
+        if len(self.data) & 0x3:
+            raise ValueError('RTCP APP data length must be multiple of 4')
+        RTCP_UINT32.pack_into(buf,offset,self.ssrc)
+        buf[offset + 4:offset + 8] = self.name
+        buf[offset + 8:offset + 8 + len(self.data)] = self.data
+        return 8 + len(self.data)
+
+'''
+    RTPFB/PSFB packet body (RFC 4585 6.1): sender and media source SSRC,
+    then the feedback control information, empty for a PLI.  fmt is
+    carried in the common header count field, see RTCP_FB_FMT.
+'''
+class RtcpFeedback:
+    __slots__ = ('fmt','ssrc','media_ssrc','fci')
+
     def __init__(self):
-        self.header =       RtcpCommonHeader()
-        self.report =       None        # sender/receiver/sdes/byte 
+        self.fmt        = 0
+        self.ssrc       = 0
+        self.media_ssrc = 0
+        self.fci        = b''           # multiple of 4 bytes
+
+    def size(self):
+        return RTCP_FB_HEADER.size + len(self.fci)
 
     def toByteArray(self):
+        buf = bytearray(self.size())
+        self.pack_into(buf,0)
+        return buf
+
+    def pack_into(self,buf,offset=0):
+        if len(self.fci) & 0x3:
+            raise ValueError('RTCP feedback FCI length must be multiple of 4')
+        RTCP_FB_HEADER.pack_into(buf,offset,self.ssrc,self.media_ssrc)
+        pos = offset + RTCP_FB_HEADER.size
+        buf[pos:pos + len(self.fci)] = self.fci
+        return RTCP_FB_HEADER.size + len(self.fci)
+
+'''
+    One RTCP packet: common header followed by a report.
+    (was named Rtcp, but that name is taken by the scheduler below)
+'''
+class RtcpPacket:
+    __slots__ = ('header','report')
+
+    def __init__(self):
+        self.header =       RtcpCommonHeader()
+        self.report =       None        # sender/receiver/sdes/bye/app/feedback
+
+    def size(self):
         if self.report is None:
             raise ValueError('Rtcp must has one report')
-        buf = self.header.toByteArray()
-        buf.append(self.report.toByteArray())
+        return self.header.size() + self.report.size()
+
+    def toByteArray(self):
+        buf = bytearray(self.size())
+        self.pack_into(buf,0)
         return buf
 
+    '''
+        Serialize header and report into buf at offset, buf must be
+        writable and large enough, see size().
+
+        Return the number of bytes written.
+    '''
+    def pack_into(self,buf,offset=0):
+        if self.report is None:
+            raise ValueError('Rtcp must has one report')
+        n = self.header.pack_into(buf,offset)
+        return n + self.report.pack_into(buf,offset + n)
+
+
+'''
+    Lazy views over a received compound RTCP packet.
+
+    parse_compound() checks the whole packet once and returns one view per
+    RTCP packet; fields are only unpacked from the buffer when read, SDES
+    text only decoded when its data is accessed.  Views reference the
+    buffer, so it must not change while they are in use.  decode() turns
+    a view into the corresponding RtcpSenderReport/RtcpReceiverReport/
+    list of RtcpSdes/RtcpBye/RtcpApp/RtcpFeedback object; packet types
+    without a view class have no decoder.
+'''
+class RtcpBlockView:
+    __slots__ = ('buf','offset','end')
+
+    def __init__(self,buf,offset,end):
+        self.buf = buf              # memoryview of the compound packet
+        self.offset = offset        # start of this packet (common header)
+        self.end = end              # end of this packet, padding excluded
+
+    @property
+    def version(self):
+        return self.buf[self.offset] >> 6
+
+    @property
+    def padding(self):
+        return (self.buf[self.offset] >> 5) & 0x1
+
+    @property
+    def count(self):
+        return self.buf[self.offset] & 0x1F
+
+    @property
+    def packet_type(self):
+        return self.buf[self.offset + 1]
+
+    @property
+    def length(self):
+        return RTCP_COMMON_HEADER.unpack_from(self.buf,self.offset)[2]
+
+    '''body of the packet, after the common header'''
+    @property
+    def body(self):
+        return self.buf[self.offset + RTCP_COMMON_HEADER.size:self.end]
+
+    def _check(self):
+        pass
+
+    def decode(self):
+        raise NotImplementedError('no decoder for RTCP packet type %d' % self.packet_type)
+
+class RtcpReceiverItemView:
+    __slots__ = ('buf','offset')
+
+    def __init__(self,buf,offset):
+        self.buf = buf
+        self.offset = offset
+
+    @property
+    def ssrc(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset)[0]
+
+    @property
+    def fraction(self):
+        return self.buf[self.offset + 4]
+
+    @property
+    def lost(self):
+        v = RTCP_UINT32.unpack_from(self.buf,self.offset + 4)[0] & 0x00FFFFFF
+        if v & 0x800000:
+            v -= 0x1000000
+        return v
+
+    @property
+    def last_seq(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset + 8)[0]
+
+    @property
+    def jitter(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset + 12)[0]
+
+    @property
+    def lsr(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset + 16)[0]
+
+    @property
+    def dlsr(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset + 20)[0]
+
+    def decode(self):
+        item = RtcpReceiverItem()
+        (item.field_uint32_1,item.field_uint32_2,item.field_uint32_3,
+         item.field_uint32_4,item.field_uint32_5,item.field_uint32_6) = RTCP_RECEIVER_ITEM.unpack_from(self.buf,self.offset)
+        return item
+
+class _ReportBlockView(RtcpBlockView):
+    __slots__ = ()
+
+    FIXED_SIZE = 0
+
+    def _check(self):
+        need = self.offset + RTCP_COMMON_HEADER.size + self.FIXED_SIZE + self.count * RTCP_RECEIVER_ITEM.size
+        if need > self.end:
+            raise ValueError('RTCP report count exceeds packet length')
+
+    @property
+    def ssrc(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset + 4)[0]
+
+    '''report blocks, as RtcpReceiverItemView'''
+    @property
+    def reports(self):
+        first = self.offset + RTCP_COMMON_HEADER.size + self.FIXED_SIZE
+        return [ RtcpReceiverItemView(self.buf,first + i * RTCP_RECEIVER_ITEM.size) for i in range(self.count) ]
+
+    def report(self,i):
+        if i >= self.count:
+            raise IndexError('report block index out of range')
+        return RtcpReceiverItemView(self.buf,self.offset + RTCP_COMMON_HEADER.size + self.FIXED_SIZE + i * RTCP_RECEIVER_ITEM.size)
+
+class RtcpSenderReportView(_ReportBlockView):
+    __slots__ = ()
+
+    FIXED_SIZE = RTCP_SENDER_INFO.size
+
+    @property
+    def ntp_sec(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset + 8)[0]
+
+    @property
+    def ntp_frac(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset + 12)[0]
+
+    @property
+    def rtp_ts(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset + 16)[0]
+
+    @property
+    def psent(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset + 20)[0]
+
+    @property
+    def osent(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset + 24)[0]
+
+    def decode(self):
+        sr = RtcpSenderReport()
+        (sr.field_uint32_1,sr.field_uint32_2,sr.field_uint32_3,
+         sr.field_uint32_4,sr.field_uint32_5,sr.field_uint32_6) = RTCP_SENDER_INFO.unpack_from(self.buf,self.offset + 4)
+        sr.rr = [ r.decode() for r in self.reports ]
+        return sr
+
+class RtcpReceiverReportView(_ReportBlockView):
+    __slots__ = ()
+
+    FIXED_SIZE = RTCP_UINT32.size
+
+    def decode(self):
+        rr = RtcpReceiverReport()
+        rr.ssrc = self.ssrc
+        rr.reports = [ r.decode() for r in self.reports ]
+        return rr
+
+class RtcpSdesItemView:
+    __slots__ = ('buf','offset')
+
+    def __init__(self,buf,offset):
+        self.buf = buf
+        self.offset = offset
+
+    @property
+    def sdes_type(self):
+        return self.buf[self.offset]
+
+    @property
+    def length(self):
+        return self.buf[self.offset + 1]
+
+    '''raw text, as memoryview'''
+    @property
+    def raw(self):
+        start = self.offset + 2
+        return self.buf[start:start + self.buf[self.offset + 1]]
+
+    @property
+    def data(self):
+        return str(self.raw,'utf-8','replace')
+
+    def decode(self):
+        item = RtcpSdesItem()
+        item.sdes_type = self.sdes_type
+        item.data = bytes(self.raw)
+        return item
+
+class RtcpSdesChunkView:
+    __slots__ = ('buf','offset','end')
+
+    def __init__(self,buf,offset,end):
+        self.buf = buf
+        self.offset = offset        # start of chunk (SSRC/CSRC)
+        self.end = end              # end of chunk, end marker and padding included
+
+    @property
+    def src(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset)[0]
+
+    @property
+    def items(self):
+        items = []
+        pos = self.offset + RTCP_UINT32.size
+        buf = self.buf
+        while buf[pos] != RTCP_SDES_TYPE.RTCP_SDES_END:
+            items.append(RtcpSdesItemView(buf,pos))
+            pos += 2 + buf[pos + 1]
+        return items
+
+    '''first item of sdes_type, None if absent'''
+    def item(self,sdes_type):
+        pos = self.offset + RTCP_UINT32.size
+        buf = self.buf
+        while buf[pos] != RTCP_SDES_TYPE.RTCP_SDES_END:
+            if buf[pos] == sdes_type:
+                return RtcpSdesItemView(buf,pos)
+            pos += 2 + buf[pos + 1]
+        return None
+
+    def decode(self):
+        sdes = RtcpSdes()
+        sdes.src = self.src
+        sdes.item = [ i.decode() for i in self.items ]
+        return sdes
+
+class RtcpSdesView(RtcpBlockView):
+    __slots__ = ()
+
+    '''
+        Chunk boundaries are found by walking item lengths, only the
+        item headers are read.
+    '''
+    @property
+    def chunks(self):
+        chunks = []
+        buf = self.buf
+        pos = self.offset + RTCP_COMMON_HEADER.size
+        for _ in range(self.count):
+            start = pos
+            pos += RTCP_UINT32.size
+            while True:
+                if pos >= self.end:
+                    raise ValueError('RTCP SDES chunk exceeds packet length')
+                if buf[pos] == RTCP_SDES_TYPE.RTCP_SDES_END:
+                    break
+                if pos + 2 > self.end:
+                    raise ValueError('RTCP SDES item exceeds packet length')
+                pos += 2 + buf[pos + 1]
+            # end marker, then pad to the next 32-bit boundary
+            pos += 1
+            pos += -(pos - self.offset) & 0x3
+            if pos > self.end:
+                raise ValueError('RTCP SDES chunk exceeds packet length')
+            chunks.append(RtcpSdesChunkView(buf,start,pos))
+        return chunks
+
+    def decode(self):
+        return [ c.decode() for c in self.chunks ]
+
+class RtcpByeView(RtcpBlockView):
+    __slots__ = ()
+
+    def _check(self):
+        if self.offset + RTCP_COMMON_HEADER.size + self.count * RTCP_UINT32.size > self.end:
+            raise ValueError('RTCP BYE count exceeds packet length')
+
+    @property
+    def sources(self):
+        first = self.offset + RTCP_COMMON_HEADER.size
+        return [ RTCP_UINT32.unpack_from(self.buf,first + i * RTCP_UINT32.size)[0] for i in range(self.count) ]
+
+    '''reason for leaving, None if absent'''
+    @property
+    def reason(self):
+        pos = self.offset + RTCP_COMMON_HEADER.size + self.count * RTCP_UINT32.size
+        if pos >= self.end:
+            return None
+        n = self.buf[pos]
+        if pos + 1 + n > self.end:
+            raise ValueError('RTCP BYE reason exceeds packet length')
+        return str(self.buf[pos + 1:pos + 1 + n],'utf-8','replace')
+
+    def decode(self):
+        bye = RtcpBye()
+        bye.src = self.sources
+        return bye
+
+class RtcpAppView(RtcpBlockView):
+    __slots__ = ()
+
+    def _check(self):
+        if self.offset + 12 > self.end:
+            raise ValueError('RTCP APP packet too short')
+
+    @property
+    def subtype(self):
+        return self.count
+
+    @property
+    def ssrc(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset + 4)[0]
+
+    @property
+    def name(self):
+        return bytes(self.buf[self.offset + 8:self.offset + 12])
+
+    @property
+    def data(self):
+        return self.buf[self.offset + 12:self.end]
+
+    def decode(self):
+        app = RtcpApp()
+        app.subtype = self.subtype
+        app.ssrc = self.ssrc
+        app.name = self.name
+        app.data = bytes(self.data)
+        return app
+
+'''
+    Common part of RTPFB and PSFB packets: fmt, sender SSRC, media SSRC
+    and the feedback control information (FCI) after them.
+'''
+class _FeedbackView(RtcpBlockView):
+    __slots__ = ()
+
+    def _check(self):
+        if self.offset + RTCP_COMMON_HEADER.size + RTCP_FB_HEADER.size > self.end:
+            raise ValueError('RTCP feedback packet too short')
+
+    @property
+    def fmt(self):
+        return self.count
+
+    @property
+    def ssrc(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset + 4)[0]
+
+    @property
+    def media_ssrc(self):
+        return RTCP_UINT32.unpack_from(self.buf,self.offset + 8)[0]
+
+    @property
+    def fci(self):
+        return self.buf[self.offset + RTCP_COMMON_HEADER.size + RTCP_FB_HEADER.size:self.end]
+
+    '''RtcpFeedback of any FMT (NACK, PLI, FIR, ...), the FCI left raw'''
+    def decode(self):
+        fb = RtcpFeedback()
+        fb.fmt = self.fmt
+        fb.ssrc,fb.media_ssrc = RTCP_FB_HEADER.unpack_from(self.buf,self.offset + RTCP_COMMON_HEADER.size)
+        fb.fci = bytes(self.fci)
+        return fb
+
+class RtcpRtpFeedbackView(_FeedbackView):
+    __slots__ = ()
+
+    @property
+    def is_nack(self):
+        return self.fmt == RTCP_FB_FMT.RTPFB_NACK
+
+    '''(PID, BLP) pairs of a generic NACK'''
+    @property
+    def nacks(self):
+        fci = self.fci
+        return [ RTCP_NACK_ITEM.unpack_from(fci,i) for i in range(0,len(fci) - RTCP_NACK_ITEM.size + 1,RTCP_NACK_ITEM.size) ]
+
+    '''sequence numbers requested by a generic NACK, in packet order'''
+    @property
+    def lost_seqs(self):
+        seqs = []
+        for pid,blp in self.nacks:
+            seqs.extend(nack_seqs(pid,blp))
+        return seqs
+
+class RtcpPayloadFeedbackView(_FeedbackView):
+    __slots__ = ()
+
+    @property
+    def is_pli(self):
+        return self.fmt == RTCP_FB_FMT.PSFB_PLI
+
+    @property
+    def is_fir(self):
+        return self.fmt == RTCP_FB_FMT.PSFB_FIR
+
+    '''(SSRC, command seq nr) entries of a FIR'''
+    @property
+    def fir_entries(self):
+        fci = self.fci
+        return [ RTCP_FIR_ITEM.unpack_from(fci,i) for i in range(0,len(fci) - RTCP_FIR_ITEM.size + 1,RTCP_FIR_ITEM.size) ]
+
+RTCP_MAX_NACK_BITMAP = 16
+
+'''
+    Sequence numbers of one generic NACK item: pid and every bit i of the
+    bitmask blp meaning pid + i + 1
+'''
+def nack_seqs(pid,blp):
+    seqs = [pid]
+    i = 0
+    while blp:
+        if blp & 1:
+            seqs.append((pid + i + 1) & 0xFFFF)
+        blp >>= 1
+        i += 1
+    return seqs
+
+'''
+    Pack sequence numbers into as few (PID, BLP) generic NACK items as
+    possible.  seqs are taken in the given order (oldest first), across
+    a wrap 65535 -> 0 as well.
+'''
+def nack_items(seqs):
+    items = []
+    pid = None
+    blp = 0
+    for seq in seqs:
+        seq &= 0xFFFF
+        if pid is not None:
+            d = (seq - pid) & 0xFFFF
+            if 0 < d <= RTCP_MAX_NACK_BITMAP:
+                blp |= 1 << (d - 1)
+                continue
+            if d == 0:
+                continue
+            items.append((pid,blp))
+        pid = seq
+        blp = 0
+    if pid is not None:
+        items.append((pid,blp))
+    return items
+
+RTCP_BLOCK_VIEWS = {
+    RTCP_TYPE.RTCP_SR:      RtcpSenderReportView,
+    RTCP_TYPE.RTCP_RR:      RtcpReceiverReportView,
+    RTCP_TYPE.RTCP_SDES:    RtcpSdesView,
+    RTCP_TYPE.RTCP_BYE:     RtcpByeView,
+    RTCP_TYPE.RTCP_APP:     RtcpAppView,
+    RTCP_TYPE.RTCP_RTPFB:   RtcpRtpFeedbackView,
+    RTCP_TYPE.RTCP_PSFB:    RtcpPayloadFeedbackView,
+}
+
+'''
+    Validate a compound RTCP packet (see RtcpCommonHeader.validity) and
+    return a list of lazy views, one per RTCP packet.  Packet types
+    without a view class in RTCP_BLOCK_VIEWS get a plain RtcpBlockView.
+
+    Raise ValueError if the packet is not valid.
+'''
+def parse_compound(buf):
+    view = buf if isinstance(buf,memoryview) else memoryview(buf)
+    total = len(view)
+    if total < RTCP_COMMON_HEADER.size:
+        raise ValueError('RTCP packet too short')
+    b0 = view[0]
+    if (b0 >> 6) != RTP_VERSION or (b0 & 0x20) or view[1] not in (RTCP_TYPE.RTCP_SR,RTCP_TYPE.RTCP_RR):
+        raise ValueError('RTCP compound packet must start with SR or RR without padding')
+
+    blocks = []
+    offset = 0
+    while offset < total:
+        if offset + RTCP_COMMON_HEADER.size > total:
+            raise ValueError('RTCP packet truncated')
+        b0,pt,length = RTCP_COMMON_HEADER.unpack_from(view,offset)
+        if (b0 >> 6) != RTP_VERSION:
+            raise ValueError('RTCP version must be 2')
+        end = offset + ((length + 1) << 2)
+        if end > total:
+            raise ValueError('RTCP length fields exceed packet')
+        block_end = end
+        if b0 & 0x20:
+            if end != total:
+                raise ValueError('RTCP padding only allowed on last packet')
+            pad = view[end - 1]
+            if pad == 0 or pad > (length << 2):
+                raise ValueError('RTCP padding length invalid')
+            block_end -= pad
+        block = RTCP_BLOCK_VIEWS.get(pt,RtcpBlockView)(view,offset,block_end)
+        block._check()
+        blocks.append(block)
+        offset = end
+    return blocks
+
+
+RTCP_MAX_PACKET = 1500
+RTCP_MAX_REPORTS = 31               # report blocks per SR/RR (5-bit count)
+
+'''
+    Build compound RTCP packets (RFC 3550 6.1):
+
+        SR or RR, [RR ...], SDES CNAME, [BYE], [APP]
+
+    straight into one preallocated buffer.  Header count and length are
+    filled in as packets are written, more than 31 report blocks are split
+    over additional RR packets, and padding is only applied to the last
+    packet.  build() returns a memoryview over the internal buffer, valid
+    until the next build().  With a BufferPool the buffer is borrowed from
+    it (size is then the pool's) and given back by close().
+'''
+class CompoundRtcpBuilder:
+    def __init__(self,ssrc,cname,size=RTCP_MAX_PACKET,pool=None):
+        self.ssrc = ssrc
+        if isinstance(cname,str):
+            cname = cname.encode('utf-8')
+        self.cname = cname[:RTP_MAX_SDES]
+        self.pool = pool
+        self.buf = pool.acquire() if pool is not None else bytearray(size)
+        self.view = memoryview(self.buf)
+        self._sdes_start = 0
+
+    def close(self):
+        if self.pool is not None and self.buf is not None:
+            self.view.release()
+            self.pool.release(self.buf)
+            self.buf = self.view = None
+
+    '''
+    Input:
+        reports: list of RtcpReceiverItem, any number
+        sender: RtcpSenderReport whose sender info is sent (its rr list is
+                ignored), None to send a RR
+        bye: list of SSRC leaving, None for no BYE
+        reason: reason for leaving, with bye
+        app: (subtype, name 4 bytes, data) for an APP packet, or None
+        nack: {media SSRC: lost sequence numbers} for generic NACKs
+        pli: media SSRCs to send a PLI for
+        fir: (media SSRC, command seq nr) entries for one FIR
+        pad_to: pad the compound packet to a multiple of pad_to bytes
+    Output:
+        return: memoryview of the compound packet
+    '''
+    def build(self,reports=(),sender=None,bye=None,reason=None,app=None,pad_to=0,nack=None,pli=None,fir=None):
+        pos = self.write_report(0,reports,sender)
+        pos = self.write_sdes(pos)
+        last = None
+        if nack:
+            for media,seqs in nack.items():
+                last = pos
+                pos = self.write_nack(pos,media,seqs)
+        if pli:
+            for media in pli:
+                last = pos
+                pos = self.write_pli(pos,media)
+        if fir:
+            last = pos
+            pos = self.write_fir(pos,fir)
+        if bye is not None:
+            last = pos
+            pos = self.write_bye(pos,bye,reason)
+        if app is not None:
+            last = pos
+            pos = self.write_app(pos,*app)
+        if pad_to > 1 and pos % pad_to:
+            if last is None:
+                # the SDES packet is the last one
+                last = self._sdes_start
+            pos = self._pad(last,pos,pad_to - pos % pad_to)
+        return self.view[:pos]
+
+    def _ensure(self,end):
+        if end > len(self.buf):
+            raise ValueError('compound RTCP packet exceeds builder buffer')
+
+    def _header(self,start,end,count,packet_type):
+        RTCP_COMMON_HEADER.pack_into(self.buf,start,(RTP_VERSION << 6) | count,packet_type,((end - start) >> 2) - 1)
+
+    '''
+        SR (or RR) with the first 31 report blocks, followed by as many
+        RR packets as needed for the rest.  Return the end offset.
+    '''
+    def write_report(self,pos,reports,sender=None):
+        buf = self.buf
+        reports = list(reports)
+        first = True
+        while first or reports:
+            chunk = reports[:RTCP_MAX_REPORTS]
+            reports = reports[RTCP_MAX_REPORTS:]
+            start = pos
+            if first and sender is not None:
+                end = start + RTCP_COMMON_HEADER.size + RTCP_SENDER_INFO.size + len(chunk) * RTCP_RECEIVER_ITEM.size
+                self._ensure(end)
+                RTCP_SENDER_INFO.pack_into(buf,start + RTCP_COMMON_HEADER.size,self.ssrc,sender.ntp_sec,sender.ntp_frac,sender.rtp_ts,sender.psent,sender.osent)
+                pos = start + RTCP_COMMON_HEADER.size + RTCP_SENDER_INFO.size
+                packet_type = RTCP_TYPE.RTCP_SR
+            else:
+                end = start + RTCP_COMMON_HEADER.size + RTCP_UINT32.size + len(chunk) * RTCP_RECEIVER_ITEM.size
+                self._ensure(end)
+                RTCP_UINT32.pack_into(buf,start + RTCP_COMMON_HEADER.size,self.ssrc)
+                pos = start + RTCP_COMMON_HEADER.size + RTCP_UINT32.size
+                packet_type = RTCP_TYPE.RTCP_RR
+            for r in chunk:
+                pos += r.pack_into(buf,pos)
+            self._header(start,pos,len(chunk),packet_type)
+            first = False
+        return pos
+
+    '''SDES packet with a CNAME chunk for our SSRC'''
+    def write_sdes(self,pos):
+        start = pos
+        self._sdes_start = start
+        n = len(self.cname)
+        chunk = RTCP_UINT32.size + RTCP_SDES_ITEM_HEADER.size + n
+        end = start + RTCP_COMMON_HEADER.size + chunk + 4 - (chunk & 0x3)
+        self._ensure(end)
+        buf = self.buf
+        pos = start + RTCP_COMMON_HEADER.size
+        RTCP_UINT32.pack_into(buf,pos,self.ssrc)
+        RTCP_SDES_ITEM_HEADER.pack_into(buf,pos + 4,RTCP_SDES_TYPE.RTCP_SDES_CNAME,n)
+        pos += 6
+        buf[pos:pos + n] = self.cname
+        pos += n
+        # end marker and padding to the next 32-bit boundary
+        buf[pos:end] = RTCP_SDES_PADDING[end - pos]
+        self._header(start,end,1,RTCP_TYPE.RTCP_SDES)
+        return end
+
+    def write_bye(self,pos,sources,reason=None):
+        start = pos
+        if len(sources) > RTCP_MAX_REPORTS:
+            raise ValueError('RTCP BYE carries at most 31 sources')
+        if isinstance(reason,str):
+            reason = reason.encode('utf-8')
+        body = len(sources) * RTCP_UINT32.size
+        if reason:
+            reason = reason[:255]
+            body += 1 + len(reason)
+            body += -body & 0x3
+        end = start + RTCP_COMMON_HEADER.size + body
+        self._ensure(end)
+        buf = self.buf
+        pos = start + RTCP_COMMON_HEADER.size
+        for src in sources:
+            RTCP_UINT32.pack_into(buf,pos,src)
+            pos += RTCP_UINT32.size
+        if reason:
+            buf[pos] = len(reason)
+            buf[pos + 1:pos + 1 + len(reason)] = reason
+            pos += 1 + len(reason)
+            buf[pos:end] = bytes(end - pos)
+        self._header(start,end,len(sources),RTCP_TYPE.RTCP_BYE)
+        return end
+
+    def write_app(self,pos,subtype,name,data=b''):
+        start = pos
+        if len(name) != 4:
+            raise ValueError('RTCP APP name must be 4 bytes')
+        if len(data) & 0x3:
+            raise ValueError('RTCP APP data length must be multiple of 4')
+        end = start + RTCP_COMMON_HEADER.size + 8 + len(data)
+        self._ensure(end)
+        buf = self.buf
+        RTCP_UINT32.pack_into(buf,start + 4,self.ssrc)
+        buf[start + 8:start + 12] = name
+        buf[start + 12:end] = data
+        self._header(start,end,subtype & 0x1F,RTCP_TYPE.RTCP_APP)
+        return end
+
+    def _feedback(self,pos,packet_type,fmt,media,fci_size):
+        end = pos + RTCP_COMMON_HEADER.size + RTCP_FB_HEADER.size + fci_size
+        self._ensure(end)
+        RTCP_FB_HEADER.pack_into(self.buf,pos + RTCP_COMMON_HEADER.size,self.ssrc,media)
+        self._header(pos,end,fmt,packet_type)
+        return pos + RTCP_COMMON_HEADER.size + RTCP_FB_HEADER.size,end
+
+    '''Generic NACK for seqs of media, see nack_items()'''
+    def write_nack(self,pos,media,seqs):
+        items = nack_items(seqs)
+        if not items:
+            raise ValueError('RTCP NACK needs at least one sequence number')
+        pos,end = self._feedback(pos,RTCP_TYPE.RTCP_RTPFB,RTCP_FB_FMT.RTPFB_NACK,media,len(items) * RTCP_NACK_ITEM.size)
+        for pid,blp in items:
+            RTCP_NACK_ITEM.pack_into(self.buf,pos,pid,blp)
+            pos += RTCP_NACK_ITEM.size
+        return end
+
+    def write_pli(self,pos,media):
+        return self._feedback(pos,RTCP_TYPE.RTCP_PSFB,RTCP_FB_FMT.PSFB_PLI,media,0)[1]
+
+    '''FIR for entries (SSRC, seq nr), the media SSRC field is 0 (RFC 5104)'''
+    def write_fir(self,pos,entries):
+        pos,end = self._feedback(pos,RTCP_TYPE.RTCP_PSFB,RTCP_FB_FMT.PSFB_FIR,0,len(entries) * RTCP_FIR_ITEM.size)
+        for ssrc,seq in entries:
+            RTCP_FIR_ITEM.pack_into(self.buf,pos,ssrc,seq & 0xFF)
+            pos += RTCP_FIR_ITEM.size
+        return end
+
+    '''
+        Pad the packet at [start,end) by n bytes and set its P bit,
+        only valid for the last packet of the compound.
+    '''
+    def _pad(self,start,end,n):
+        if n & 0x3:
+            raise ValueError('RTCP padding must be multiple of 4')
+        self._ensure(end + n)
+        buf = self.buf
+        buf[end:end + n - 1] = bytes(n - 1)
+        buf[end + n - 1] = n
+        b0,pt,length = RTCP_COMMON_HEADER.unpack_from(buf,start)
+        RTCP_COMMON_HEADER.pack_into(buf,start,b0 | 0x20,pt,length + (n >> 2))
+        return end + n
+
+
+'''
+    Middle 32 bits of a 64-bit NTP timestamp, as carried in LSR
+'''
+def ntp_middle32(ntp_sec,ntp_frac):
+    return ((ntp_sec & 0xFFFF) << 16) | (ntp_frac >> 16)
+
+'''
+    Build receiver report blocks from the senders of a SourceRegistry.
+
+    One RtcpReceiverItem is kept per source and refreshed in place.  Only
+    sources which received packets since their last report are reported,
+    least recently reported first, so with more than max_reports of them
+    the report blocks go round-robin over the following intervals.  LSR
+    and DLSR come from the last SR seen of each source, see
+    on_sender_report().
+'''
+class ReportGenerator:
+    def __init__(self,sources,clock=time.monotonic):
+        self.sources = sources              # SourceRegistry
+        self.clock = clock
+        self._items = {}                    # ssrc -> RtcpReceiverItem
+        self._reported = {}                 # ssrc -> Source.received at last report
+        self._order = OrderedDict()         # ssrc, least recently reported first
+        self._sr = {}                       # ssrc -> (lsr, arrival time)
+
+    '''
+        Record the arrival of a SR (RtcpSenderReport or its view),
+        arrival defaults to clock().
+    '''
+    def on_sender_report(self,sr,arrival=None):
+        if arrival is None:
+            arrival = self.clock()
+        self._sr[sr.ssrc] = (ntp_middle32(sr.ntp_sec,sr.ntp_frac),arrival)
+
+    '''last report block generated about ssrc, None if never reported'''
+    def last_report(self,ssrc):
+        return self._items.get(ssrc)
+
+    def forget(self,ssrc):
+        self._items.pop(ssrc,None)
+        self._reported.pop(ssrc,None)
+        self._order.pop(ssrc,None)
+        self._sr.pop(ssrc,None)
+
+    '''
+        Report blocks for the next RR/SR, at most max_reports of them.
+    '''
+    def generate(self,now=None,max_reports=RTCP_MAX_REPORTS):
+        if now is None:
+            now = self.clock()
+        senders = self.sources.senders
+        order = self._order
+        # never reported sources go first, in order of appearance
+        new = [ ssrc for ssrc in senders if ssrc not in order ]
+        for ssrc in reversed(new):
+            order[ssrc] = True
+            order.move_to_end(ssrc,last=False)
+
+        picked = []
+        stale = []
+        for ssrc in order:
+            m = senders.get(ssrc)
+            if m is None:
+                if ssrc not in self.sources:
+                    stale.append(ssrc)
+                continue
+            if m.source.received != self._reported.get(ssrc):
+                picked.append(m)
+                if len(picked) >= max_reports:
+                    break
+        for ssrc in stale:
+            self.forget(ssrc)
+
+        items = []
+        for m in picked:
+            items.append(self._refresh(m.ssrc,m.source,now))
+            order.move_to_end(m.ssrc)
+        return items
+
+    def _refresh(self,ssrc,source,now):
+        item = self._items.get(ssrc)
+        if item is None:
+            item = self._items[ssrc] = RtcpReceiverItem()
+            item.ssrc = ssrc
+        item.fraction = source.lost_fraction()
+        item.lost = source.lost()
+        item.last_seq = source.cycles + source.max_seq
+        item.jitter = int(source.jitter)
+        sr = self._sr.get(ssrc)
+        if sr is None:
+            item.lsr = 0
+            item.dlsr = 0
+        else:
+            item.lsr = sr[0]
+            # delay in units of 1/65536 seconds
+            item.dlsr = int((now - sr[1]) * 65536)
+        self._reported[ssrc] = source.received
+        return item
+
+
+NTP_EPOCH_OFFSET = 2208988800       # seconds from 1900-01-01 to 1970-01-01
+CLOCK_SYNC_WINDOW = 8               # SRs kept per source for the fit
+RTT_SMOOTHING = 1.0 / 8.0
+
+'''
+    time.time() like value as NTP (seconds, fraction)
+'''
+def ntp_from_unix(t):
+    t += NTP_EPOCH_OFFSET
+    sec = int(t)
+    return sec & 0xFFFFFFFF,int((t - sec) * 4294967296.0) & 0xFFFFFFFF
+
+class _SenderClock:
+    __slots__ = ('window','last_raw','last_rtp','mean_ntp','mean_rtp','rate')
+
+    def __init__(self,window):
+        self.window = deque(maxlen=window)  # (ntp seconds, unwrapped rtp)
+        self.last_raw = 0                   # last SR rtp timestamp, 32 bits
+        self.last_rtp = 0                   # same, unwrapped
+        self.mean_ntp = 0.0
+        self.mean_rtp = 0.0
+        self.rate = 0.0                     # rtp units per second
+
+    def unwrap(self,ts):
+        d = (ts - self.last_raw) & 0xFFFFFFFF
+        if d >= 0x80000000:
+            d -= 0x100000000
+        return self.last_rtp + d
+
+'''
+    Per-SSRC clock mapping and round-trip time, from RTCP.
+
+    Every SR feeds a sliding window of (NTP, RTP timestamp) pairs of its
+    source, and a least squares line is fitted through it once, on
+    arrival; rtp_to_ntp()/ntp_to_rtp() then only evaluate the line.  With
+    a single SR the nominal clock_rate is used as slope.
+
+    RR blocks about our own SSRC give the round trip time to their
+    reporter (RFC 3550 6.4.1), kept raw and smoothed.
+'''
+class ClockSync:
+    def __init__(self,own_ssrc=None,clock_rate=None,window=CLOCK_SYNC_WINDOW,clock=time.time):
+        self.own_ssrc = own_ssrc
+        self.clock_rate = clock_rate
+        self.window = window
+        self.clock = clock
+        self._senders = {}          # ssrc -> _SenderClock
+        self._rtt = {}              # reporter ssrc -> [last rtt, smoothed rtt]
+
+    def on_sender_report(self,sr):
+        c = self._senders.get(sr.ssrc)
+        if c is None:
+            c = self._senders[sr.ssrc] = _SenderClock(self.window)
+            c.last_raw = sr.rtp_ts
+            c.last_rtp = sr.rtp_ts
+        rtp_ts = c.unwrap(sr.rtp_ts)
+        c.last_raw = sr.rtp_ts
+        c.last_rtp = rtp_ts
+        c.window.append((sr.ntp_sec + sr.ntp_frac / 4294967296.0,rtp_ts))
+
+        n = len(c.window)
+        mean_ntp = sum(p[0] for p in c.window) / n
+        mean_rtp = sum(p[1] for p in c.window) / n
+        sxx = sum((p[0] - mean_ntp) ** 2 for p in c.window)
+        if sxx > 0:
+            c.rate = sum((p[0] - mean_ntp) * (p[1] - mean_rtp) for p in c.window) / sxx
+        elif self.clock_rate:
+            c.rate = float(self.clock_rate)
+        c.mean_ntp = mean_ntp
+        c.mean_rtp = mean_rtp
+
+    '''
+        Account the report blocks of a RR/SR (objects or views) sent by
+        reporter; blocks about own_ssrc with a LSR give the RTT.
+    '''
+    def on_receiver_report(self,reporter,reports,arrival=None):
+        if arrival is None:
+            arrival = self.clock()
+        a = ntp_middle32(*ntp_from_unix(arrival))
+        for item in reports:
+            if item.ssrc != self.own_ssrc:
+                continue
+            lsr = item.lsr
+            if lsr == 0:
+                continue
+            rtt = ((a - lsr - item.dlsr) & 0xFFFFFFFF) / 65536.0
+            if rtt > 3600:
+                # negative: clocks or report inconsistent
+                continue
+            r = self._rtt.get(reporter)
+            if r is None:
+                self._rtt[reporter] = [rtt,rtt]
+            else:
+                r[0] = rtt
+                r[1] += RTT_SMOOTHING * (rtt - r[1])
+
+    '''last round trip time to reporter in seconds, None if unknown'''
+    def rtt(self,reporter):
+        r = self._rtt.get(reporter)
+        return None if r is None else r[0]
+
+    def smoothed_rtt(self,reporter):
+        r = self._rtt.get(reporter)
+        return None if r is None else r[1]
+
+    def synchronized(self,ssrc):
+        c = self._senders.get(ssrc)
+        return c is not None and c.rate > 0
+
+    '''NTP time (seconds, float) of a RTP timestamp of ssrc'''
+    def rtp_to_ntp(self,ssrc,rtp_ts):
+        c = self._senders[ssrc]
+        if c.rate <= 0:
+            raise ValueError('no clock rate known for SSRC %d' % ssrc)
+        return c.mean_ntp + (c.unwrap(rtp_ts) - c.mean_rtp) / c.rate
+
+    '''RTP timestamp (32 bits) of ssrc at NTP time ntp (seconds, float)'''
+    def ntp_to_rtp(self,ssrc,ntp):
+        c = self._senders[ssrc]
+        if c.rate <= 0:
+            raise ValueError('no clock rate known for SSRC %d' % ssrc)
+        return int(round(c.mean_rtp + (ntp - c.mean_ntp) * c.rate)) & 0xFFFFFFFF
+
+    '''estimated RTP clock rate of ssrc, measured from its SRs'''
+    def rate(self,ssrc):
+        c = self._senders.get(ssrc)
+        return None if c is None else c.rate
+
+    def forget(self,ssrc):
+        self._senders.pop(ssrc,None)
+        self._rtt.pop(ssrc,None)
+
 
 '''
     Minimum average time between RTCP packets from this site (in
@@ -432,9 +1557,126 @@ COMPENSATION = 2.71828 - 1.5
 
 SESSION_BANDWIDTH = 20.0      # kilobits/second
 
+'''
+    Kind of a received packet, for Rtcp.onReceive()
+'''
+PACKET_RTP = 0
+PACKET_RTCP_REPORT = 1
+PACKET_BYE = 2
+
+def PacketType(packet):
+    return packet.kind
+
+def ReceivedPacketSize(packet):
+    return packet.size
+
+RTCP_HEADER_SIZE_BYE = 28 + 8   # IP/UDP + BYE with one SSRC
+
+SCHEDULER_RESOLUTION = 0.05   # seconds per timer wheel slot
+SCHEDULER_SLOTS = 1024        # one wheel turn ~51 seconds
+
+'''
+    One timer wheel driving the RTCP transmission timers (Rtcp.onExpire)
+    of any number of sessions, instead of one OS timer per session.
+
+    A session has at most one pending timer: schedule() replaces it, and
+    both schedule() and cancel() are O(1), so reverse reconsideration on
+    BYE costs nothing extra.  Timers are kept in `slots` buckets of
+    `resolution` seconds; a timer further than one wheel turn away waits
+    in its bucket for the right turn.  Timers never fire early, at most
+    one resolution late.
+
+    Time comes from `clock` (time.monotonic by default), inject another
+    one for deterministic tests.  Drive it by calling tick(now) from any
+    loop, or run() it as an asyncio task.
+'''
+class RtcpScheduler:
+    def __init__(self,clock=time.monotonic,resolution=SCHEDULER_RESOLUTION,slots=SCHEDULER_SLOTS):
+        self.clock = clock
+        self.resolution = resolution
+        self._slots = [ {} for _ in range(slots) ]
+        self._where = {}                        # session -> slot index
+        self._tick = int(clock() / resolution)  # last tick processed
+        self._running = False
+        self.fired = 0
+        self.metrics = None                     # metrics.SessionMetrics counting timers fired
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self,session):
+        return session in self._where
+
+    '''Arm (or move) the timer of session to fire at tn with event e'''
+    def schedule(self,session,tn,e):
+        tick = max(int(math.ceil(tn / self.resolution)),self._tick + 1)
+        index = tick % len(self._slots)
+        old = self._where.get(session)
+        if old is not None:
+            del self._slots[old][session]
+        self._slots[index][session] = (tick,e)
+        self._where[session] = index
+
+    def cancel(self,session):
+        index = self._where.pop(session,None)
+        if index is not None:
+            del self._slots[index][session]
+
+    '''
+        Fire every timer due at `now` (default clock()), return how many
+        fired.  Each session gets tc = now, then onExpire(e).
+    '''
+    def tick(self,now=None):
+        if now is None:
+            now = self.clock()
+        target = int(now / self.resolution)
+        steps = min(target - self._tick,len(self._slots))
+        due = []
+        n = len(self._slots)
+        for i in range(1,steps + 1):
+            slot = self._slots[(self._tick + i) % n]
+            if not slot:
+                continue
+            expired = [ (session,entry) for session,entry in slot.items() if entry[0] <= target ]
+            for session,entry in expired:
+                del slot[session]
+                del self._where[session]
+                due.append((entry[0],session,entry[1]))
+        if target > self._tick:
+            self._tick = target
+        due.sort(key=lambda d: d[0])
+        for _,session,e in due:
+            session.tc = now
+            session.onExpire(e)
+        self.fired += len(due)
+        if due and self.metrics is not None:
+            self.metrics.count(METRIC.RTCP_TIMERS,len(due))
+        return len(due)
+
+    async def run(self):
+        self._running = True
+        while self._running:
+            self.tick()
+            await asyncio.sleep(self.resolution)
+
+    def stop(self):
+        self._running = False
+
+'''
+    RTCP transmission timer rules of RFC 3550 6.3 for one session.
+
+    scheduler: RtcpScheduler running the timer, None to drive onExpire()
+               yourself (Schedule() then only records tn)
+    send_report(e): called to send a report, returns its size in bytes
+    send_bye(e): called to send the BYE packet
+'''
 class Rtcp:
-    def __init__(self,bandwidth):
-        self.we_ssrc = random.randint(1,0xFFFFFFFF)
+    def __init__(self,bandwidth,scheduler=None,send_report=None,send_bye=None,clock=time.monotonic,ssrc=None):
+        self.scheduler = scheduler
+        self.send_report = send_report
+        self.send_bye = send_bye
+        self.clock = scheduler.clock if scheduler is not None else clock
+        self.we_ssrc = ssrc if ssrc is not None else random.randint(1,0xFFFFFFFF)
         self.initial = True
         self.we_sent = False
         self.bandwidth = bandwidth
@@ -452,13 +1694,19 @@ class Rtcp:
         self.pmembers = 1               # the estimated number of session members at the time tn was last recomputed
         self.members = 1                # the most current estimate for the number of session members
         self.senders = 0                # the most current estimate for the number of senders in the session
-        self.member_list = set([self.we_ssrc])
-        self.sender_list = set()
+        self.sources = SourceRegistry(self.we_ssrc)
+        self.last_sent_size = 0
+        self.event = None               # event of the pending timer
 
-        self.Schedule(RTCP_TYPE.RTCP_RR)
+        # times are absolute clock() values rather than relative to start
+        self.tc = self.tp = self.clock()
+        self.Schedule(self.tc + self.rtcp_interval(),RTCP_TYPE.RTCP_RR)
 
-    # TODO: need update. this is for multicast algorithm. eChat is unicast.
-    def rtcp_interval(self):
+    '''
+        Deterministic interval Td of RFC 3550 6.3.1, before randomization.
+        It is also the unit of the member and sender timeouts (6.3.5).
+    '''
+    def deterministic_interval(self):
         rtcp_min_time = RTCP_MIN_TIME
 
         '''
@@ -499,6 +1747,10 @@ class Rtcp:
         t = self.avg_rtcp_size * n / rtcp_bw
         if t < rtcp_min_time:
             t = rtcp_min_time
+        return t
+
+    def rtcp_interval(self):
+        t = self.deterministic_interval()
 
         '''
             To avoid traffic bursts from unintended synchronization with
@@ -540,14 +1792,22 @@ class Rtcp:
                 self.Schedule(tn,e)
             self.pmembers = self.member_count
 
-    def onReceive(self,packet,e):
+    def onReceive(self,packet,e=None):
         '''
             What we do depends on whether we have left the group, and are
             waiting to send a BYE (TypeOfEvent(e) == EVENT_BYE) or an RTCP
-            report.  packet represents the packet that was just received.
+            report.  packet represents the packet that was just received,
+            it has ssrc, kind (PACKET_RTP, PACKET_RTCP_REPORT or
+            PACKET_BYE) and size, plus seq for RTP.
         '''
+        self.tc = self.clock()
+        if e is None:
+            e = self.event
         if PacketType(packet) == PACKET_RTCP_REPORT:
-            if self.NewMember(packet) and RTCP_TYPE.TypeOfEvent(e) == RTCP_TYPE.EVENT_REPORT:
+            if not self.NewMember(packet):
+                # keeps the member from timing out (RFC 3550 6.3.5)
+                self.TouchMember(packet)
+            elif RTCP_TYPE.TypeOfEvent(e) == RTCP_TYPE.EVENT_REPORT:
                 self.AddMember(packet)
                 self.members += 1
             self.avg_rtcp_size = (1.0/16.0) * ReceivedPacketSize(packet) + (15.0/16.0) * self.avg_rtcp_size
@@ -555,7 +1815,9 @@ class Rtcp:
             if self.NewMember(packet) and RTCP_TYPE.TypeOfEvent(e) == RTCP_TYPE.EVENT_REPORT:
                 self.AddMember(packet)
                 self.members += 1
-            if self.NewSender(packet) and RTCP_TYPE.TypeOfEvent(e) == RTCP_TYPE.EVENT_REPORT:
+            if not self.NewSender(packet):
+                self.TouchSender(packet)
+            elif RTCP_TYPE.TypeOfEvent(e) == RTCP_TYPE.EVENT_REPORT:
                 self.AddSender(packet)
                 self.senders += 1
         elif PacketType(packet) == PACKET_BYE:
@@ -572,37 +1834,86 @@ class Rtcp:
                     self.Reschedule(tn,e)
                     self.pmembers = self.member_count
             elif RTCP_TYPE.TypeOfEvent(e) == RTCP_TYPE.EVENT_BYE:
-                self.member_count += 1
+                self.members += 1
+
+    '''
+        Leave the session: schedule a BYE with BYE reconsideration
+        (RFC 3550 6.3.7), members then counts the BYEs received.
+    '''
+    def leave(self,bye_size=RTCP_HEADER_SIZE_BYE):
+        self.tc = self.clock()
+        self.tp = self.tc
+        self.members = 1
+        self.pmembers = 1
+        self.senders = 0
+        self.initial = True
+        self.we_sent = False
+        self.avg_rtcp_size = bye_size
+        self.event = RTCP_TYPE.RTCP_BYE
+        self.Schedule(self.tc + self.rtcp_interval(),RTCP_TYPE.RTCP_BYE)
+
+    '''
+        While a BYE is pending the interval only counts ourselves and the
+        BYEs received since leave(), not the registry of the session.
+    '''
+    @property
+    def member_count(self):
+        if RTCP_TYPE.TypeOfEvent(self.event) == RTCP_TYPE.EVENT_BYE:
+            return self.members
+        return self.sources.member_count
+
+    @property
+    def sender_count(self):
+        if RTCP_TYPE.TypeOfEvent(self.event) == RTCP_TYPE.EVENT_BYE:
+            return self.senders
+        return self.sources.sender_count
 
     def NewMember(self,m):
-        return m.ssrc in self.member_list
+        return m.ssrc not in self.sources
 
     def AddMember(self,m):
-        self.members_list.add( m.ssrc )
+        self.sources.on_rtcp(m.ssrc,None,self.tc)
+
+    '''refresh last_seen of a known member'''
+    def TouchMember(self,m):
+        self.sources.on_rtcp(m.ssrc,None,self.tc)
 
     def RemoveMember(self,m):
-        self.members_list.remove(m.ssrc)
+        self.sources.on_bye(m.ssrc)
 
     def NewSender(self,m):
-        return m.ssrc in self.sender_list
+        return m.ssrc not in self.sources.senders
 
     def AddSender(self,m):
-        self.sender_list.add(m.ssrc)
+        self.sources.on_rtp(m.ssrc,m.seq,None,self.tc)
+
+    '''refresh last_seen and last_sent of a known sender'''
+    def TouchSender(self,m):
+        self.sources.on_rtp(m.ssrc,m.seq,None,self.tc)
 
     def RemoveSender(self,m):
-        self.sender_list.remove(m.ssrc)
+        self.sources.senders.pop(m.ssrc,None)
 
     def Schedule(self,tn,e):
         self.tn = tn
-        pass
+        self.event = e
+        if self.scheduler is not None:
+            self.scheduler.schedule(self,tn,e)
 
     def Reschedule(self,tn,e):
-        self.tn = tn
-        pass
+        self.Schedule(tn,e)
+
+    def SendByePacket(self,e):
+        if self.scheduler is not None:
+            self.scheduler.cancel(self)
+        if self.send_bye is not None:
+            self.send_bye(e)
 
-    def SendByePacket(self):
-        pass
     def SendRTCPReport(self,e):
-        pass
+        if self.send_report is not None:
+            self.last_sent_size = self.send_report(e)
+
+    def SentPacketSize(self,e):
+        return self.last_sent_size
 
 
@@ -1,5 +1,15 @@
 import struct
 import random
+from array import array
+from collections import OrderedDict
+from time import perf_counter_ns
+
+from metrics import HISTOGRAM, METRIC
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 RTP_VERSION = 2
 RTP_SEQ_MOD = (1 << 16)
@@ -8,7 +18,16 @@ MAX_DROPOUT = 3000
 MAX_MISORDER = 100
 MIN_SEQUENTIAL = 2
 
+RTP_HEADER_SIZE = 12
+
+# precompiled layouts, shared by every header instance
+RTP_FIXED_HEADER = struct.Struct('!BBHII')
+RTP_EXT_HEADER = struct.Struct('!HH')
+RTP_CSRC_LIST = [ struct.Struct('!%dI' % n) for n in range(16) ]
+
 class RtpHeader:
+    __slots__ = ('field_byte_1','field_byte_2','field_uint16_3','field_uint32_4','field_uint32_5','field_uint32_list_6','field_uint16_7','field_bytes_8','field_layout_9','field_values_10')
+
     def __init__(self):
         self.field_byte_1           = 0
         self.field_byte_2           = 0
@@ -16,15 +35,127 @@ class RtpHeader:
         self.field_uint32_4         = 0
         self.field_uint32_5         = 0
         self.field_uint32_list_6    = []
+        self.field_uint16_7         = 0     # header extension profile
+        self.field_bytes_8          = None  # header extension data, w/o the 4 bytes ext header
+        self.field_layout_9         = None  # ExtensionLayout used to serialize RFC 8285 extensions
+        self.field_values_10        = None  # extension values, in field_layout_9.ids order
+
+    '''
+    Input:
+        buf: bytes, bytearray or memoryview holding a RTP packet
+        offset: where the packet starts in buf
+    Output:
+        return: (RtpHeader, payload memoryview)
+    '''
+    @staticmethod
+    def from_buffer(buf,offset=0):
+        header = RtpHeader()
+        payload = header.parse_into(buf,offset)
+        return header,payload
+
+    '''
+        Decode the fixed header, CSRC list, header extension and padding
+        of the packet at buf[offset:] into this header.  Nothing is copied:
+        the extension data and the returned payload are memoryviews over buf,
+        so they are only valid as long as buf is not modified.
+
+        Return the payload memoryview, padding excluded.
+    '''
+    def parse_into(self,buf,offset=0):
+        view = buf if isinstance(buf,memoryview) else memoryview(buf)
+        end = len(view)
+        if end - offset < RTP_HEADER_SIZE:
+            raise ValueError('RTP packet too short')
+
+        b1,b2,seq,ts,ssrc = RTP_FIXED_HEADER.unpack_from(view,offset)
+        if (b1 >> 6) != RTP_VERSION:
+            raise ValueError('RTP version must be 2')
+        self.field_byte_1 = b1
+        self.field_byte_2 = b2
+        self.field_uint16_3 = seq
+        self.field_uint32_4 = ts
+        self.field_uint32_5 = ssrc
+
+        pos = offset + RTP_HEADER_SIZE
+        cc = b1 & 0xF
+        if cc:
+            layout = RTP_CSRC_LIST[cc]
+            if pos + layout.size > end:
+                raise ValueError('RTP packet too short for CSRC list')
+            self.field_uint32_list_6 = list(layout.unpack_from(view,pos))
+            pos += layout.size
+        else:
+            self.field_uint32_list_6 = []
+
+        if b1 & 0x10:
+            if pos + RTP_EXT_HEADER.size > end:
+                raise ValueError('RTP packet too short for header extension')
+            profile,words = RTP_EXT_HEADER.unpack_from(view,pos)
+            pos += RTP_EXT_HEADER.size
+            if pos + (words << 2) > end:
+                raise ValueError('RTP header extension exceeds packet')
+            self.field_uint16_7 = profile
+            self.field_bytes_8 = view[pos:pos + (words << 2)]
+            pos += words << 2
+        else:
+            self.field_uint16_7 = 0
+            self.field_bytes_8 = None
+        self.field_layout_9 = None
+        self.field_values_10 = None
+
+        if b1 & 0x20:
+            pad = view[end - 1]
+            if pad == 0 or pos + pad > end:
+                raise ValueError('RTP padding length invalid')
+            end -= pad
+        return view[pos:end]
+
+    def size(self):
+        n = RTP_HEADER_SIZE + (len(self.field_uint32_list_6) << 2)
+        if self.ext and self.field_layout_9 is not None:
+            n += self.field_layout_9.size
+        elif self.ext and self.field_bytes_8 is not None:
+            n += RTP_EXT_HEADER.size + len(self.field_bytes_8)
+        return n
 
     def toByteArray(self):
-        self.update_cc()
-        buf = bytearray( struct.pack('!BBHII',self.field_byte_1,self.field_byte_2,self.field_uint16_3,self.field_uint32_4,self.field_uint32_5) )
-        for v in self.field_uint32_list_6:
+        buf = bytearray(self.size())
+        self.pack_into(buf,0)
+        return buf
+
+    '''
+        Serialize the header into buf at offset, buf must be writable
+        (bytearray or writable memoryview) and large enough, see size().
+
+        Return the number of bytes written.
+    '''
+    def pack_into(self,buf,offset=0):
+        csrc = self.field_uint32_list_6
+        if len(csrc) > 15:
+            raise ValueError('RTP header can carry at most 15 CSRC')
+        for v in csrc:
             if not isinstance(v,int):
                 raise TypeError('every CSRC must be a uint32 number')
-            buf.append( struct.pack('!I',v) )
-        return buf
+        self.update_cc()
+        RTP_FIXED_HEADER.pack_into(buf,offset,self.field_byte_1,self.field_byte_2,self.field_uint16_3,self.field_uint32_4,self.field_uint32_5)
+        pos = offset + RTP_HEADER_SIZE
+        if csrc:
+            layout = RTP_CSRC_LIST[len(csrc)]
+            layout.pack_into(buf,pos,*csrc)
+            pos += layout.size
+        if self.ext and self.field_layout_9 is not None:
+            pos += self.field_layout_9.pack_into(buf,pos,self.field_values_10)
+        elif self.ext and self.field_bytes_8 is not None:
+            n = len(self.field_bytes_8)
+            if n & 0x3:
+                raise ValueError('RTP header extension length must be multiple of 4')
+            RTP_EXT_HEADER.pack_into(buf,pos,self.field_uint16_7,n >> 2)
+            pos += RTP_EXT_HEADER.size
+            if pos + n > len(buf):
+                raise ValueError('buffer too small for RTP header extension')
+            buf[pos:pos + n] = self.field_bytes_8
+            pos += n
+        return pos - offset
 
     @property
     def version(self):
@@ -58,7 +189,7 @@ class RtpHeader:
 
     @property
     def marker(self):
-        return (self.field_byte_2 >> 7) & 0x 1
+        return (self.field_byte_2 >> 7) & 0x1
     @marker.setter
     def marker(self,m):
         self.field_byte_2 = (self.field_byte_2 & 0x7F) | ( (m & 0x1) << 7 )
@@ -95,12 +226,419 @@ class RtpHeader:
     @property
     def csrc(self):
         return self.field_uint32_list_6
-    @csrc.setter(self,cs):
+    @csrc.setter
+    def csrc(self,cs):
         self.field_uint32_list_6 = cs
 
+    '''header extension profile defined'''
+    @property
+    def ext_profile(self):
+        return self.field_uint16_7
+    @ext_profile.setter
+    def ext_profile(self,p):
+        self.field_uint16_7 = (p & 0xFFFF)
+
+    '''header extension data, length MUST be multiple of 4'''
+    @property
+    def ext_data(self):
+        return self.field_bytes_8
+    @ext_data.setter
+    def ext_data(self,d):
+        self.field_bytes_8 = d
+        self.field_layout_9 = None
+        self.field_values_10 = None
+
+    '''
+        Send RFC 8285 header extensions: values are serialized by pack_into()
+        with the precomputed layout, see ExtensionRegistry.layout().
+
+        Input:
+            layout: ExtensionLayout
+            values: one value per layout.ids, in the same order
+    '''
+    def set_extensions(self,layout,values):
+        if len(values) != len(layout.ids):
+            raise ValueError('need one value per extension of the layout')
+        self.field_layout_9 = layout
+        self.field_values_10 = values
+        self.field_uint16_7 = layout.profile
+        self.field_bytes_8 = None
+        self.ext = 1
+
+    '''
+        Raw data of the RFC 8285 extension element `id` of a parsed packet,
+        a memoryview, or None if the packet does not carry it.  Only the
+        element headers before it are looked at, nothing is decoded.
+    '''
+    def extension(self,id):
+        if not self.ext or self.field_bytes_8 is None:
+            return None
+        return find_extension(self.field_uint16_7,self.field_bytes_8,id)
+
+
+'''
+    RFC 8285 header extensions
+'''
+RTP_EXT_ONE_BYTE = 0xBEDE
+RTP_EXT_TWO_BYTE = 0x1000               # low 4 bits are appbits
+RTP_EXT_TWO_BYTE_MASK = 0xFFF0
+RTP_EXT_ONE_BYTE_MAX_ID = 14
+RTP_EXT_ONE_BYTE_MAX_SIZE = 16
+RTP_EXT_TWO_BYTE_MAX_ID = 255
+RTP_EXT_TWO_BYTE_MAX_SIZE = 255
+
+'''
+    Walk the extension elements of ext_data.
+
+    Input:
+        profile: ext_profile of the packet, 0xBEDE or 0x100X
+        data: ext_data of the packet
+    Output:
+        yield: (id, memoryview of the element data)
+'''
+def iter_extensions(profile,data):
+    view = data if isinstance(data,memoryview) else memoryview(data)
+    end = len(view)
+    pos = 0
+    if profile == RTP_EXT_ONE_BYTE:
+        while pos < end:
+            b = view[pos]
+            if b == 0:                  # padding
+                pos += 1
+                continue
+            id = b >> 4
+            if id == 15:                # reserved, stop processing
+                return
+            n = (b & 0xF) + 1
+            pos += 1
+            if pos + n > end:
+                return
+            yield id,view[pos:pos + n]
+            pos += n
+    elif (profile & RTP_EXT_TWO_BYTE_MASK) == RTP_EXT_TWO_BYTE:
+        while pos < end:
+            id = view[pos]
+            if id == 0:
+                pos += 1
+                continue
+            if pos + 2 > end:
+                return
+            n = view[pos + 1]
+            pos += 2
+            if pos + n > end:
+                return
+            yield id,view[pos:pos + n]
+            pos += n
+
+def find_extension(profile,data,id):
+    for eid,value in iter_extensions(profile,data):
+        if eid == id:
+            return value
+    return None
+
+'''
+    Typed codec of one extension.  size is the length of the element data,
+    pack_into() writes a value there and unpack() reads it back from a
+    memoryview of exactly size bytes.
+'''
+class HeaderExtension:
+    uri = None
+    size = 0
+
+    def pack_into(self,buf,offset,value):
+        buf[offset:offset + self.size] = value
+
+    def unpack(self,data):
+        return bytes(data)
+
+'''
+    abs-send-time: 24 bits 6.18 fixed point seconds, value in seconds
+'''
+class AbsSendTimeExtension(HeaderExtension):
+    uri = 'http://www.webrtc.org/experiments/rtp-hdrext/abs-send-time'
+    size = 3
+
+    def pack_into(self,buf,offset,value):
+        v = int(value * (1 << 18)) & 0xFFFFFF
+        buf[offset] = v >> 16
+        buf[offset + 1] = (v >> 8) & 0xFF
+        buf[offset + 2] = v & 0xFF
+
+    def unpack(self,data):
+        return ((data[0] << 16) | (data[1] << 8) | data[2]) / float(1 << 18)
+
+'''
+    Client-to-mixer audio level (RFC 6464): value is (voice, level),
+    voice activity flag and level in -dBov 0..127
+'''
+class AudioLevelExtension(HeaderExtension):
+    uri = 'urn:ietf:params:rtp-hdrext:ssrc-audio-level'
+    size = 1
+
+    def pack_into(self,buf,offset,value):
+        voice,level = value
+        buf[offset] = (0x80 if voice else 0) | (level & 0x7F)
+
+    def unpack(self,data):
+        b = data[0]
+        return (b >> 7,b & 0x7F)
+
+'''
+    Transport-wide congestion control sequence number, uint16
+'''
+class TransportSequenceExtension(HeaderExtension):
+    uri = 'http://www.ietf.org/id/draft-holmer-rmcat-transport-wide-cc-extensions-01'
+    size = 2
+
+    def pack_into(self,buf,offset,value):
+        buf[offset] = (value >> 8) & 0xFF
+        buf[offset + 1] = value & 0xFF
+
+    def unpack(self,data):
+        return (data[0] << 8) | data[1]
+
+'''
+    Serialization plan of a fixed set of extensions, built once by
+    ExtensionRegistry.layout().  The 4 bytes extension header, element
+    headers and padding are prepared in a template, pack_into() copies it
+    and lets each codec write its value at a precomputed offset.
+'''
+class ExtensionLayout:
+    __slots__ = ('ids','codecs','offsets','profile','size','template')
+
+    def __init__(self,ids,codecs):
+        self.ids = tuple(ids)
+        self.codecs = tuple(codecs)
+        one_byte = all( id <= RTP_EXT_ONE_BYTE_MAX_ID and 0 < c.size <= RTP_EXT_ONE_BYTE_MAX_SIZE for id,c in zip(self.ids,self.codecs) )
+        self.profile = RTP_EXT_ONE_BYTE if one_byte else RTP_EXT_TWO_BYTE
+        template = bytearray(RTP_EXT_HEADER.size)
+        offsets = []
+        for id,codec in zip(self.ids,self.codecs):
+            if one_byte:
+                template.append((id << 4) | (codec.size - 1))
+            else:
+                if codec.size > RTP_EXT_TWO_BYTE_MAX_SIZE:
+                    raise ValueError('RTP header extension %d too large' % id)
+                template.append(id)
+                template.append(codec.size)
+            offsets.append(len(template))
+            template.extend(bytes(codec.size))
+        template.extend(bytes(-len(template) & 0x3))
+        RTP_EXT_HEADER.pack_into(template,0,self.profile,(len(template) - RTP_EXT_HEADER.size) >> 2)
+        self.offsets = tuple(offsets)
+        self.size = len(template)
+        self.template = bytes(template)
+
+    '''
+        Write extension header and elements at buf[offset:], return the
+        number of bytes written (always self.size).
+    '''
+    def pack_into(self,buf,offset,values):
+        size = self.size
+        if offset + size > len(buf):
+            raise ValueError('buffer too small for RTP header extension')
+        buf[offset:offset + size] = self.template
+        for codec,pos,value in zip(self.codecs,self.offsets,values):
+            codec.pack_into(buf,offset + pos,value)
+        return size
+
+'''
+    Extension IDs negotiated for a session (SDP a=extmap) and their codecs.
+'''
+class ExtensionRegistry:
+    def __init__(self):
+        self.codecs = {}                # id -> HeaderExtension
+        self.ids = {}                   # uri -> id
+        self._layouts = {}              # tuple of ids -> ExtensionLayout
+
+    def register(self,id,codec):
+        if not 0 < id <= RTP_EXT_TWO_BYTE_MAX_ID:
+            raise ValueError('RTP header extension id must be in 1..255')
+        self.codecs[id] = codec
+        if codec.uri is not None:
+            self.ids[codec.uri] = id
+        self._layouts.clear()
+        return codec
+
+    def id_of(self,uri):
+        return self.ids.get(uri)
+
+    '''
+        ExtensionLayout for sending exactly these extension ids, in this
+        order.  Layouts are cached, call it per packet freely.
+    '''
+    def layout(self,ids):
+        ids = tuple(ids)
+        layout = self._layouts.get(ids)
+        if layout is None:
+            try:
+                codecs = [ self.codecs[id] for id in ids ]
+            except KeyError as e:
+                raise ValueError('RTP header extension %s not registered' % e.args[0])
+            layout = self._layouts[ids] = ExtensionLayout(ids,codecs)
+        return layout
+
+    '''
+        Decoded value of extension `id` in a parsed header, None if the
+        packet does not carry it.  Other extensions are not decoded.
+    '''
+    def get(self,header,id):
+        data = header.extension(id)
+        if data is None:
+            return None
+        codec = self.codecs.get(id)
+        if codec is None:
+            return bytes(data)
+        if codec.size and len(data) != codec.size:
+            raise ValueError('RTP header extension %d has wrong length' % id)
+        return codec.unpack(data)
+
+    def decode(self,header):
+        if not header.ext or header.ext_data is None:
+            return {}
+        out = {}
+        for id,data in iter_extensions(header.ext_profile,header.ext_data):
+            codec = self.codecs.get(id)
+            out[id] = codec.unpack(data) if codec is not None else bytes(data)
+        return out
+
+
+RTP_BATCH_FIELDS = ('valid','version','marker','paytype','seq','timestamp','ssrc','cc','payload_offset','payload_length')
+RTP_BATCH_TYPECODES = ('B','B','B','B','H','I','I','B','q','q')
+
+if numpy is not None:
+    RTP_BATCH_DTYPE = numpy.dtype([
+        ('valid','?'),
+        ('version','u1'),
+        ('marker','u1'),
+        ('paytype','u1'),
+        ('seq','u2'),
+        ('timestamp','u4'),
+        ('ssrc','u4'),
+        ('cc','u1'),
+        ('payload_offset','i8'),
+        ('payload_length','i8'),
+    ])
+else:
+    RTP_BATCH_DTYPE = None
+
+'''
+    Decode the headers of many RTP packets stored back to back in one buffer.
+
+    Input:
+        buf: bytes, bytearray or memoryview holding the packets
+        offsets: start of every packet in buf, ascending
+        lengths: length of every packet, default is up to the next offset
+                 (the last packet runs to the end of buf)
+    Output:
+        return: columns indexed by field name (see RTP_BATCH_FIELDS).
+                A numpy structured array of RTP_BATCH_DTYPE when numpy is
+                installed, otherwise a dict of array.array.
+
+    payload_offset is absolute in buf, payload_length excludes padding.
+    Packets which are too short or malformed have valid == 0 and the
+    other fields are meaningless.
+'''
+def decode_headers(buf,offsets,lengths=None):
+    if numpy is not None:
+        return _decode_headers_numpy(buf,offsets,lengths)
+    return _decode_headers_python(buf,offsets,lengths)
+
+def _decode_headers_numpy(buf,offsets,lengths):
+    data = numpy.frombuffer(buf,dtype=numpy.uint8)
+    size = data.shape[0]
+    off = numpy.asarray(offsets,dtype=numpy.int64)
+    n = off.shape[0]
+    out = numpy.zeros(n,dtype=RTP_BATCH_DTYPE)
+    if n == 0:
+        return out
+    if lengths is None:
+        end = numpy.empty(n,dtype=numpy.int64)
+        end[:-1] = off[1:]
+        end[-1] = size
+    else:
+        end = off + numpy.asarray(lengths,dtype=numpy.int64)
+
+    # gather with clipped indices, invalid rows are masked out at the end
+    last = max(size - 1,0)
+    def at(idx):
+        return data[numpy.clip(idx,0,last)].astype(numpy.uint32)
+
+    valid = (off >= 0) & (end <= size) & (end - off >= RTP_HEADER_SIZE)
+    b0 = at(off)
+    b1 = at(off + 1)
+    version = b0 >> 6
+    valid &= (version == RTP_VERSION)
+    cc = b0 & 0xF
+
+    pos = off + RTP_HEADER_SIZE + (cc.astype(numpy.int64) << 2)
+    has_ext = (b0 & 0x10) != 0
+    ext_words = (at(pos + 2) << 8) | at(pos + 3)
+    ext_len = numpy.where(has_ext,RTP_EXT_HEADER.size + (ext_words.astype(numpy.int64) << 2),0)
+    valid &= ~has_ext | (pos + RTP_EXT_HEADER.size <= end)
+    pos = pos + ext_len
+
+    has_pad = (b0 & 0x20) != 0
+    pad = numpy.where(has_pad,at(end - 1).astype(numpy.int64),0)
+    valid &= ~has_pad | (pad > 0)
+    plen = end - pad - pos
+    valid &= plen >= 0
+
+    out['valid'] = valid
+    out['version'] = version
+    out['marker'] = b1 >> 7
+    out['paytype'] = b1 & 0x7F
+    out['seq'] = (at(off + 2) << 8) | at(off + 3)
+    out['timestamp'] = (at(off + 4) << 24) | (at(off + 5) << 16) | (at(off + 6) << 8) | at(off + 7)
+    out['ssrc'] = (at(off + 8) << 24) | (at(off + 9) << 16) | (at(off + 10) << 8) | at(off + 11)
+    out['cc'] = cc
+    out['payload_offset'] = pos
+    out['payload_length'] = plen
+    return out
+
+def _decode_headers_python(buf,offsets,lengths):
+    view = buf if isinstance(buf,memoryview) else memoryview(buf)
+    size = len(view)
+    out = dict( (name,array(code)) for name,code in zip(RTP_BATCH_FIELDS,RTP_BATCH_TYPECODES) )
+    columns = [ out[name] for name in RTP_BATCH_FIELDS ]
+    offsets = list(offsets)
+    for i,off in enumerate(offsets):
+        if lengths is not None:
+            end = off + lengths[i]
+        elif i + 1 < len(offsets):
+            end = offsets[i + 1]
+        else:
+            end = size
+        row = _decode_header_row(view,off,end,size)
+        for column,v in zip(columns,row):
+            column.append(v)
+    return out
+
+def _decode_header_row(view,off,end,size):
+    if off < 0 or end > size or end - off < RTP_HEADER_SIZE:
+        return (0,0,0,0,0,0,0,0,0,0)
+    b0,b1,seq,ts,ssrc = RTP_FIXED_HEADER.unpack_from(view,off)
+    cc = b0 & 0xF
+    valid = (b0 >> 6) == RTP_VERSION
+    pos = off + RTP_HEADER_SIZE + (cc << 2)
+    if valid and (b0 & 0x10):
+        if pos + RTP_EXT_HEADER.size > end:
+            valid = False
+        else:
+            pos += RTP_EXT_HEADER.size + (RTP_EXT_HEADER.unpack_from(view,pos)[1] << 2)
+    pad = 0
+    if valid and (b0 & 0x20):
+        pad = view[end - 1]
+        valid = pad > 0
+    plen = end - pad - pos
+    if not valid or plen < 0:
+        return (0,b0 >> 6,b1 >> 7,b1 & 0x7F,seq,ts,ssrc,cc,pos,0)
+    return (1,b0 >> 6,b1 >> 7,b1 & 0x7F,seq,ts,ssrc,cc,pos,plen)
 
 
 class Source:
+    __slots__ = ('max_seq','cycles','base_seq','bad_seq','probation','received','expected_prior','received_prior','transit','jitter','metrics')
+
     def __init__(self):
         self.max_seq = 0            # u_int16 ,highest seq. number seen
         self.cycles = 0             # shifted count of seq. number cycles
@@ -112,6 +650,7 @@ class Source:
         self.received_prior = 0     # packet received at last interval
         self.transit = 0            # relative trans time for prev pkt
         self.jitter = 0             # estimated jitter
+        self.metrics = None         # metrics.SessionMetrics counting rejected packets
 
     def init_seq(self,seq):
         self.base_seq = seq
@@ -122,10 +661,45 @@ class Source:
         self.received_prior = 0
         self.expected_prior = 0
 
+    '''
+        Initialize state for a source heard for the first time, the
+        source is not valid until MIN_SEQUENTIAL packets in sequence
+        have been received.
+    '''
+    def init_source(self,seq):
+        self.init_seq(seq)
+        self.max_seq = seq - 1
+        self.probation = MIN_SEQUENTIAL
+
+    '''
+        Update the interarrival jitter estimate (RFC 3550 A.8), arrival
+        is the packet arrival time in the same units as the RTP timestamp.
+    '''
+    def update_jitter(self,timestamp,arrival):
+        transit = arrival - timestamp
+        if self.received <= 1:
+            # first packet since (re)sync, nothing to compare with
+            self.transit = transit
+            return
+        # timestamps wrap at 32 bits, so does the transit difference
+        d = (transit - self.transit) & 0xFFFFFFFF
+        self.transit = transit
+        if d >= 0x80000000:
+            d = 0x100000000 - d
+        self.jitter += (1.0/16.0) * (d - self.jitter)
+
+    '''
+        Account one received packet, return False if the packet is not
+        valid (source on probation, or a bad sequence jump).
+    '''
+    def receive(self,seq,timestamp,arrival):
+        if not self.update_seq(seq):
+            return False
+        self.update_jitter(timestamp,arrival)
+        return True
+
     def update_seq(self,seq):
-        udelta = seq - self.max_seq
-        if udelta < 0:
-            udelta += 0xFFFF 
+        udelta = (seq - self.max_seq) & (RTP_SEQ_MOD - 1)
         if self.probation > 0:
             if seq == self.max_seq + 1:
                 self.probation -= 1
@@ -137,6 +711,10 @@ class Source:
             else:
                 self.probation = MIN_SEQUENTIAL - 1
                 self.max_seq = seq
+                if self.metrics is not None:
+                    # in sequence packets on probation are not rejections
+                    self.metrics.count(METRIC.PROBATION_RESETS)
+                    self.metrics.count(METRIC.SEQ_REJECTED)
             return False
         elif udelta < MAX_DROPOUT:
             if seq < self.max_seq:
@@ -152,6 +730,8 @@ class Source:
                 self.init_seq(seq)
             else:
                 self.bad_seq = (seq + 1) & (RTP_SEQ_MOD - 1)
+                if self.metrics is not None:
+                    self.metrics.count(METRIC.SEQ_REJECTED)
                 return False
         else:
             # duplicate or reordered packet
@@ -181,11 +761,649 @@ class Source:
         if expected_interval == 0 or lost_interval <= 0:
             return 0
         else:
-            return ((lost_interval << 8) / expected_interval) & 0xFF
+            return ((lost_interval << 8) // expected_interval) & 0xFF
+
+
+SOURCE_INT_COLUMNS = ('ssrc','max_seq','cycles','base_seq','bad_seq','probation','received','expected_prior','received_prior','transit')
+
+'''
+    Per-SSRC receive statistics of many sources, held in columns (one row
+    per source) instead of one Source object each.  update() applies a
+    whole batch of packets from any number of sources; the result is the
+    same as calling Source.receive() packet by packet, in batch order.
+
+    The columns are numpy arrays when numpy is installed, array.array
+    otherwise.
+'''
+class SourceTable:
+    def __init__(self,capacity=64):
+        self.index = {}             # ssrc -> row
+        self.count = 0              # rows in use
+        self.capacity = 0
+        for name in SOURCE_INT_COLUMNS:
+            setattr(self,name,self._column('q',0))
+        self.jitter = self._column('d',0)
+        self._grow(max(capacity,1))
+
+    @staticmethod
+    def _column(code,n):
+        if numpy is not None:
+            return numpy.zeros(n,dtype=numpy.int64 if code == 'q' else numpy.float64)
+        return array(code,bytes(8 * n))
+
+    def _grow(self,capacity):
+        n = capacity - self.capacity
+        for name in SOURCE_INT_COLUMNS + ('jitter',):
+            column = getattr(self,name)
+            extra = self._column('d' if name == 'jitter' else 'q',n)
+            if numpy is not None:
+                setattr(self,name,numpy.concatenate((column,extra)))
+            else:
+                column.extend(extra)
+        self.capacity = capacity
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self,ssrc):
+        return ssrc in self.index
+
+    '''
+        Row of ssrc, a new row initialized by Source.init_source(seq)
+        is added if ssrc is unknown.
+    '''
+    def row(self,ssrc,seq):
+        r = self.index.get(ssrc)
+        if r is not None:
+            return r
+        if self.count == self.capacity:
+            self._grow(self.capacity * 2)
+        r = self.count
+        self.count += 1
+        self.index[ssrc] = r
+        self.ssrc[r] = ssrc
+        self.base_seq[r] = seq
+        self.max_seq[r] = seq - 1
+        self.bad_seq[r] = RTP_SEQ_MOD + 1
+        self.probation[r] = MIN_SEQUENTIAL
+        for name in ('cycles','received','expected_prior','received_prior','transit'):
+            getattr(self,name)[r] = 0
+        self.jitter[r] = 0.0
+        return r
+
+    '''
+    Input:
+        ssrcs,seqs,timestamps,arrivals: one entry per packet, in arrival
+        order; arrival is in the same units as the RTP timestamp
+    Output:
+        return: validity of each packet, as Source.receive() returns it
+    '''
+    def update(self,ssrcs,seqs,timestamps,arrivals):
+        if numpy is not None:
+            return self._update_numpy(ssrcs,seqs,timestamps,arrivals)
+        return self._update_python(ssrcs,seqs,timestamps,arrivals)
+
+    def _update_numpy(self,ssrcs,seqs,timestamps,arrivals):
+        ssrcs = numpy.asarray(ssrcs,dtype=numpy.int64)
+        seqs = numpy.asarray(seqs,dtype=numpy.int64)
+        transits = numpy.asarray(arrivals,dtype=numpy.int64) - numpy.asarray(timestamps,dtype=numpy.int64)
+        n = ssrcs.shape[0]
+        valid = numpy.zeros(n,dtype=bool)
+        if n == 0:
+            return valid
+
+        # map ssrc to row, one dict lookup per distinct ssrc
+        uniq,first,inverse = numpy.unique(ssrcs,return_index=True,return_inverse=True)
+        rows_of_uniq = numpy.empty(uniq.shape[0],dtype=numpy.int64)
+        for u in numpy.argsort(first,kind='stable'):
+            rows_of_uniq[u] = self.row(int(uniq[u]),int(seqs[first[u]]))
+        rows = rows_of_uniq[inverse]
+
+        # packets of one source must be applied in order, so split the
+        # batch in rounds holding at most one packet per source
+        order = numpy.argsort(rows,kind='stable')
+        sorted_rows = rows[order]
+        starts = numpy.flatnonzero(numpy.r_[True,sorted_rows[1:] != sorted_rows[:-1]])
+        group_start = numpy.repeat(starts,numpy.diff(numpy.r_[starts,n]))
+        rank = numpy.empty(n,dtype=numpy.int64)
+        rank[order] = numpy.arange(n) - group_start
+        by_rank = numpy.argsort(rank,kind='stable')
+        bounds = numpy.searchsorted(rank[by_rank],numpy.arange(int(rank.max()) + 2))
+        for k in range(bounds.shape[0] - 1):
+            idx = by_rank[bounds[k]:bounds[k + 1]]
+            valid[idx] = self._apply_round(rows[idx],seqs[idx],transits[idx])
+        return valid
+
+    def _apply_round(self,r,seq,transit):
+        max_seq = self.max_seq[r]
+        probation = self.probation[r]
+        cycles = self.cycles[r]
+        received = self.received[r]
+        bad_seq = self.bad_seq[r]
+        udelta = (seq - max_seq) & (RTP_SEQ_MOD - 1)
+
+        # source on probation
+        on_probation = probation > 0
+        in_sequence = on_probation & (seq == max_seq + 1)
+        probation = numpy.where(in_sequence,probation - 1,numpy.where(on_probation,MIN_SEQUENTIAL - 1,probation))
+        validated = in_sequence & (probation == 0)
+
+        # valid source
+        normal = ~on_probation
+        forward = normal & (udelta < MAX_DROPOUT)
+        cycles = cycles + numpy.where(forward & (seq < max_seq),RTP_SEQ_MOD,0)
+        jump = normal & ~forward & (udelta < RTP_SEQ_MOD - MAX_MISORDER)
+        resync = jump & (seq == bad_seq)
+        bad = jump & ~resync
+        bad_seq = numpy.where(bad,(seq + 1) & (RTP_SEQ_MOD - 1),bad_seq)
+        max_seq = numpy.where(on_probation | forward,seq,max_seq)
+
+        restart = validated | resync
+        valid = validated | (normal & ~bad)
+        self.base_seq[r] = numpy.where(restart,seq,self.base_seq[r])
+        self.max_seq[r] = numpy.where(restart,seq,max_seq)
+        self.bad_seq[r] = numpy.where(restart,RTP_SEQ_MOD + 1,bad_seq)
+        self.cycles[r] = numpy.where(restart,0,cycles)
+        self.expected_prior[r] = numpy.where(restart,0,self.expected_prior[r])
+        self.received_prior[r] = numpy.where(restart,0,self.received_prior[r])
+        received = numpy.where(restart,0,received) + valid
+        self.received[r] = received
+        self.probation[r] = probation
+
+        # interarrival jitter of valid packets
+        prev = self.transit[r]
+        jitter = self.jitter[r]
+        update = valid & (received > 1)
+        d = (transit - prev) & 0xFFFFFFFF
+        d = numpy.where(d >= 0x80000000,0x100000000 - d,d).astype(numpy.float64)
+        self.jitter[r] = numpy.where(update,jitter + (1.0/16.0) * (d - jitter),jitter)
+        self.transit[r] = numpy.where(valid,transit,prev)
+        return valid
+
+    def _update_python(self,ssrcs,seqs,timestamps,arrivals):
+        valid = []
+        for ssrc,seq,ts,arrival in zip(ssrcs,seqs,timestamps,arrivals):
+            valid.append(self._receive(self.row(ssrc,seq),seq,arrival - ts))
+        return valid
+
+    def _receive(self,r,seq,transit):
+        max_seq = self.max_seq[r]
+        udelta = (seq - max_seq) & (RTP_SEQ_MOD - 1)
+        if self.probation[r] > 0:
+            self.max_seq[r] = seq
+            if seq == max_seq + 1:
+                self.probation[r] -= 1
+                if self.probation[r] != 0:
+                    return False
+                self._init_seq(r,seq)
+            else:
+                self.probation[r] = MIN_SEQUENTIAL - 1
+                return False
+        elif udelta < MAX_DROPOUT:
+            if seq < max_seq:
+                self.cycles[r] += RTP_SEQ_MOD
+            self.max_seq[r] = seq
+        elif udelta < RTP_SEQ_MOD - MAX_MISORDER:
+            if seq == self.bad_seq[r]:
+                self._init_seq(r,seq)
+            else:
+                self.bad_seq[r] = (seq + 1) & (RTP_SEQ_MOD - 1)
+                return False
+        self.received[r] += 1
+
+        if self.received[r] > 1:
+            d = (transit - self.transit[r]) & 0xFFFFFFFF
+            if d >= 0x80000000:
+                d = 0x100000000 - d
+            self.jitter[r] += (1.0/16.0) * (d - self.jitter[r])
+        self.transit[r] = transit
+        return True
+
+    def _init_seq(self,r,seq):
+        self.base_seq[r] = seq
+        self.max_seq[r] = seq
+        self.bad_seq[r] = RTP_SEQ_MOD + 1
+        self.cycles[r] = 0
+        self.received[r] = 0
+        self.received_prior[r] = 0
+        self.expected_prior[r] = 0
+
+    def expected(self,r):
+        return self.cycles[r] + self.max_seq[r] - self.base_seq[r] + 1
+
+    def lost(self,r):
+        return self.expected(r) - self.received[r]
+
+    '''
+        Same as Source.lost_fraction() for every row at once, the interval
+        counters of all rows are advanced.
+    '''
+    def lost_fraction(self):
+        n = self.count
+        if numpy is not None:
+            expected = self.cycles[:n] + self.max_seq[:n] - self.base_seq[:n] + 1
+            expected_interval = expected - self.expected_prior[:n]
+            received_interval = self.received[:n] - self.received_prior[:n]
+            self.expected_prior[:n] = expected
+            self.received_prior[:n] = self.received[:n]
+            lost_interval = expected_interval - received_interval
+            ok = (expected_interval != 0) & (lost_interval > 0)
+            return numpy.where(ok,((lost_interval << 8) // numpy.where(ok,expected_interval,1)) & 0xFF,0)
+        fractions = []
+        for r in range(n):
+            expected = self.expected(r)
+            expected_interval = expected - self.expected_prior[r]
+            self.expected_prior[r] = expected
+            received_interval = self.received[r] - self.received_prior[r]
+            self.received_prior[r] = self.received[r]
+            lost_interval = expected_interval - received_interval
+            if expected_interval == 0 or lost_interval <= 0:
+                fractions.append(0)
+            else:
+                fractions.append(((lost_interval << 8) // expected_interval) & 0xFF)
+        return fractions
+
+    '''
+        Snapshot of ssrc state as a Source
+    '''
+    def source(self,ssrc):
+        r = self.index[ssrc]
+        s = Source()
+        for name in SOURCE_INT_COLUMNS[1:]:     # the Source attributes after ssrc
+            setattr(s,name,int(getattr(self,name)[r]))
+        s.jitter = float(self.jitter[r])
+        return s
+
+
+'''
+    Result of SourceRegistry.on_rtp()/on_rtcp() (RFC 3550 8.2)
+'''
+class SSRC_STATE:
+    KNOWN           = 0     # packet from a known source
+    NEW             = 1     # first packet of a new source
+    COLLISION       = 2     # another participant uses our own SSRC: choose a new one and send BYE
+    LOOP            = 3     # our own packet looped back, drop it
+    CONFLICT        = 4     # third party collision or loop, drop it
+
+'''
+    Default time (seconds) a conflicting source transport address is
+    remembered, RFC 3550 8.2 suggests 10 RTCP intervals.
+'''
+CONFLICT_TIMEOUT = 50.0
+
+class Member:
+    __slots__ = ('ssrc','source','rtp_address','rtcp_address','last_seen','last_sent')
+
+    def __init__(self,ssrc):
+        self.ssrc = ssrc
+        self.source = None          # Source, created on first RTP packet
+        self.rtp_address = None     # source transport address of data packets
+        self.rtcp_address = None    # source transport address of control packets
+        self.last_seen = 0          # time of last RTP or RTCP packet
+        self.last_sent = 0          # time of last RTP packet
+
+'''
+    Session members keyed by SSRC.
+
+    members and senders are kept ordered by last activity, so lookups are
+    O(1) and expire() only touches the entries it removes.
+'''
+class SourceRegistry:
+    def __init__(self,own_ssrc=None,conflict_timeout=CONFLICT_TIMEOUT):
+        self.own_ssrc = own_ssrc
+        self.conflict_timeout = conflict_timeout
+        self.members = OrderedDict()        # ssrc -> Member, by last_seen
+        self.senders = OrderedDict()        # ssrc -> Member, by last_sent
+        self.conflicts = OrderedDict()      # source transport address -> time last conflict
+        self.collisions = 0
+        self.loops = 0
+        self._metrics = None
+
+    '''
+        metrics.SessionMetrics counting the rejected packets of the
+        sources, set on the existing sources too so None stops counting.
+    '''
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self,metrics):
+        self._metrics = metrics
+        for m in self.members.values():
+            if m.source is not None:
+                m.source.metrics = metrics
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self,ssrc):
+        return ssrc in self.members
+
+    def __iter__(self):
+        return iter(self.members.values())
+
+    def get(self,ssrc):
+        return self.members.get(ssrc)
+
+    def source(self,ssrc):
+        m = self.members.get(ssrc)
+        return None if m is None else m.source
+
+    @property
+    def member_count(self):
+        # we are a member of the session as well
+        return len(self.members) + (0 if self.own_ssrc is None else 1)
+
+    @property
+    def sender_count(self):
+        return len(self.senders)
+
+    '''
+        Account a RTP packet, see SSRC_STATE for the result.
+        A Source initialized with seq is created for new senders.
+    '''
+    def on_rtp(self,ssrc,seq,address,now):
+        state,m = self._check(ssrc,address,now,False)
+        if m is not None:
+            if m.source is None:
+                m.source = Source()
+                m.source.init_source(seq)
+                m.source.metrics = self._metrics
+            m.last_sent = now
+            if ssrc in self.senders:
+                self.senders.move_to_end(ssrc)
+            else:
+                self.senders[ssrc] = m
+        return state
+
+    '''
+        Account a RTCP packet (SR/RR/SDES) of ssrc
+    '''
+    def on_rtcp(self,ssrc,address,now):
+        return self._check(ssrc,address,now,True)[0]
+
+    '''
+        Remove ssrc on BYE, return True if it was a member
+    '''
+    def on_bye(self,ssrc):
+        self.senders.pop(ssrc,None)
+        return self.members.pop(ssrc,None) is not None
+
+    def _check(self,ssrc,address,now,control):
+        if ssrc == self.own_ssrc:
+            self._expire_conflicts(now)
+            if address in self.conflicts:
+                self.loops += 1
+                self.conflicts[address] = now
+                self.conflicts.move_to_end(address)
+                return SSRC_STATE.LOOP,None
+            self.collisions += 1
+            self.conflicts[address] = now
+            return SSRC_STATE.COLLISION,None
+
+        m = self.members.get(ssrc)
+        if m is None:
+            m = Member(ssrc)
+            state = SSRC_STATE.NEW
+            self.members[ssrc] = m
+        else:
+            known = m.rtcp_address if control else m.rtp_address
+            if known is not None and known != address:
+                self._expire_conflicts(now)
+                self.conflicts[address] = now
+                self.conflicts.move_to_end(address)
+                return SSRC_STATE.CONFLICT,None
+            state = SSRC_STATE.KNOWN
+            self.members.move_to_end(ssrc)
+        if control:
+            m.rtcp_address = address
+        else:
+            m.rtp_address = address
+        m.last_seen = now
+        return state,m
+
+    def _expire_conflicts(self,now):
+        limit = now - self.conflict_timeout
+        conflicts = self.conflicts
+        while conflicts:
+            address,t = next(iter(conflicts.items()))
+            if t >= limit:
+                break
+            del conflicts[address]
+
+    '''
+        Our own SSRC changed after a collision
+    '''
+    def change_own_ssrc(self,ssrc):
+        self.members.pop(ssrc,None)
+        self.senders.pop(ssrc,None)
+        self.own_ssrc = ssrc
+
+    '''
+        Timeout of members and senders (RFC 3550 6.3.5):
+        members not heard of since now - 5 * td are removed, senders
+        which sent no RTP since now - 2 * t lose their sender status.
+
+        td: deterministic calculated interval (without randomization)
+        t: last transmission interval, default td
+
+        return: (list of removed Member, list of Member no longer senders)
+    '''
+    def expire(self,now,td,t=None):
+        if t is None:
+            t = td
+        removed = []
+        demoted = []
+
+        limit = now - 2 * t
+        senders = self.senders
+        while senders:
+            m = next(iter(senders.values()))
+            if m.last_sent >= limit:
+                break
+            del senders[m.ssrc]
+            demoted.append(m)
+
+        limit = now - 5 * td
+        members = self.members
+        while members:
+            m = next(iter(members.values()))
+            if m.last_seen >= limit:
+                break
+            del members[m.ssrc]
+            senders.pop(m.ssrc,None)
+            removed.append(m)
+        return removed,demoted
+
+
+RTP_MTU = 1500
 
+'''
+    Loss fraction (8-bit fixed point, see Source.lost_fraction()) above
+    which a sender with auto_adjust_sent_rate packs more frames per
+    packet, and below which it steps back to frames_per_packet_hint.
+'''
+LOSS_FRACTION_HIGH = 13         # ~5%
+LOSS_FRACTION_LOW = 3           # ~1%
 
 class RtpStream:
     def __init__(self,**kwargs):
         self.profile = kwargs.get('profile',None)
         self.transport = kwargs.get('transport',None)
-        self.sources = []
+        self.ssrc = kwargs.get('ssrc',None)
+        if self.ssrc is None:
+            self.ssrc = random.randint(1,0xFFFFFFFF)
+        self.sources = SourceRegistry(self.ssrc)
+
+        # sender state
+        self.header = RtpHeader()
+        self.header.version = RTP_VERSION
+        self.header.ssrc = self.ssrc
+        self.header.paytype = kwargs.get('paytype',0)
+        self.header.seq = random.randint(0,0xFFFF)
+        self.header.timestamp = random.randint(0,0xFFFFFFFF)
+        self.header.marker = 1          # first packet of the stream
+        hint = self.profile.frames_per_packet_hint if self.profile is not None else 1
+        self.frames_per_packet = hint
+        self.max_frames_per_packet = kwargs.get('max_frames_per_packet',hint * 4)
+        self.srtp = kwargs.get('srtp',None)     # srtp.SrtpSession, None sends cleartext
+        self.pool = kwargs.get('pool',None)     # bufferpool.BufferPool to borrow the packet buffer from
+        self.rtx_cache = kwargs.get('rtx_cache',None)   # retransmit.RetransmissionCache for NACKs, expired on every send
+        self.fec = kwargs.get('fec',None)       # fec.FecEncoder, parity packets sent after the media
+        self.metrics = None                     # metrics.SessionMetrics, times packet serialization
+        if self.pool is not None:
+            self._buffer = self.pool.acquire()
+        else:
+            self._buffer = bytearray(kwargs.get('mtu',RTP_MTU))
+        self._view = memoryview(self._buffer)
+        self.packets_sent = 0
+        self.octets_sent = 0            # payload octets, as reported in SR
+        self.retransmitted = 0
+        self.fec_sent = 0
+
+    '''
+        Send one packet carrying frames, return the packet size.
+
+        Header and payload are written into one buffer reused for every
+        packet, the transport must not keep a reference to it.  With srtp
+        set the packet is encrypted in place in that same buffer.
+    '''
+    def send_frames(self,frames):
+        header = self.header
+        metrics = self.metrics
+        if metrics is not None:
+            start = perf_counter_ns()
+        n = header.pack_into(self._buffer,0)
+        size = self.profile.pack_into(frames,self._buffer,n)
+        length = n + size
+        if metrics is not None:
+            metrics.observe(HISTOGRAM.PACK,perf_counter_ns() - start)
+        if self.rtx_cache is not None:
+            cache = self.rtx_cache
+            now = cache.clock()
+            cache.put(self._view[:length],now)
+            cache.expire(now)
+        parity = None
+        if self.fec is not None:
+            parity = self.fec.add(self._view[:length])
+        if self.srtp is not None:
+            length = self.srtp.protect(self._buffer,length)
+        self.transport.send(self._view[:length])
+        if parity is not None:
+            self._send_fec(len(parity))
+        header.marker = 0
+        header.seq = header.seq + 1
+        header.timestamp = header.timestamp + self.profile.samples_per_frame * len(frames)
+        self.packets_sent += 1
+        self.octets_sent += size
+        return length
+
+    def _send_fec(self,length):
+        fec = self.fec
+        if self.srtp is not None:
+            length = self.srtp.protect(fec.buf,length)
+        self.transport.send(fec.view[:length])
+        self.fec_sent += 1
+
+    '''
+        Send the parity packet of the last, incomplete FEC window (end of
+        the stream).
+    '''
+    def flush_fec(self):
+        if self.fec is None:
+            return
+        parity = self.fec.flush()
+        if parity is not None:
+            self._send_fec(len(parity))
+
+    '''
+        Send again the packets of seqs still in rtx_cache (e.g. the
+        lost_seqs of a NACK), return how many were sent.
+
+        Packets are resent unchanged in the original stream.  With SRTP
+        the receiver's replay window drops them, RTX streams (RFC 4588)
+        are not implemented.
+    '''
+    def retransmit(self,seqs):
+        cache = self.rtx_cache
+        if cache is None:
+            return 0
+        now = cache.clock()
+        cache.expire(now)
+        count = 0
+        for seq in seqs:
+            packet = cache.get(seq,now)
+            if packet is None:
+                continue
+            length = len(packet)
+            self._buffer[:length] = packet
+            if self.srtp is not None:
+                length = self.srtp.protect(self._buffer,length)
+            self.transport.send(self._view[:length])
+            count += 1
+        self.retransmitted += count
+        return count
+
+    '''
+        Give the packet buffer back to the pool, the stream can not send
+        anymore.
+    '''
+    def close(self):
+        if self.pool is not None and self._buffer is not None:
+            self._view.release()
+            self.pool.release(self._buffer)
+            self._buffer = self._view = None
+
+    '''
+        Pull encoded frames from an iterator and send them, grouped
+        frames_per_packet at a time.  Return the number of packets sent.
+    '''
+    def packetize(self,frames):
+        count = 0
+        group = []
+        for frame in frames:
+            group.append(frame)
+            if len(group) >= self.frames_per_packet:
+                self.send_frames(group)
+                group = []
+                count += 1
+        if group:
+            self.send_frames(group)
+            count += 1
+        return count
+
+    '''
+        Same as packetize() for an async iterator (e.g. async generator)
+    '''
+    async def packetize_async(self,frames):
+        count = 0
+        group = []
+        async for frame in frames:
+            group.append(frame)
+            if len(group) >= self.frames_per_packet:
+                self.send_frames(group)
+                group = []
+                count += 1
+        if group:
+            self.send_frames(group)
+            count += 1
+        return count
+
+    '''
+        Loss feedback for our stream from a RTCP receiver report item.
+        With profile.auto_adjust_sent_rate, more frames are packed per
+        packet while the loss fraction is high, cutting the packet rate
+        and per-packet overhead, and fewer once it is low again.
+    '''
+    def on_receiver_report(self,item):
+        if item.ssrc != self.ssrc:
+            return
+        profile = self.profile
+        if not profile.auto_adjust_sent_rate:
+            return
+        fraction = item.fraction
+        if fraction > LOSS_FRACTION_HIGH:
+            self.frames_per_packet = min(self.frames_per_packet + 1,self.max_frames_per_packet)
+        elif fraction < LOSS_FRACTION_LOW:
+            self.frames_per_packet = max(self.frames_per_packet - 1,profile.frames_per_packet_hint)
@@ -1,5 +1,6 @@
+from rtp import SourceRegistry
 
 
 class Session:
     def __init__(self):
-        self.sources = []
+        self.sources = SourceRegistry()
@@ -0,0 +1,588 @@
+import asyncio
+import multiprocessing
+import os
+import random
+import struct
+import time
+import zlib
+from multiprocessing import shared_memory
+
+from rtcp import RTCP_MIN_TIME, RTCP_TYPE, ClockSync, CompoundRtcpBuilder, ReportGenerator, Rtcp, RtcpScheduler, parse_compound
+from rtp import SSRC_STATE
+from session import Session
+from transport import AsyncioTransport
+
+SHARD_ROWS = 4096                   # source rows per worker in shared memory
+SHARD_STATS_INTERVAL = 1.0          # seconds between stats publications
+SHARD_SESSION_BANDWIDTH = 64        # kb/s, default RTCP session bandwidth
+SHARD_READ_RETRIES = 1000
+
+'''
+    Shared memory layout, per worker:
+
+        worker row: gen, sessions, updated, rtp packets, rtcp packets,
+                    unrouted, errors
+        SHARD_ROWS source rows: gen, used, session handle, ssrc, received,
+                    expected, lost, jitter, extended max seq, fraction
+                    lost (last RR)
+
+    There is no round trip time: workers only receive, so they send RRs
+    and no SR, and peers have no LSR/DLSR to report back to them.
+
+    Every row has a single writer (its worker).  gen is a sequence lock:
+    odd while the row is written, readers retry until they see the same
+    even gen before and after reading.
+'''
+SHARD_WORKER_STATS = struct.Struct('=IIdQQQQ')
+SHARD_SOURCE_STATS = struct.Struct('=IIIIQQqIII')
+SHARD_GEN = struct.Struct('=I')
+
+SHARD_WORKER_FIELDS = ('sessions','updated','rtp_packets','rtcp_packets','unrouted','errors')
+SHARD_SOURCE_FIELDS = ('session','ssrc','received','expected','lost','jitter','ext_max_seq','fraction')
+
+'''
+    Stable shard index of a session key: an SSRC (int), a 5-tuple or any
+    str/bytes.  Python's hash() is salted per process, so it is not used.
+'''
+def shard_of(key,shards):
+    if isinstance(key,int):
+        # Fibonacci hashing: consecutive SSRC/ids spread over the shards
+        return ((key * 0x9E3779B1) & 0xFFFFFFFF) * shards >> 32
+    if isinstance(key,str):
+        key = key.encode('utf-8')
+    elif isinstance(key,tuple):
+        key = repr(key).encode('utf-8')
+    return zlib.crc32(key) % shards
+
+class ShardStats:
+    def __init__(self,workers,rows=SHARD_ROWS,name=None,create=True):
+        self.workers = workers
+        self.rows = rows
+        self.stride = SHARD_WORKER_STATS.size + rows * SHARD_SOURCE_STATS.size
+        self.shm = shared_memory.SharedMemory(name=name,create=create,size=workers * self.stride)
+        self.buf = self.shm.buf
+        if create:
+            self.buf[:workers * self.stride] = bytes(workers * self.stride)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _worker_offset(self,worker):
+        return worker * self.stride
+
+    def _source_offset(self,worker,row):
+        return worker * self.stride + SHARD_WORKER_STATS.size + row * SHARD_SOURCE_STATS.size
+
+    def _write(self,layout,offset,values):
+        gen = SHARD_GEN.unpack_from(self.buf,offset)[0] | 1
+        # pack first: a bad value must not leave the row locked
+        row = layout.pack(gen,*values)
+        self.buf[offset:offset + layout.size] = row
+        SHARD_GEN.pack_into(self.buf,offset,(gen + 1) & 0xFFFFFFFF)
+
+    def _read(self,layout,offset):
+        for _ in range(SHARD_READ_RETRIES):
+            values = layout.unpack_from(self.buf,offset)
+            if not values[0] & 1 and SHARD_GEN.unpack_from(self.buf,offset)[0] == values[0]:
+                break
+        # else the writer died mid-row, return what is there
+        return values[1:]
+
+    def write_worker(self,worker,sessions,rtp_packets,rtcp_packets,unrouted,errors):
+        self._write(SHARD_WORKER_STATS,self._worker_offset(worker),(sessions,time.time(),rtp_packets,rtcp_packets,unrouted,errors))
+
+    def read_worker(self,worker):
+        return dict(zip(SHARD_WORKER_FIELDS,self._read(SHARD_WORKER_STATS,self._worker_offset(worker))))
+
+    def write_source(self,worker,row,session,ssrc,received,expected,lost,jitter,ext_max_seq,fraction):
+        self._write(SHARD_SOURCE_STATS,self._source_offset(worker,row),(1,session,ssrc,received,expected,lost,jitter,ext_max_seq,fraction))
+
+    def clear_source(self,worker,row):
+        self._write(SHARD_SOURCE_STATS,self._source_offset(worker,row),(0,0,0,0,0,0,0,0,0))
+
+    def read_sources(self,worker):
+        out = []
+        for row in range(self.rows):
+            values = self._read(SHARD_SOURCE_STATS,self._source_offset(worker,row))
+            if values[0]:
+                out.append(dict(zip(SHARD_SOURCE_FIELDS,values[1:])))
+        return out
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+'''
+    One RTP session of a worker: SourceRegistry (shared with the RTCP
+    timer rules), report generation and sender clock tracking.
+'''
+class _ShardSession:
+    def __init__(self,id,handle,params,scheduler,transport):
+        self.id = id
+        self.handle = handle                # number standing for id in ShardStats
+        self.clock_rate = params.get('clock_rate',8000)
+        self.transport = transport
+        self.remote_rtcp = None
+        self.ssrcs = list(params.get('ssrcs',()))
+        self.rtp_packets = 0
+        self.rtcp_packets = 0
+        self.errors = 0
+        self.session = Session()
+        self.rtcp = Rtcp(params.get('bandwidth',SHARD_SESSION_BANDWIDTH),scheduler,send_report=self._send_report,ssrc=params.get('ssrc'))
+        self.session.sources = self.rtcp.sources
+        self.reports = ReportGenerator(self.rtcp.sources,scheduler.clock)
+        self.clock = ClockSync(self.rtcp.we_ssrc,self.clock_rate)
+        self.builder = CompoundRtcpBuilder(self.rtcp.we_ssrc,params.get('cname','shard-%d' % os.getpid()))
+
+    @property
+    def sources(self):
+        return self.session.sources
+
+    def on_rtp(self,header,addr,now):
+        self.rtp_packets += 1
+        ssrc = header.ssrc
+        state = self.sources.on_rtp(ssrc,header.seq,addr,now)
+        if state != SSRC_STATE.KNOWN and state != SSRC_STATE.NEW:
+            # collision, loop or third party conflict: not that source's packet
+            return
+        source = self.sources.source(ssrc)
+        if source is not None:
+            source.receive(header.seq,header.timestamp,int(now * self.clock_rate))
+
+    def on_rtcp(self,data,addr,now):
+        self.rtcp_packets += 1
+        try:
+            blocks = parse_compound(data)
+        except ValueError:
+            self.errors += 1
+            return
+        self.remote_rtcp = addr
+        for block in blocks:
+            pt = block.packet_type
+            if pt == RTCP_TYPE.RTCP_SR:
+                self.sources.on_rtcp(block.ssrc,addr,now)
+                self.reports.on_sender_report(block,now)
+                self.clock.on_sender_report(block)
+            elif pt == RTCP_TYPE.RTCP_RR:
+                self.sources.on_rtcp(block.ssrc,addr,now)
+            elif pt == RTCP_TYPE.RTCP_BYE:
+                for ssrc in block.sources:
+                    self.sources.on_bye(ssrc)
+                    self.reports.forget(ssrc)
+
+    def _send_report(self,e):
+        # member timeouts of RFC 3550 6.3.5, checked at each report, with
+        # the full minimum interval even before the first report
+        td = max(self.rtcp.deterministic_interval(),RTCP_MIN_TIME)
+        removed,_ = self.sources.expire(self.rtcp.tc,td)
+        for m in removed:
+            self.reports.forget(m.ssrc)
+            self.clock.forget(m.ssrc)
+        addr = self.remote_rtcp or self.transport.remote_rtcp
+        if addr is None:
+            return 0
+        packet = self.builder.build(self.reports.generate())
+        self.transport.send_rtcp(packet,addr)
+        return len(packet)
+
+    def source_stats(self):
+        for ssrc,m in self.sources.senders.items():
+            s = m.source
+            if s is None:
+                continue
+            item = self.reports.last_report(ssrc)
+            yield (ssrc,s.received,s.expected(),s.lost(),int(s.jitter),s.cycles + s.max_seq,
+                   item.fraction if item is not None else 0)
+
+    def query(self):
+        return {
+            'id': self.id,
+            'worker': os.getpid(),
+            'port': self.transport.local_port,
+            'ssrc': self.rtcp.we_ssrc,
+            'members': self.sources.member_count,
+            'senders': self.sources.sender_count,
+            'member_ssrcs': sorted(self.sources.members),
+            'sender_ssrcs': sorted(self.sources.senders),
+            'rtp_packets': self.rtp_packets,
+            'rtcp_packets': self.rtcp_packets,
+            'errors': self.errors,
+            'sources': [ dict(zip(SHARD_SOURCE_FIELDS[1:],row)) for row in self.source_stats() ],
+        }
+
+    def close(self):
+        self.rtcp.scheduler.cancel(self.rtcp)
+        self.builder.close()
+
+'''
+    Event loop of one worker process.
+
+    Sessions either own a port pair (opened on create), or, with
+    reuse_port, all workers bind the same port pair and route packets
+    to sessions by SSRC.  Sources are published to ShardStats every
+    interval, control requests arrive as (op, args) on conn and are
+    answered with (True, result) or (False, message).
+'''
+class ShardWorker:
+    def __init__(self,index,conn,stats,reuse_port=None,interval=SHARD_STATS_INTERVAL):
+        self.index = index
+        self.conn = conn
+        self.stats = stats
+        self.reuse_port = reuse_port        # (host, port) shared by all workers, or None
+        self.interval = interval
+        self.sessions = {}
+        self.by_ssrc = {}                   # reuse_port routing: remote SSRC -> _ShardSession
+        self.transport = None               # shared transport with reuse_port
+        self.scheduler = RtcpScheduler()
+        self.unrouted = 0
+        self.errors = 0
+        self._rows = {}                     # (session id, ssrc) -> stats row
+        self._free_rows = list(range(stats.rows - 1,-1,-1))
+        self._done = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._done = loop.create_future()
+        if self.reuse_port is not None:
+            host,port = self.reuse_port
+            self.transport = await AsyncioTransport().open(host,port,reuse_port=True)
+            self.transport.readable(self._route_rtp)
+            self.transport.rtcp_readable(self._route_rtcp)
+        loop.add_reader(self.conn.fileno(),self._control)
+        timer = loop.create_task(self.scheduler.run())
+        publisher = loop.create_task(self._publish_loop())
+        try:
+            await self._done
+        finally:
+            loop.remove_reader(self.conn.fileno())
+            self.scheduler.stop()
+            publisher.cancel()
+            for id in list(self.sessions):
+                await self.destroy(id)
+            if self.transport is not None:
+                self.transport.close()
+            await asyncio.gather(timer,publisher,return_exceptions=True)
+
+    def _control(self):
+        try:
+            op,args = self.conn.recv()
+        except EOFError:
+            # supervisor gone
+            if not self._done.done():
+                self._done.set_result(None)
+            return
+        asyncio.get_running_loop().create_task(self._answer(op,args))
+
+    async def _answer(self,op,args):
+        try:
+            if op == 'create':
+                result = await self.create(*args)
+            elif op == 'destroy':
+                result = await self.destroy(*args)
+            elif op == 'query':
+                result = self.query(*args)
+            elif op == 'list':
+                result = sorted(self.sessions)
+            elif op == 'stop':
+                result = None
+                self._done.set_result(None)
+            else:
+                raise ValueError('unknown shard operation %r' % (op,))
+            reply = (True,result)
+        except Exception as e:
+            # any failure must be answered, the supervisor blocks on recv()
+            reply = (False,'%s: %s' % (e.__class__.__name__,e))
+        self.conn.send(reply)
+
+    async def create(self,id,handle,params):
+        if id in self.sessions:
+            raise ValueError('session %r exists' % (id,))
+        if self.transport is not None:
+            transport = self.transport
+        else:
+            transport = await AsyncioTransport().open(params.get('local_host','0.0.0.0'),params.get('local_port',0),params.get('remote_host'),params.get('remote_port'))
+        s = _ShardSession(id,handle,params,self.scheduler,transport)
+        if transport is not self.transport:
+            now = self.scheduler.clock
+            transport.readable(lambda packet: s.on_rtp(packet[0],packet[2],now()))
+            transport.rtcp_readable(lambda packet: s.on_rtcp(packet[0],packet[1],now()))
+        for ssrc in s.ssrcs:
+            self.by_ssrc[ssrc] = s
+        self.sessions[id] = s
+        return s.query()
+
+    async def destroy(self,id):
+        s = self.sessions.pop(id)
+        for ssrc in s.ssrcs:
+            if self.by_ssrc.get(ssrc) is s:
+                del self.by_ssrc[ssrc]
+        for key in [ key for key in self._rows if key[0] == id ]:
+            row = self._rows.pop(key)
+            self.stats.clear_source(self.index,row)
+            self._free_rows.append(row)
+        s.close()
+        if s.transport is not self.transport:
+            s.transport.close()
+        return None
+
+    def query(self,id):
+        return self.sessions[id].query()
+
+    def _route_rtp(self,packet):
+        s = self.by_ssrc.get(packet[0].ssrc)
+        if s is None:
+            self.unrouted += 1
+            return
+        s.on_rtp(packet[0],packet[2],self.scheduler.clock())
+
+    def _route_rtcp(self,packet):
+        data,addr = packet
+        if len(data) < 8:
+            self.errors += 1
+            return
+        s = self.by_ssrc.get(struct.unpack_from('!I',data,4)[0])
+        if s is None:
+            self.unrouted += 1
+            return
+        s.on_rtcp(data,addr,self.scheduler.clock())
+
+    async def _publish_loop(self):
+        while True:
+            self.publish()
+            await asyncio.sleep(self.interval)
+
+    def publish(self):
+        stats = self.stats
+        rtp_packets = rtcp_packets = 0
+        errors = self.errors
+        live = set()
+        for s in self.sessions.values():
+            rtp_packets += s.rtp_packets
+            rtcp_packets += s.rtcp_packets
+            errors += s.errors
+            for row in s.source_stats():
+                key = (s.id,row[0])
+                live.add(key)
+                index = self._rows.get(key)
+                if index is None:
+                    if not self._free_rows:
+                        continue
+                    index = self._rows[key] = self._free_rows.pop()
+                try:
+                    stats.write_source(self.index,index,s.handle,*row)
+                except struct.error:
+                    errors += 1
+        for key in [ key for key in self._rows if key not in live ]:
+            # source timed out or left
+            row = self._rows.pop(key)
+            stats.clear_source(self.index,row)
+            self._free_rows.append(row)
+        stats.write_worker(self.index,len(self.sessions),rtp_packets,rtcp_packets,self.unrouted,errors)
+
+def _worker_main(index,conn,name,workers,rows,reuse_port,interval):
+    stats = ShardStats(workers,rows,name=name,create=False)
+    try:
+        asyncio.run(ShardWorker(index,conn,stats,reuse_port,interval).run())
+    finally:
+        stats.close()
+        conn.close()
+
+'''
+    Supervisor of N worker processes, each running its sessions on its
+    own event loop.
+
+    Without reuse_port a session lives on the worker shard_of(key) picks
+    (key defaults to the session id, use the SSRC or 5-tuple of its
+    traffic) and opens its own port pair there.  With reuse_port=(host,
+    port) every worker binds that port pair with SO_REUSEPORT, sessions
+    are created on all workers with the remote `ssrcs` they accept, and
+    each worker accounts the flows the kernel hands to it: query results
+    are then merged over the workers.
+
+    Per source statistics are read from shared memory without a round
+    trip to the workers, see stats().  Failed control operations raise
+    ValueError with the worker's message.
+'''
+class ShardedRuntime:
+    def __init__(self,workers=None,reuse_port=None,rows=SHARD_ROWS,interval=SHARD_STATS_INTERVAL,context=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.reuse_port = reuse_port
+        self.rows = rows
+        self.interval = interval
+        self.context = context or multiprocessing.get_context()
+        self.stats_memory = None
+        self._conns = []
+        self._procs = []
+        self._owner = {}                # session id -> worker index, None on all workers
+        self._handles = {}              # session id -> handle in ShardStats rows
+        self._ids = {}                  # handle -> session id
+        self._next_handle = 1
+
+    def start(self):
+        self.stats_memory = ShardStats(self.workers,self.rows)
+        for index in range(self.workers):
+            parent,child = self.context.Pipe()
+            proc = self.context.Process(target=_worker_main,name='rtp-shard-%d' % index,
+                                        args=(index,child,self.stats_memory.name,self.workers,self.rows,self.reuse_port,self.interval),
+                                        daemon=True)
+            proc.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(proc)
+        return self
+
+    def shard_of(self,key):
+        return shard_of(key,self.workers)
+
+    def _call(self,worker,op,*args):
+        conn = self._conns[worker]
+        conn.send((op,args))
+        ok,result = conn.recv()
+        if not ok:
+            raise ValueError(result)
+        return result
+
+    def _broadcast(self,op,*args):
+        for conn in self._conns:
+            conn.send((op,args))
+        results = []
+        error = None
+        for conn in self._conns:
+            ok,result = conn.recv()
+            if ok:
+                results.append(result)
+            elif error is None:
+                error = result
+        if error is not None:
+            raise ValueError(error)
+        return results
+
+    '''
+        Create session `id` and return its query() result.  params:
+        local_host, local_port, remote_host, remote_port, clock_rate,
+        bandwidth (kb/s), cname, ssrcs (remote SSRCs, used for routing
+        with reuse_port), ssrc (our RTCP SSRC).
+
+        ssrc and cname are picked here when not given, so that with
+        reuse_port every worker reports for the session under the same
+        identity.
+    '''
+    def create_session(self,id,key=None,**params):
+        if id in self._owner:
+            raise ValueError('session %r exists' % (id,))
+        handle = self._next_handle
+        params.setdefault('ssrc',random.randint(1,0xFFFFFFFF))
+        params.setdefault('cname','shard-%d-%d' % (os.getpid(),handle))
+        if self.reuse_port is not None:
+            worker = None
+            result = _merge(self._broadcast('create',id,handle,params))
+        else:
+            worker = self.shard_of(key if key is not None else id)
+            result = self._call(worker,'create',id,handle,params)
+        self._next_handle = (handle + 1) & 0xFFFFFFFF or 1
+        self._owner[id] = worker
+        self._handles[id] = handle
+        self._ids[handle] = id
+        return result
+
+    def destroy_session(self,id):
+        worker = self._owner.pop(id)
+        del self._ids[self._handles.pop(id)]
+        if worker is None:
+            self._broadcast('destroy',id)
+        else:
+            self._call(worker,'destroy',id)
+
+    def query_session(self,id):
+        worker = self._owner[id]
+        if worker is None:
+            return _merge(self._broadcast('query',id))
+        return self._call(worker,'query',id)
+
+    def sessions(self):
+        return sorted(self._owner)
+
+    '''
+        Snapshot of the shared memory statistics:
+        {'workers': [per worker counters], 'sources': [per source rows]}
+    '''
+    def stats(self):
+        workers = []
+        sources = []
+        for index in range(self.workers):
+            w = self.stats_memory.read_worker(index)
+            w['worker'] = index
+            workers.append(w)
+            for row in self.stats_memory.read_sources(index):
+                if row['session'] not in self._ids:
+                    # destroyed, the worker has not cleared it yet
+                    continue
+                row['session'] = self._ids[row['session']]
+                row['worker'] = index
+                sources.append(row)
+        return {'workers': workers,'sources': sources}
+
+    def stop(self,timeout=5.0):
+        for conn in self._conns:
+            try:
+                conn.send(('stop',()))
+            except OSError:
+                pass
+        for proc in self._procs:
+            proc.join(timeout)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        for conn in self._conns:
+            conn.close()
+        self._conns = []
+        self._procs = []
+        self._owner.clear()
+        self._handles.clear()
+        self._ids.clear()
+        if self.stats_memory is not None:
+            self.stats_memory.close()
+            self.stats_memory.unlink()
+            self.stats_memory = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,*exc):
+        self.stop()
+        return False
+
+'''
+    Merge the query() results of one session over all workers.
+
+    A remote SSRC can be heard by several workers (RTP and RTCP of a peer
+    hashed to different workers, or a peer changing port): members and
+    senders are counted over the union of the SSRCs, and of the source
+    rows of one SSRC the one with the most packets received is kept.
+'''
+def _merge(results):
+    merged = dict(results[0])
+    merged['workers'] = [ r['worker'] for r in results ]
+    members = set()
+    senders = set()
+    sources = {}
+    for r in results:
+        members.update(r['member_ssrcs'])
+        senders.update(r['sender_ssrcs'])
+        for row in r['sources']:
+            kept = sources.get(row['ssrc'])
+            if kept is None or row['received'] > kept['received']:
+                sources[row['ssrc']] = row
+    for r in results[1:]:
+        for name in ('rtp_packets','rtcp_packets','errors'):
+            merged[name] += r[name]
+    merged['member_ssrcs'] = sorted(members)
+    merged['sender_ssrcs'] = sorted(senders)
+    merged['members'] = len(members) + 1       # ourselves, as SourceRegistry.member_count
+    merged['senders'] = len(senders)
+    merged['sources'] = [ sources[ssrc] for ssrc in sorted(sources) ]
+    return merged
@@ -0,0 +1,324 @@
+import hashlib
+import hmac
+import struct
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+from rtp import RTP_HEADER_SIZE, RTP_EXT_HEADER
+
+class SRTP_PROFILE:
+    AES_CM_128_HMAC_SHA1_80     = 1     # RFC 3711
+    AEAD_AES_128_GCM            = 7     # RFC 7714
+
+'''
+    Key derivation labels (RFC 3711 4.3.1)
+'''
+class SRTP_LABEL:
+    RTP_ENCRYPTION      = 0x00
+    RTP_AUTH            = 0x01
+    RTP_SALT            = 0x02
+    RTCP_ENCRYPTION     = 0x03
+    RTCP_AUTH           = 0x04
+    RTCP_SALT           = 0x05
+
+SRTP_AUTH_KEY_SIZE = 20
+SRTP_HMAC_TAG_SIZE = 10                 # HMAC-SHA1-80
+SRTP_GCM_TAG_SIZE = 16
+SRTP_CM_SALT_SIZE = 14
+SRTP_GCM_SALT_SIZE = 12
+SRTCP_HEADER_SIZE = 8                   # common header + SSRC, never encrypted
+SRTCP_INDEX_SIZE = 4                    # E flag + 31-bit SRTCP index
+SRTCP_E_FLAG = 0x80000000
+SRTP_REPLAY_WINDOW = 64
+
+_UINT32 = struct.Struct('!I')
+_GCM_RTP_IV = struct.Struct('!HIIH')    # 0 || SSRC || ROC || SEQ
+_GCM_RTCP_IV = struct.Struct('!HIHI')   # 0 || SSRC || 0 || SRTCP index
+
+'''
+    AES-CM key derivation (RFC 3711 4.3.3), key derivation rate 0
+'''
+def derive_key(master_key,master_salt,label,length):
+    if Cipher is None:
+        raise ImportError('SRTP needs the cryptography package')
+    salt = int.from_bytes(master_salt.ljust(SRTP_CM_SALT_SIZE,b'\0'),'big')
+    x = (label << 48) ^ salt
+    encryptor = Cipher(algorithms.AES(master_key),modes.CTR((x << 16).to_bytes(16,'big'))).encryptor()
+    return encryptor.update(bytes(length))
+
+'''
+    Length of the RTP header (fixed, CSRC list and extension) of packet
+'''
+def rtp_header_length(buf,length):
+    n = RTP_HEADER_SIZE + ((buf[0] & 0xF) << 2)
+    if buf[0] & 0x10:
+        if n + RTP_EXT_HEADER.size > length:
+            raise ValueError('RTP packet too short for header extension')
+        n += RTP_EXT_HEADER.size + (RTP_EXT_HEADER.unpack_from(buf,n)[1] << 2)
+    if n > length:
+        raise ValueError('RTP packet too short')
+    return n
+
+'''
+    Sliding window of packet indexes already seen (RFC 3711 3.3.2),
+    bit i of bitmap is set if index top - i was accepted.
+'''
+class ReplayWindow:
+    __slots__ = ('top','bitmap','size')
+
+    def __init__(self,size=SRTP_REPLAY_WINDOW):
+        self.top = -1
+        self.bitmap = 0
+        self.size = size
+
+    def check(self,index):
+        if index > self.top:
+            return True
+        d = self.top - index
+        if d >= self.size:
+            return False
+        return not (self.bitmap >> d) & 1
+
+    def update(self,index):
+        if index > self.top:
+            self.bitmap = ((self.bitmap << (index - self.top)) | 1) & ((1 << self.size) - 1)
+            self.top = index
+        else:
+            self.bitmap |= 1 << (self.top - index)
+
+'''
+    Per-SSRC state: rollover counter, highest sequence number, replay
+    windows, SRTCP index and the IV part depending on the SSRC only.
+'''
+class _Stream:
+    __slots__ = ('roc','s_l','started','replay','rtcp_replay','rtcp_index','rtp_iv','rtcp_iv')
+
+    def __init__(self,ssrc,rtp_salt,rtcp_salt,window):
+        self.roc = 0
+        self.s_l = 0
+        self.started = False
+        self.replay = ReplayWindow(window)
+        self.rtcp_replay = ReplayWindow(window)
+        self.rtcp_index = 0
+        # AES-CM: IV = (salt << 16) ^ (SSRC << 64) ^ (index << 16)
+        self.rtp_iv = (rtp_salt << 16) ^ (ssrc << 64)
+        self.rtcp_iv = (rtcp_salt << 16) ^ (ssrc << 64)
+
+    '''packet index guess for seq (RFC 3711 3.3.1), return (roc, index)'''
+    def estimate(self,seq):
+        if not self.started:
+            return self.roc,(self.roc << 16) | seq
+        roc = self.roc
+        if self.s_l < 0x8000:
+            if seq - self.s_l > 0x8000:
+                roc = (roc - 1) & 0xFFFFFFFF
+        elif self.s_l - 0x8000 > seq:
+            roc = (roc + 1) & 0xFFFFFFFF
+        return roc,(roc << 16) | seq
+
+    def advance(self,roc,seq):
+        if not self.started:
+            self.started = True
+            self.roc = roc
+            self.s_l = seq
+        elif roc == ((self.roc + 1) & 0xFFFFFFFF):
+            self.roc = roc
+            self.s_l = seq
+        elif roc == self.roc and seq > self.s_l:
+            self.s_l = seq
+
+'''
+    SRTP/SRTCP transform of one session (one master key and salt).
+
+    Session keys are derived once, the AES and HMAC key schedules are
+    built once and per-SSRC IV material and replay state is cached, so a
+    packet costs one cipher context and (for AES-CM) one HMAC copy.
+
+    All transforms work in place: protect() and protect_rtcp() encrypt
+    buf[:length] and append the trailer/tag, buf needs room for it (see
+    overhead / rtcp_overhead); unprotect() and unprotect_rtcp() verify,
+    check replay and decrypt in place.  Each returns the new length.
+    Authentication and replay failures raise ValueError.
+'''
+class SrtpSession:
+    def __init__(self,master_key,master_salt,profile=SRTP_PROFILE.AES_CM_128_HMAC_SHA1_80,replay_window=SRTP_REPLAY_WINDOW):
+        if Cipher is None:
+            raise ImportError('SRTP needs the cryptography package')
+        self.profile = profile
+        self.replay_window = replay_window
+        self.gcm = profile == SRTP_PROFILE.AEAD_AES_128_GCM
+        key_size = len(master_key)
+        salt_size = SRTP_GCM_SALT_SIZE if self.gcm else SRTP_CM_SALT_SIZE
+
+        rtp_key = derive_key(master_key,master_salt,SRTP_LABEL.RTP_ENCRYPTION,key_size)
+        rtcp_key = derive_key(master_key,master_salt,SRTP_LABEL.RTCP_ENCRYPTION,key_size)
+        self.rtp_salt = int.from_bytes(derive_key(master_key,master_salt,SRTP_LABEL.RTP_SALT,salt_size),'big')
+        self.rtcp_salt = int.from_bytes(derive_key(master_key,master_salt,SRTP_LABEL.RTCP_SALT,salt_size),'big')
+        self._rtp_aes = algorithms.AES(rtp_key)
+        self._rtcp_aes = algorithms.AES(rtcp_key)
+        if self.gcm:
+            self.tag_size = SRTP_GCM_TAG_SIZE
+        else:
+            self.tag_size = SRTP_HMAC_TAG_SIZE
+            self._rtp_hmac = hmac.new(derive_key(master_key,master_salt,SRTP_LABEL.RTP_AUTH,SRTP_AUTH_KEY_SIZE),digestmod=hashlib.sha1)
+            self._rtcp_hmac = hmac.new(derive_key(master_key,master_salt,SRTP_LABEL.RTCP_AUTH,SRTP_AUTH_KEY_SIZE),digestmod=hashlib.sha1)
+        self._streams = {}          # ssrc -> _Stream
+
+    @property
+    def overhead(self):
+        return self.tag_size
+
+    @property
+    def rtcp_overhead(self):
+        return self.tag_size + SRTCP_INDEX_SIZE
+
+    def _stream(self,ssrc):
+        s = self._streams.get(ssrc)
+        if s is None:
+            s = self._streams[ssrc] = _Stream(ssrc,self.rtp_salt,self.rtcp_salt,self.replay_window)
+        return s
+
+    def forget(self,ssrc):
+        self._streams.pop(ssrc,None)
+
+    def _gcm_iv(self,layout,salt,*fields):
+        iv = bytearray(layout.size)
+        layout.pack_into(iv,0,*fields)
+        return (int.from_bytes(iv,'big') ^ salt).to_bytes(layout.size,'big')
+
+    def protect(self,buf,length):
+        view = buf if isinstance(buf,memoryview) else memoryview(buf)
+        if length + self.tag_size > len(view):
+            raise ValueError('no room for SRTP authentication tag')
+        seq,ssrc = struct.unpack_from('!2xH4xI',view,0)
+        start = rtp_header_length(view,length)
+        s = self._stream(ssrc)
+        roc,index = s.estimate(seq)
+        s.advance(roc,seq)
+        payload = view[start:length]
+        if self.gcm:
+            iv = self._gcm_iv(_GCM_RTP_IV,self.rtp_salt,0,ssrc,roc,seq)
+            encryptor = Cipher(self._rtp_aes,modes.GCM(iv)).encryptor()
+            encryptor.authenticate_additional_data(view[:start])
+            encryptor.update_into(payload,payload)
+            encryptor.finalize()
+            view[length:length + self.tag_size] = encryptor.tag
+        else:
+            iv = (s.rtp_iv ^ (index << 16)).to_bytes(16,'big')
+            encryptor = Cipher(self._rtp_aes,modes.CTR(iv)).encryptor()
+            encryptor.update_into(payload,payload)
+            h = self._rtp_hmac.copy()
+            h.update(view[:length])
+            h.update(_UINT32.pack(roc))
+            view[length:length + self.tag_size] = h.digest()[:self.tag_size]
+        return length + self.tag_size
+
+    def unprotect(self,buf,length):
+        view = buf if isinstance(buf,memoryview) else memoryview(buf)
+        length -= self.tag_size
+        if length < RTP_HEADER_SIZE:
+            raise ValueError('SRTP packet too short')
+        seq,ssrc = struct.unpack_from('!2xH4xI',view,0)
+        start = rtp_header_length(view,length)
+        s = self._stream(ssrc)
+        roc,index = s.estimate(seq)
+        if not s.replay.check(index):
+            raise ValueError('SRTP packet replayed')
+        tag = view[length:length + self.tag_size]
+        payload = view[start:length]
+        if self.gcm:
+            iv = self._gcm_iv(_GCM_RTP_IV,self.rtp_salt,0,ssrc,roc,seq)
+            decryptor = Cipher(self._rtp_aes,modes.GCM(iv,bytes(tag))).decryptor()
+            decryptor.authenticate_additional_data(view[:start])
+            clear = decryptor.update(payload)
+            try:
+                decryptor.finalize()
+            except InvalidTag:
+                raise ValueError('SRTP authentication failed')
+            payload[:] = clear
+        else:
+            h = self._rtp_hmac.copy()
+            h.update(view[:length])
+            h.update(_UINT32.pack(roc))
+            if not hmac.compare_digest(h.digest()[:self.tag_size],tag):
+                raise ValueError('SRTP authentication failed')
+            iv = (s.rtp_iv ^ (index << 16)).to_bytes(16,'big')
+            decryptor = Cipher(self._rtp_aes,modes.CTR(iv)).decryptor()
+            decryptor.update_into(payload,payload)
+        s.replay.update(index)
+        s.advance(roc,seq)
+        return length
+
+    def protect_rtcp(self,buf,length):
+        view = buf if isinstance(buf,memoryview) else memoryview(buf)
+        if length + self.rtcp_overhead > len(view):
+            raise ValueError('no room for SRTCP trailer')
+        ssrc = _UINT32.unpack_from(view,4)[0]
+        s = self._stream(ssrc)
+        index = s.rtcp_index
+        s.rtcp_index = (index + 1) & 0x7FFFFFFF
+        payload = view[SRTCP_HEADER_SIZE:length]
+        if self.gcm:
+            # header | ciphertext | tag | E + index
+            trailer = _UINT32.pack(SRTCP_E_FLAG | index)
+            iv = self._gcm_iv(_GCM_RTCP_IV,self.rtcp_salt,0,ssrc,0,index)
+            encryptor = Cipher(self._rtcp_aes,modes.GCM(iv)).encryptor()
+            encryptor.authenticate_additional_data(bytes(view[:SRTCP_HEADER_SIZE]) + trailer)
+            encryptor.update_into(payload,payload)
+            encryptor.finalize()
+            view[length:length + self.tag_size] = encryptor.tag
+            view[length + self.tag_size:length + self.rtcp_overhead] = trailer
+        else:
+            # header | ciphertext | E + index | tag
+            iv = (s.rtcp_iv ^ (index << 16)).to_bytes(16,'big')
+            encryptor = Cipher(self._rtcp_aes,modes.CTR(iv)).encryptor()
+            encryptor.update_into(payload,payload)
+            _UINT32.pack_into(view,length,SRTCP_E_FLAG | index)
+            h = self._rtcp_hmac.copy()
+            h.update(view[:length + SRTCP_INDEX_SIZE])
+            view[length + SRTCP_INDEX_SIZE:length + self.rtcp_overhead] = h.digest()[:self.tag_size]
+        return length + self.rtcp_overhead
+
+    def unprotect_rtcp(self,buf,length):
+        view = buf if isinstance(buf,memoryview) else memoryview(buf)
+        length -= self.rtcp_overhead
+        if length < SRTCP_HEADER_SIZE:
+            raise ValueError('SRTCP packet too short')
+        ssrc = _UINT32.unpack_from(view,4)[0]
+        s = self._stream(ssrc)
+        if self.gcm:
+            tag = view[length:length + self.tag_size]
+            trailer = view[length + self.tag_size:length + self.rtcp_overhead]
+        else:
+            trailer = view[length:length + SRTCP_INDEX_SIZE]
+            tag = view[length + SRTCP_INDEX_SIZE:length + self.rtcp_overhead]
+        word = _UINT32.unpack_from(trailer,0)[0]
+        index = word & 0x7FFFFFFF
+        if not s.rtcp_replay.check(index):
+            raise ValueError('SRTCP packet replayed')
+        payload = view[SRTCP_HEADER_SIZE:length]
+        if self.gcm:
+            iv = self._gcm_iv(_GCM_RTCP_IV,self.rtcp_salt,0,ssrc,0,index)
+            decryptor = Cipher(self._rtcp_aes,modes.GCM(iv,bytes(tag))).decryptor()
+            decryptor.authenticate_additional_data(bytes(view[:SRTCP_HEADER_SIZE]) + bytes(trailer))
+            clear = decryptor.update(payload)
+            try:
+                decryptor.finalize()
+            except InvalidTag:
+                raise ValueError('SRTCP authentication failed')
+            payload[:] = clear
+        else:
+            h = self._rtcp_hmac.copy()
+            h.update(view[:length + SRTCP_INDEX_SIZE])
+            if not hmac.compare_digest(h.digest()[:self.tag_size],tag):
+                raise ValueError('SRTCP authentication failed')
+            if word & SRTCP_E_FLAG:
+                iv = (s.rtcp_iv ^ (index << 16)).to_bytes(16,'big')
+                decryptor = Cipher(self._rtcp_aes,modes.CTR(iv)).decryptor()
+                decryptor.update_into(payload,payload)
+        s.rtcp_replay.update(index)
+        return length